@@ -123,6 +123,9 @@ def _size(x):
             wq.extend(x.items())
     return res
 
+# Cached attributes of ADT instances that must not be pickled.
+_TRANSIENT_ATTRS = ("_hash", "_alpha_hash", "_alpha_key")
+
 @total_ordering
 class ADT(object):
     def children(self):
@@ -154,8 +157,10 @@ class ADT(object):
         return self._hash
     def __getstate__(self):
         d = dict(self.__dict__)
-        if "_hash" in d:
-            del d["_hash"]
+        # hashes of strings and types differ from process to process
+        for a in _TRANSIENT_ATTRS:
+            if a in d:
+                del d[a]
         if hasattr(self, "__slots__"):
             for a in self.__slots__:
                 d[a] = getattr(self, a)
@@ -165,7 +170,14 @@ class ADT(object):
             setattr(self, k, v)
     def __eq__(self, other):
         if self is other: return True
-        return type(self) is type(other) and self.children() == other.children()
+        if type(self) is not type(other): return False
+        # cheap rejection when both hashes are already known
+        h1 = self.__dict__.get("_hash")
+        if h1 is not None:
+            h2 = other.__dict__.get("_hash")
+            if h2 is not None and h1 != h2:
+                return False
+        return self.children() == other.children()
     def __ne__(self, other):
         return not self.__eq__(other)
     def __lt__(self, other):
@@ -1,18 +1,20 @@
 from collections import OrderedDict
 from functools import total_ordering, lru_cache
 import itertools
+import random
 
-from cozy.common import typechecked, partition, make_random_access
+from cozy.common import typechecked, partition, make_random_access, OrderedSet
 from cozy.target_syntax import *
-from cozy.syntax_tools import BottomUpExplorer, pprint, equal, fresh_var, mk_lambda, free_vars, subst, alpha_equivalent, all_exps, cse
+from cozy.syntax_tools import BottomUpExplorer, pprint, equal, fresh_var, mk_lambda, free_vars, subst, alpha_equivalent, all_exps, cse, break_conj
 from cozy.typecheck import is_collection
 from cozy.pools import RUNTIME_POOL, STATE_POOL
 from cozy.solver import valid, satisfiable, REAL, SolverReportedUnknown, IncrementalSolver
-from cozy.evaluation import eval
+from cozy.evaluation import eval, eval_bulk
 from cozy.opts import Option
 
 assume_large_cardinalities = Option("assume-large-cardinalities", int, 1000)
 integer_cardinalities = Option("try-integer-cardinalities", bool, True)
+sample_cardinalities = Option("sample-cardinalities", bool, True, description="Rule out cost orderings by evaluating costs on sampled cardinalities before calling the solver")
 
 # In principle these settings are supposed to improve performance; in practice,
 # they do not.
@@ -25,6 +27,67 @@ class Cost(object):
     UNORDERED = "unordered"
     def compare_to(self, other, assumptions : Exp = T, solver : IncrementalSolver = None):
         raise NotImplementedError()
+    def comparison_key(self):
+        """
+        A structure of expressions, tuples, and constants that determines
+        the outcome of compare_to (see solver_cache.canonical_text).
+        """
+        raise NotImplementedError()
+
+# Cardinalities to try when sampling. They should be comfortably larger than
+# the minimum from --assume-large-cardinalities.
+_SAMPLE_GRID = (1001, 1500, 4000, 20000, 1000000)
+_RANDOM_SAMPLES = 8
+
+def _cardinality_samples(card_vars, cards : Exp) -> [dict]:
+    """
+    Environments mapping each of `card_vars` to a value such that `cards`
+    (a conjunction as produced by SymbolicCost.order_cardinalities) holds.
+    """
+    # Variables that must be equal get the same value.
+    rep = { v : v for v in card_vars }
+    def find(v):
+        while rep[v] != v:
+            v = rep[v]
+        return v
+    edges = []
+    for c in break_conj(cards):
+        if isinstance(c, EBinOp) and isinstance(c.e1, EVar) and isinstance(c.e2, EVar) and c.e1 in rep and c.e2 in rep:
+            if c.op == "==":
+                rep[find(c.e1)] = find(c.e2)
+            elif c.op == "<=":
+                edges.append((c.e1, c.e2))
+    classes = OrderedSet(find(v) for v in card_vars)
+    edges = [(find(v1), find(v2)) for (v1, v2) in edges]
+
+    # Lay the classes out by their depth in the <= graph.
+    level = { c : 0 for c in classes }
+    for i in range(len(classes)):
+        changed = False
+        for (c1, c2) in edges:
+            if c1 != c2 and level[c2] <= level[c1]:
+                level[c2] = level[c1] + 1
+                changed = True
+        if not changed:
+            break
+
+    assignments = []
+    for n in _SAMPLE_GRID:
+        assignments.append({ c : n for c in classes })
+        assignments.append({ c : n * (level[c] + 1) for c in classes })
+        assignments.append({ c : n * 10**level[c] for c in classes })
+    rng = random.Random(0)
+    by_level = sorted(classes, key=level.get)
+    for i in range(_RANDOM_SAMPLES):
+        a = { }
+        for c in by_level:
+            a[c] = max(itertools.chain(
+                (rng.randint(_SAMPLE_GRID[0], _SAMPLE_GRID[-1]),),
+                (a[c1] for (c1, c2) in edges if c2 == c and c1 in a)))
+        assignments.append(a)
+
+    envs = [{ v.id : a[find(v)] for v in card_vars } for a in assignments]
+    return [env for (env, ok) in zip(envs, eval_bulk(cards, envs)) if ok]
 
 class CostModel(object):
     def cost(self, e, pool):
@@ -43,6 +106,8 @@ class SymbolicCost(Cost):
         return "SymbolicCost({!r}, {!r})".format(self.formula, self.cardinalities)
     def __str__(self):
         return pprint(self.formula)
+    def comparison_key(self):
+        return (self.formula, tuple(self.cardinalities.items()))
     def compare_to(self, other, assumptions : Exp = T, solver : IncrementalSolver = None):
         assert isinstance(other, SymbolicCost)
         if False:
@@ -56,14 +121,42 @@ class SymbolicCost(Cost):
             o2 = s.valid(v2)
         else:
             cards = self.order_cardinalities(other, assumptions, solver)
-            o1 = self.always("<=", other, cards=cards)
-            o2 = other.always("<=", self, cards=cards)
+            r1, r2 = self.refuted_by_samples(other, cards) if sample_cardinalities.value else (False, False)
+            if r1 and r2:
+                return Cost.UNORDERED
+            o1 = not r1 and self.always("<=", other, cards=cards)
+            o2 = not r2 and other.always("<=", self, cards=cards)
         if o1 and not o2:
             return Cost.BETTER
         elif o2 and not o1:
             return Cost.WORSE
         else:
             return Cost.UNORDERED
+    def refuted_by_samples(self, other, cards : Exp) -> (bool, bool):
+        """
+        Evaluate both formulas on a few cardinalities satisfying `cards`.
+        Returns a pair (r1, r2), where r1 is true if some sample shows that
+        self <= other does not always hold, and r2 is likewise for
+        other <= self.
+        """
+        card_vars = OrderedSet(itertools.chain(self.cardinalities.values(), other.cardinalities.values()))
+        if not all(v in card_vars for v in itertools.chain(free_vars(self.formula), free_vars(other.formula))):
+            return (False, False)
+        # `cards` may also constrain cardinalities that neither formula uses
+        for v in free_vars(cards):
+            if v.type != INT:
+                return (False, False)
+            card_vars.add(v)
+        envs = _cardinality_samples(card_vars, cards)
+        if not envs:
+            return (False, False)
+        r1 = r2 = False
+        for (x, y) in zip(eval_bulk(self.formula, envs), eval_bulk(other.formula, envs)):
+            if x > y:
+                r1 = True
+            elif y > x:
+                r2 = True
+        return (r1, r2)
     def order_cardinalities(self, other, assumptions : Exp = T, solver : IncrementalSolver = None) -> Exp:
         if solver is None:
             solver = IncrementalSolver()
@@ -138,12 +231,12 @@ class SymbolicCost(Cost):
         # will cause this to timeout _every_time_, meaning we never make
         # progress.
         #   However, this timeout helps ensure liveness: the Python process
-        # never gets deadlocked waiting for Z3. In the Distant Future it
-        # would be nice to move away from Z3Py and invoke Z3 as a subprocess
-        # instead. That would allow the Python process to break out if it is
-        # asked to stop while Z3 is running. It would also give us added
-        # protection against Z3 segfaults, which have been observed in the
-        # wild from time to time.
+        # never gets deadlocked waiting for Z3. A job that is asked to stop
+        # does not wait for it either: the job's stop callback interrupts
+        # the check (see cozy.solver.default_stop_callback). With
+        # --solver-workers, Z3 runs in subprocesses that are killed instead,
+        # which also protects us against Z3 segfaults; those have been
+        # observed in the wild from time to time.
         timeout = 60
         try:
             return valid(f, logic="QF_NRA", timeout=timeout, **kwargs)
@@ -158,6 +251,8 @@ class PlainCost(Cost):
         return "PlainCost({!r})".format(self.n)
     def __str__(self):
         return str(self.n)
+    def comparison_key(self):
+        return self.n
     def compare_to(self, other, assumptions : Exp = T, solver : IncrementalSolver = None):
         assert isinstance(other, PlainCost)
         if self.n < other.n:
@@ -186,6 +281,8 @@ class CompositeCost(Cost):
         return "CompositeCost({})".format(", ".join(repr(c) for c in self.costs))
     def __str__(self):
         return "; ".join(str(c) for c in self.costs)
+    def comparison_key(self):
+        return tuple(c.comparison_key() for c in self.costs)
     def compare_to(self, other, assumptions : Exp = T, solver : IncrementalSolver = None):
         assert isinstance(other, CompositeCost)
         assert len(self.costs) == len(other.costs)
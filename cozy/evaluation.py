@@ -1,11 +1,16 @@
-from collections import UserDict, defaultdict, namedtuple
+from collections import UserDict, OrderedDict, defaultdict, namedtuple
 from functools import total_ordering, cmp_to_key, lru_cache
 import itertools
+import threading
 
 from cozy.target_syntax import *
 from cozy.syntax_tools import equal, pprint, free_vars, free_funcs, all_exps, purify
 from cozy.common import FrozenDict, OrderedSet, extend
 from cozy.typecheck import is_numeric, is_collection
+from cozy.opts import Option
+
+columnar_evaluation = Option("columnar-evaluation", bool, True, description="Evaluate expressions over many environments one operation at a time, rather than one environment at a time")
+compile_cache_size = Option("eval-compile-cache-size", int, 10000, metavar="N", description="Number of compiled expressions to keep for re-use by the evaluator (0 to disable)")
 
 @total_ordering
 class Map(object):
@@ -783,32 +788,192 @@ def _compile(e, env : {str:int}, out, bind_callback):
     if hasattr(e, "type") and isinstance(e.type, TList):
         out.append(iterable_to_list)
 
+# Types whose values compare the same way under `cmp` as under Python's
+# built-in comparison operators.
+_PYTHON_ORDERED_TYPES = (TInt, TLong, TFloat, TBool, TString, TNative)
+
+def _columnar_cond(cond, then_branch, else_branch):
+    def eval_cond(rows):
+        mask = cond(rows)
+        then_idx = [i for (i, b) in enumerate(mask) if b]
+        if len(then_idx) == len(rows):
+            return then_branch(rows)
+        if not then_idx:
+            return else_branch(rows)
+        else_idx = [i for (i, b) in enumerate(mask) if not b]
+        res = [None] * len(rows)
+        for (i, v) in zip(then_idx, then_branch([rows[i] for i in then_idx])):
+            res[i] = v
+        for (i, v) in zip(else_idx, else_branch([rows[i] for i in else_idx])):
+            res[i] = v
+        return res
+    return eval_cond
+
+def _compile_columnar(e, env : {str:int}):
+    """
+    Compile `e` to a function that takes a list of rows (each a list of
+    variable values laid out as in `env`) and returns the list of the values
+    of `e` on each row.
+
+    Each operation processes every row before moving on to the next one.
+    Only scalar-valued operations are handled this way; any other
+    subexpression is compiled with `_compile` and evaluated row by row.
+    Conditionals evaluate each branch only on the rows that select it, so
+    that the result is the same as evaluating row by row.
+    """
+    if isinstance(e.type, TList):
+        pass
+    elif isinstance(e, EVar) and isinstance(env.get(e.id), int):
+        i = env[e.id]
+        return lambda rows: [row[i] for row in rows]
+    elif isinstance(e, EBool) or isinstance(e, ENum) or isinstance(e, EStr) or isinstance(e, EEnumEntry) or isinstance(e, ENull):
+        val = None if isinstance(e, ENull) else e.name if isinstance(e, EEnumEntry) else e.val
+        return lambda rows: [val] * len(rows)
+    elif isinstance(e, EStateVar):
+        return _compile_columnar(e.e, env)
+    elif isinstance(e, ECond):
+        return _columnar_cond(
+            _compile_columnar(e.cond, env),
+            _compile_columnar(e.then_branch, env),
+            _compile_columnar(e.else_branch, env))
+    elif isinstance(e, ETuple):
+        fs = [_compile_columnar(ee, env) for ee in e.es]
+        return lambda rows: list(zip(*[f(rows) for f in fs])) if fs else [()] * len(rows)
+    elif isinstance(e, ETupleGet):
+        f = _compile_columnar(e.e, env)
+        n = e.n
+        return lambda rows: [v[n] for v in f(rows)]
+    elif isinstance(e, EGetField):
+        f = _compile_columnar(e.e, env)
+        if isinstance(e.e.type, THandle):
+            return lambda rows: [v.value for v in f(rows)]
+        field = e.f
+        return lambda rows: [v[field] for v in f(rows)]
+    elif isinstance(e, EUnaryOp):
+        op = {
+            UOp.Not:    lambda v: not v,
+            "-":        lambda v: -v,
+            UOp.Length: len,
+            UOp.Empty:  lambda v: not v,
+            UOp.Exists: bool,
+            UOp.Sum:    sum,
+            UOp.All:    all,
+            UOp.Any:    any }.get(e.op)
+        if op is not None:
+            f = _compile_columnar(e.e, env)
+            return lambda rows: [op(v) for v in f(rows)]
+    elif isinstance(e, EBinOp):
+        if e.op == "and":
+            return _compile_columnar(ECond(e.e1, e.e2, F).with_type(BOOL), env)
+        elif e.op == "or":
+            return _compile_columnar(ECond(e.e1, T, e.e2).with_type(BOOL), env)
+        op = None
+        t = e.e1.type
+        if is_numeric(e.type) and e.op in ("+", "-", "*"):
+            op = e.op
+        elif isinstance(t, _PYTHON_ORDERED_TYPES) and e.op in ("==", "===", "!=", "<", ">", "<=", ">="):
+            op = e.op
+        elif isinstance(t, TEnum) and e.op in ("==", "===", "!="):
+            op = e.op
+        if op is not None:
+            f1 = _compile_columnar(e.e1, env)
+            f2 = _compile_columnar(e.e2, env)
+            if   op == "+":  return lambda rows: [x + y  for (x, y) in zip(f1(rows), f2(rows))]
+            elif op == "-":  return lambda rows: [x - y  for (x, y) in zip(f1(rows), f2(rows))]
+            elif op == "*":  return lambda rows: [x * y  for (x, y) in zip(f1(rows), f2(rows))]
+            elif op == "!=": return lambda rows: [x != y for (x, y) in zip(f1(rows), f2(rows))]
+            elif op == "<":  return lambda rows: [x < y  for (x, y) in zip(f1(rows), f2(rows))]
+            elif op == ">":  return lambda rows: [x > y  for (x, y) in zip(f1(rows), f2(rows))]
+            elif op == "<=": return lambda rows: [x <= y for (x, y) in zip(f1(rows), f2(rows))]
+            elif op == ">=": return lambda rows: [x >= y for (x, y) in zip(f1(rows), f2(rows))]
+            else:            return lambda rows: [x == y for (x, y) in zip(f1(rows), f2(rows))]
+
+    # fall back to row-by-row evaluation
+    ops = []
+    _compile(e, env, ops, bind_callback=lambda arg, val: None)
+    return lambda rows: [_eval_compiled(ops, row) for row in rows]
+
 def free_vars_and_funcs(e):
     for v in free_vars(e):
         yield v.id
     for f in free_funcs(e):
         yield f
 
-def eval_bulk(e, envs, bind_callback=None, use_default_values_for_undefined_vars : bool = False):
-    e = purify(e)
-    if bind_callback is None:
-        bind_callback = lambda arg, val: None
+class _CompiledExp(object):
+    def __init__(self, e):
+        self.e = e # NOTE: keeps id(e) from being reused while cached
+        self.pure = purify(e)
+        self.vars = OrderedSet(free_vars_and_funcs(self.pure))
+        self.types = { v.id : v.type for v in free_vars(self.pure) }
+        self.vmap = { v : i for (i, v) in enumerate(self.vars) }
+        self._ops = None
+        self._columnar = None
+    def ops(self):
+        if self._ops is None:
+            ops = []
+            _compile(self.pure, self.vmap, ops, lambda arg, val: None)
+            self._ops = ops
+        return self._ops
+    def columnar(self):
+        if self._columnar is None:
+            self._columnar = _compile_columnar(self.pure, self.vmap)
+        return self._columnar
+
+_COMPILED = OrderedDict() # id(e) -> _CompiledExp
+_COMPILED_LOCK = threading.Lock()
+_compile_cache_hits = 0
+_compile_cache_misses = 0
+
+def _compiled(e):
+    global _compile_cache_hits, _compile_cache_misses
+    key = id(e)
+    with _COMPILED_LOCK:
+        c = _COMPILED.get(key)
+        if c is not None:
+            _COMPILED.move_to_end(key)
+            _compile_cache_hits += 1
+            return c
+        _compile_cache_misses += 1
+    c = _CompiledExp(e)
+    with _COMPILED_LOCK:
+        _COMPILED[key] = c
+        while len(_COMPILED) > compile_cache_size.value:
+            _COMPILED.popitem(last=False)
+    return c
+
+def compile_cache_stats():
+    return {
+        "hits": _compile_cache_hits,
+        "misses": _compile_cache_misses,
+        "size": len(_COMPILED) }
+
+def eval_bulk(e, envs, bind_callback=None, use_default_values_for_undefined_vars : bool = False, use_cache : bool = True):
     # return [eval(e, env, bind_callback=bind_callback) for env in envs]
     if not envs:
         return []
-    ops = []
-    vars = OrderedSet(free_vars_and_funcs(e))
-    types = { v.id : v.type for v in free_vars(e) }
-    vmap = { v : i for (i, v) in enumerate(vars) }
+    # Compiled code for `e` can only be re-used if it does not call back into
+    # a caller-provided bind_callback. Expressions are never mutated, so the
+    # cache never needs invalidation. Callers should pass use_cache=False for
+    # expressions that will not be evaluated again, which would only push
+    # useful entries out of the cache.
+    c = _compiled(e) if use_cache and bind_callback is None and compile_cache_size.value > 0 else _CompiledExp(e)
+    vars = c.vars
+    types = c.types
     try:
         envs = [ [(env.get(v, mkval(types[v])) if (use_default_values_for_undefined_vars and v in types) else env[v]) for v in vars] for env in envs ]
     except KeyError:
         import sys
         print("OH NO", file=sys.stderr)
-        print("e = {}".format(pprint(e)), file=sys.stderr)
-        print("eval_bulk({!r}, {!r}, use_default_values_for_undefined_vars={!r})".format(e, envs, use_default_values_for_undefined_vars), file=sys.stderr)
+        print("e = {}".format(pprint(c.pure)), file=sys.stderr)
+        print("eval_bulk({!r}, {!r}, use_default_values_for_undefined_vars={!r})".format(c.pure, envs, use_default_values_for_undefined_vars), file=sys.stderr)
         # import pdb
         # pdb.set_trace()
         raise
-    _compile(e, vmap, ops, bind_callback)
+    if bind_callback is not None:
+        ops = []
+        _compile(c.pure, c.vmap, ops, bind_callback)
+    elif columnar_evaluation.value and len(envs) > 1:
+        return c.columnar()(envs)
+    else:
+        ops = c.ops()
     return [_eval_compiled(ops, env) for env in envs]
@@ -0,0 +1,259 @@
+"""
+Per-phase timers for synthesis.
+
+Code marks the phases of synthesis with `phase(name)` (a context manager) or
+`timed(name)` (a decorator). Timing is exclusive: while a phase is running
+inside another one, only the inner phase is charged. Each thread has its
+own stack of phases, but all threads charge the same totals.
+
+The phases used by Cozy are listed in PHASES. The Learner reports the time
+spent in each phase for every minor iteration as an event (see `emit`).
+Events are sent to any registered listeners; when the "--trace" option is
+set, every query job also writes them as JSON lines to
+"<log-dir>/<query>.trace.jsonl". Running this module as a script summarizes
+such traces:
+
+    python -m cozy.instrumentation /tmp/*.trace.jsonl
+    python -m cozy.instrumentation /tmp/new --baseline /tmp/old
+"""
+
+from collections import defaultdict
+import functools
+import json
+import os
+import threading
+import time
+
+from cozy.opts import Option
+
+trace = Option("trace", bool, False,
+    description="Write per-phase timings for each query job to <log-dir>/<query>.trace.jsonl")
+
+PHASES = (
+    "enumeration",    # building candidate expressions
+    "wf",             # well-formedness checks
+    "fingerprint",    # evaluating candidates on examples
+    "cost",           # computing and comparing costs
+    "counterexample", # searching for counterexamples to candidate rewrites
+    "validation",     # checking solver models with the evaluator
+)
+
+class _Phase(object):
+    __slots__ = ("recorder", "name")
+    def __init__(self, recorder, name):
+        self.recorder = recorder
+        self.name = name
+    def __enter__(self):
+        self.recorder._push(self.name)
+    def __exit__(self, *args):
+        self.recorder._pop()
+
+class Recorder(object):
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.iteration = defaultdict(float) # since the last end_iteration()
+        self.total = defaultdict(float)     # since the last reset()
+        self.out = None
+        self.context = { }
+        self.listeners = []
+
+    def _stack(self):
+        try:
+            return self._local.stack
+        except AttributeError:
+            self._local.stack = []
+            return self._local.stack
+
+    def _charge(self, name, now):
+        local = self._local
+        elapsed = now - local.started
+        local.started = now
+        with self._lock:
+            self.iteration[name] += elapsed
+            self.total[name] += elapsed
+
+    def _push(self, name):
+        stack = self._stack()
+        now = time.perf_counter()
+        if stack:
+            self._charge(stack[-1], now)
+        else:
+            self._local.started = now
+        stack.append(name)
+
+    def _pop(self):
+        stack = self._stack()
+        self._charge(stack.pop(), time.perf_counter())
+
+    def phase(self, name):
+        return _Phase(self, name)
+
+    def end_iteration(self):
+        """Returns the time spent in each phase since the last call."""
+        with self._lock:
+            res = dict(self.iteration)
+            self.iteration.clear()
+        return res
+
+    def reset(self):
+        with self._lock:
+            self.iteration.clear()
+            self.total.clear()
+
+    def start_trace(self, path, **context):
+        self.stop_trace()
+        self.out = open(path, "w")
+        self.context = context
+
+    def stop_trace(self):
+        if self.out is not None:
+            self.out.close()
+            self.out = None
+
+    def emit(self, event, **fields):
+        if self.out is None and not self.listeners:
+            return
+        record = { "event": event, "time": time.time() }
+        record.update(self.context)
+        record.update(fields)
+        if self.out is not None:
+            self.out.write(json.dumps(record, default=str))
+            self.out.write("\n")
+            self.out.flush()
+        for f in self.listeners:
+            f(record)
+
+_RECORDER = Recorder()
+
+def phase(name):
+    """Context manager that charges the time spent inside it to `name`."""
+    return _RECORDER.phase(name)
+
+def timed(name):
+    """Decorator that charges the time spent in the function to `name`."""
+    def wrap(f):
+        @functools.wraps(f)
+        def g(*args, **kwargs):
+            with _RECORDER.phase(name):
+                return f(*args, **kwargs)
+        return g
+    return wrap
+
+def timed_iter(it, name):
+    """Yields the elements of `it`, charging the time to produce them to `name`."""
+    it = iter(it)
+    while True:
+        with _RECORDER.phase(name):
+            try:
+                x = next(it)
+            except StopIteration:
+                return
+        yield x
+
+def end_iteration():
+    return _RECORDER.end_iteration()
+
+def total_times():
+    with _RECORDER._lock:
+        return dict(_RECORDER.total)
+
+def reset():
+    _RECORDER.reset()
+
+def start_trace(path, **context):
+    """Send events to the given file. `context` is added to every event."""
+    _RECORDER.start_trace(path, **context)
+
+def stop_trace():
+    _RECORDER.stop_trace()
+
+def emit(event, **fields):
+    """Record an event, e.g. in the trace file; all fields must be JSON-friendly."""
+    _RECORDER.emit(event, **fields)
+
+def add_listener(f):
+    """Call f(record) on every event, whether or not a trace is being written."""
+    _RECORDER.listeners.append(f)
+
+def remove_listener(f):
+    _RECORDER.listeners.remove(f)
+
+def format_times(times):
+    return ", ".join("{}={:.2f}s".format(p, times.get(p, 0.0)) for p in PHASES)
+
+# -----------------------------------------------------------------------------
+# Summarizing traces
+
+def _trace_files(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name.endswith(".trace.jsonl"):
+                    yield os.path.join(path, name)
+        else:
+            yield path
+
+def summarize(paths):
+    """
+    Returns a map from query name to the time spent in each phase, read from
+    the given trace files (or directories containing them). Jobs that were
+    killed before writing a final "job" event are summarized from their
+    minor iterations.
+    """
+    iterations = defaultdict(lambda: defaultdict(float))
+    finished = { }
+    for path in _trace_files(paths):
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                record = json.loads(line)
+                q = record.get("query", os.path.basename(path))
+                if record["event"] == "minor_iteration":
+                    for p, t in record["phases"].items():
+                        iterations[q][p] += t
+                elif record["event"] == "job":
+                    finished[q] = record["phases"]
+    res = { }
+    for q in set(iterations) | set(finished):
+        res[q] = dict(finished[q] if q in finished else iterations[q])
+    return res
+
+def _print_summary(summary, baseline=None):
+    cols = ("query",) + PHASES
+    print("  ".join("{:>14}".format(c) for c in cols))
+    def row(name, times, base):
+        cells = ["{:>14}".format(name[:14])]
+        for p in PHASES:
+            t = times.get(p, 0.0)
+            if base is None:
+                cells.append("{:>14.2f}".format(t))
+            else:
+                cells.append("{:>14}".format("{:.2f} ({:+.2f})".format(t, t - base.get(p, 0.0))))
+        print("  ".join(cells))
+    overall = defaultdict(float)
+    overall_base = defaultdict(float)
+    for q in sorted(summary):
+        row(q, summary[q], baseline.get(q, { }) if baseline is not None else None)
+        for p, t in summary[q].items():
+            overall[p] += t
+    if baseline is not None:
+        for times in baseline.values():
+            for p, t in times.items():
+                overall_base[p] += t
+    row("TOTAL", overall, overall_base if baseline is not None else None)
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="Summarize Cozy synthesis traces.")
+    parser.add_argument("traces", nargs="+", help="trace files or directories containing them")
+    parser.add_argument("--baseline", nargs="+", help="traces from an earlier run to compare against")
+    args = parser.parse_args(argv)
+    _print_summary(
+        summarize(args.traces),
+        summarize(args.baseline) if args.baseline else None)
+
+if __name__ == "__main__":
+    main()
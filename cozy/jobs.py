@@ -1,10 +1,15 @@
 from multiprocessing import Process, Array, Queue
 from queue import Queue as PlainQueue, Empty, Full
+import os
+import pickle
+import select
+import struct
+import subprocess
 import time
 import threading
 import sys
 
-from cozy.timeouts import Timeout
+from cozy.timeouts import Timeout, TimeoutException
 from cozy.opts import Option
 
 do_profiling = Option("profile", bool, False, description="Profile Cozy itself")
@@ -134,3 +139,112 @@ class SafeQueue(object):
                 res.append(self.get(block=False))
             except Empty:
                 return res
+
+class WorkerDied(Exception):
+    pass
+
+class WorkerInterrupted(Exception):
+    pass
+
+_HEADER = struct.Struct(">Q")
+
+def _write_message(f, obj):
+    data = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+    f.write(_HEADER.pack(len(data)))
+    f.write(data)
+    f.flush()
+
+def _read_exactly(f, n):
+    chunks = []
+    while n > 0:
+        chunk = f.read(n)
+        if not chunk:
+            raise EOFError()
+        chunks.append(chunk)
+        n -= len(chunk)
+    return b"".join(chunks)
+
+def serve(handler):
+    """
+    Main loop for a SubprocessWorker: read requests from stdin, and write
+    handler(request) to stdout. Returns when stdin is closed.
+    """
+    inp = sys.stdin.buffer
+    out = sys.stdout.buffer
+    # Stray print statements must not corrupt the protocol.
+    sys.stdout = sys.stderr
+    while True:
+        try:
+            n, = _HEADER.unpack(_read_exactly(inp, _HEADER.size))
+            request = pickle.loads(_read_exactly(inp, n))
+        except EOFError:
+            return
+        _write_message(out, handler(request))
+
+class SubprocessWorker(object):
+    """
+    A long-lived Python subprocess running `serve` that answers requests one
+    at a time.
+
+    Unlike a Job, a SubprocessWorker can be started from inside a Job (whose
+    daemonic process is not allowed to have children of its own) and can be
+    killed at any moment---e.g. while it is stuck in native code---without
+    harming the process that started it.
+    """
+    def __init__(self, module : str):
+        env = dict(os.environ)
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env["PYTHONPATH"] = root + (os.pathsep + env["PYTHONPATH"] if env.get("PYTHONPATH") else "")
+        self.proc = subprocess.Popen(
+            [sys.executable, "-m", module],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            env=env)
+        self.buf = b""
+    @property
+    def alive(self):
+        return self.proc.poll() is None
+    def send(self, request):
+        try:
+            _write_message(self.proc.stdin, request)
+        except (BrokenPipeError, OSError) as e:
+            raise WorkerDied() from e
+    def _fill(self, n, deadline, stop_callback, poll_interval):
+        fd = self.proc.stdout.fileno()
+        while len(self.buf) < n:
+            if stop_callback is not None and stop_callback():
+                raise WorkerInterrupted()
+            wait = poll_interval
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise TimeoutException()
+                wait = min(wait, remaining)
+            ready, _, _ = select.select([fd], [], [], wait)
+            if ready:
+                chunk = os.read(fd, 65536)
+                if not chunk:
+                    raise WorkerDied()
+                self.buf += chunk
+        res = self.buf[:n]
+        self.buf = self.buf[n:]
+        return res
+    def recv(self, deadline : float = None, stop_callback = None, poll_interval : float = 0.1):
+        """
+        Wait for the response to the last request. Raises TimeoutException if
+        the response does not arrive before `deadline` (as given by
+        time.time()), WorkerInterrupted if `stop_callback()` becomes true
+        first, and WorkerDied if the worker exits. After any of those the
+        worker is in an unknown state and should be killed.
+        """
+        n, = _HEADER.unpack(self._fill(_HEADER.size, deadline, stop_callback, poll_interval))
+        return pickle.loads(self._fill(n, deadline, stop_callback, poll_interval))
+    def kill(self):
+        if self.alive:
+            self.proc.kill()
+        self.proc.wait()
+        for f in (self.proc.stdin, self.proc.stdout):
+            try:
+                f.close()
+            except OSError:
+                pass
@@ -33,7 +33,7 @@ def run():
     parser.add_argument("-R", "--resume", action="store_true", help="Resume from saved synthesis output")
     parser.add_argument("-t", "--timeout", metavar="N", type=float, default=60, help="Per-query synthesis timeout (in seconds); default=60")
     parser.add_argument("-s", "--simple", action="store_true", help="Do not synthesize improved solution; use the most trivial implementation of the spec")
-    parser.add_argument("-p", "--port", metavar="P", type=int, default=None, help="Port to run progress-showing HTTP server")
+    parser.add_argument("-p", "--port", metavar="P", type=int, default=None, help="Port to run progress-showing HTTP server (live job metrics are at /metrics.json)")
 
     java_opts = parser.add_argument_group("Java codegen")
     java_opts.add_argument("--java", metavar="FILE.java", default=None, help="Output file for java classes, use '-' for stdout")
@@ -90,6 +90,7 @@ def run():
     if not args.simple:
         callback = None
         server = None
+        metrics = None
         if checkpoint_prefix.value:
             def callback(res):
                 impl, ast, state_map = res
@@ -103,11 +104,7 @@ def run():
 
         if args.port:
             from cozy import progress_server
-            state = ["Initializing..."]
-            orig_callback = callback
-            def callback(res):
-                if orig_callback is not None:
-                    orig_callback(res)
+            def render(res):
                 impl, ast, state_map = res
                 s = "<!DOCTYPE html>\n"
                 s += "<html>"
@@ -122,13 +119,22 @@ def run():
                 s += "\n"
                 s += syntax_tools.pprint(ast, format="html")
                 s += "</pre></body></html>"
-                state[0] = s
-            server = progress_server.ProgressServer(port=args.port, callback=lambda: state[0])
+                return s
+            page = progress_server.LazyPage(render, initial="Initializing...")
+            orig_callback = callback
+            def callback(res):
+                if orig_callback is not None:
+                    orig_callback(res)
+                page.update(res)
+            metrics = synthesis.JobMetrics()
+            server = progress_server.ProgressServer(port=args.port, callback=page,
+                endpoints={ "/metrics.json": metrics.snapshot })
             server.start_async()
         ast = synthesis.improve_implementation(
             ast,
             timeout           = datetime.timedelta(seconds=args.timeout),
-            progress_callback = callback)
+            progress_callback = callback,
+            metrics           = metrics)
         if server is not None:
             server.join()
 
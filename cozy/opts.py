@@ -31,3 +31,13 @@ def read(args):
             o.value = not o.value
         if o.type is int:
             o.value = int(o.value)
+
+def snapshot():
+    """Current values of all options, suitable for passing to `restore`."""
+    return { o.name : o.value for o in _OPTS }
+
+def restore(values):
+    """Set option values from the output of `snapshot` (e.g. in a subprocess)."""
+    for o in _OPTS:
+        if o.name in values:
+            o.value = values[o.name]
@@ -1,28 +1,67 @@
-from threading import Thread
+import json
+from threading import Lock, Thread
 from http.server import HTTPServer, BaseHTTPRequestHandler
 
-def handler_class(callback):
+def handler_class(callback, endpoints=None):
+    """
+    The page at "/" is the HTML returned by `callback()`. `endpoints` maps
+    other paths to functions whose results are served as JSON.
+    """
+    endpoints = endpoints or { }
     class Handler(BaseHTTPRequestHandler):
-        def do_GET(self):
-            if self.path != "/":
-                self.send_response(404)
-                content = "not found"
-                self.send_header("Content-Type", "text/plain")
-                self.send_header("Content-Length", str(len(content)))
-                self.end_headers()
-                self.wfile.write(content.encode("utf-8"))
-                return
-            content = callback()
-            self.send_response(200)
-            self.send_header("Content-Type", "text/html")
+        def respond(self, code, content_type, content):
+            content = content.encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", "{}; charset=utf-8".format(content_type))
             self.send_header("Content-Length", str(len(content)))
             self.end_headers()
-            self.wfile.write(content.encode("ascii"))
+            self.wfile.write(content)
+        def do_GET(self):
+            path = self.path.split("?", 1)[0]
+            if path == "/":
+                self.respond(200, "text/html", callback())
+            elif path in endpoints:
+                self.respond(200, "application/json", json.dumps(endpoints[path](), default=str))
+            else:
+                self.respond(404, "text/plain", "not found")
+        def log_message(self, format, *args):
+            # polling clients would flood the console otherwise
+            pass
     return Handler
 
+class LazyPage(object):
+    """
+    Page callback that renders `render(snapshot)` only when the page is
+    requested, at most once per call to `update(snapshot)`. Rendering
+    happens on the server thread, so `update` never waits for it.
+    """
+    def __init__(self, render, initial=""):
+        self.render = render
+        self.lock = Lock()
+        self.snapshot = None
+        self.version = 0
+        self.rendered_version = 0
+        self.content = initial
+    def update(self, snapshot):
+        with self.lock:
+            self.snapshot = snapshot
+            self.version += 1
+    def __call__(self):
+        with self.lock:
+            version = self.version
+            snapshot = self.snapshot
+            if version == self.rendered_version:
+                return self.content
+        content = self.render(snapshot)
+        with self.lock:
+            if version > self.rendered_version:
+                self.content = content
+                self.rendered_version = version
+        return content
+
 class ProgressServer(HTTPServer):
-    def __init__(self, callback, port=8080):
-        super().__init__(('', port), handler_class(callback))
+    def __init__(self, callback, port=8080, endpoints=None):
+        super().__init__(('', port), handler_class(callback, endpoints))
     def start_async(self):
         self.thread = Thread(target=self.serve_forever, daemon=True)
         self.thread.start()
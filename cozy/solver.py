@@ -1,6 +1,8 @@
 from collections import defaultdict, OrderedDict
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 import itertools
+import os
 import threading
 from functools import lru_cache
 
@@ -11,10 +13,15 @@ from cozy.syntax_tools import BottomUpExplorer, pprint, free_vars, free_funcs, c
 from cozy.typecheck import is_collection, is_numeric
 from cozy.common import declare_case, fresh_name, Visitor, FrozenDict, typechecked, extend, OrderedSet, make_random_access
 from cozy import evaluation
+from cozy import solver_cache
+from cozy import solver_worker
+from cozy.jobs import WorkerInterrupted
+from cozy.instrumentation import phase
 from cozy.opts import Option
 
 save_solver_testcases = Option("save-solver-testcases", str, "", metavar="PATH")
 collection_depth_opt = Option("collection-depth", int, 2, metavar="N", description="Bound for bounded verification")
+solver_pool_reuse = Option("solver-pool-reuse", int, 500, metavar="N", description="Number of queries answered by a pooled solver before it is replaced (0 to disable pooling)")
 
 class SolverReportedUnknown(Exception):
     pass
@@ -22,6 +29,45 @@ class SolverReportedUnknown(Exception):
 class ModelValidationError(Exception):
     pass
 
+class SolverInterrupted(Exception):
+    pass
+
+# Stop callback for the top-level satisfy, satisfiable, and valid functions
+# when they are not given one (see default_stop_callback).
+_DEFAULT_STOP_CALLBACK = None
+
+# How often (in seconds) a running check polls its stop callback.
+_STOP_POLL_INTERVAL = 0.1
+
+# Timeout (in seconds) for re-checking a model found by a solver worker when
+# the query itself has none.
+_MODEL_CHECK_TIMEOUT = 10
+
+# Z3's value for "no timeout".
+_NO_TIMEOUT = 2**32 - 1
+
+@contextmanager
+def default_stop_callback(stop_callback):
+    """
+    Within this block, the top-level satisfy, satisfiable, and valid
+    functions (on every thread) raise SolverInterrupted soon after
+    `stop_callback()` becomes true, unless they are given a stop_callback of
+    their own. Meant to cover everything a job does.
+    """
+    global _DEFAULT_STOP_CALLBACK
+    prev = _DEFAULT_STOP_CALLBACK
+    _DEFAULT_STOP_CALLBACK = stop_callback
+    try:
+        yield
+    finally:
+        _DEFAULT_STOP_CALLBACK = prev
+
+def _with_default_stop_callback(opts):
+    if opts.get("stop_callback") is None and _DEFAULT_STOP_CALLBACK is not None:
+        opts = dict(opts)
+        opts["stop_callback"] = _DEFAULT_STOP_CALLBACK
+    return opts
+
 TReal = declare_case(Type, "TReal", [])
 REAL = TReal()
 
@@ -953,18 +999,48 @@ def mkconst(ctx, solver, val):
     else:
         raise NotImplementedError(repr(val))
 
-_start = None
+# Per-thread timing state for _tick/_tock.
+_timing = threading.local()
 _debug_duration = timedelta(seconds=5)
 def _tick():
-    global _start
-    _start = datetime.now()
+    _timing.start = datetime.now()
+
+# Upper bounds (in milliseconds) of the buckets of the solver latency
+# histogram reported by solver_stats(); the last bucket is unbounded.
+_LATENCY_BUCKETS = (1, 10, 100, 1000, 10000)
+_stats_lock = threading.Lock()
+_calls = 0
+_solve_seconds = 0.0
+_latencies = [0] * (len(_LATENCY_BUCKETS) + 1)
+
+def _record_solve(elapsed):
+    global _calls, _solve_seconds
+    ms = elapsed.total_seconds() * 1000
+    i = 0
+    while i < len(_LATENCY_BUCKETS) and ms > _LATENCY_BUCKETS[i]:
+        i += 1
+    with _stats_lock:
+        _calls += 1
+        _solve_seconds += elapsed.total_seconds()
+        _latencies[i] += 1
+
+def solver_stats():
+    """
+    Number of calls to Z3 made by this process, the total time spent in
+    them, and a histogram of their latencies.
+    """
+    with _stats_lock:
+        hist = OrderedDict(("<={}ms".format(b), n) for (b, n) in zip(_LATENCY_BUCKETS, _latencies))
+        hist[">{}ms".format(_LATENCY_BUCKETS[-1])] = _latencies[-1]
+        return { "calls": _calls, "seconds": _solve_seconds, "latency": hist }
 
 def _tock(e, event):
-    global _start
     now = datetime.now()
     # print("tock({}) @ {}".format(event, now))
-    elapsed = now - _start
-    _start = now
+    elapsed = now - _timing.start
+    _timing.start = now
+    if event == "solve":
+        _record_solve(elapsed)
     if elapsed > _debug_duration:
         import sys
         print("took {elapsed}s to {event}".format(event=event, elapsed=elapsed.total_seconds()), file=sys.stderr)
@@ -972,9 +1048,12 @@ def _tock(e, event):
         # print(repr(e), file=sys.stderr)
         # raise NotImplementedError()
 
-_LOCK = threading.RLock()
-
 class IncrementalSolver(object):
+    """
+    A Z3 solver with its own Z3 context. Instances must not be shared between
+    threads, but distinct instances may be used concurrently.
+    """
+
     SAVE_PROPS = [
         "vars",
         "funcs",
@@ -987,7 +1066,8 @@ class IncrementalSolver(object):
             validate_model : bool = True,
             model_callback = None,
             logic : str = None,
-            timeout : float = None):
+            timeout : float = None,
+            stop_callback = None):
 
         if collection_depth is None:
             collection_depth = collection_depth_opt.value
@@ -997,20 +1077,27 @@ class IncrementalSolver(object):
         self.collection_depth = collection_depth
         self.validate_model = validate_model
         self.model_callback = model_callback
+        self.logic = logic
+        self.timeout = timeout
+        self.stop_callback = stop_callback
         self._env = OrderedDict()
         self.stk = []
 
-        with _LOCK:
-            ctx = z3.Context()
-            solver = z3.Solver(ctx=ctx) if logic is None else z3.SolverFor(logic, ctx=ctx)
-            if timeout is not None:
-                solver.set("timeout", int(timeout * 1000))
-            solver.set("core.validate", validate_model)
-            visitor = ToZ3(ctx, solver)
+        ctx = z3.Context()
+        solver = self._new_z3_solver(ctx)
+        visitor = ToZ3(ctx, solver)
+
+        self.visitor = visitor
+        self.z3_solver = solver
+        self._create_vars(vars=vars or (), funcs=funcs or {})
 
-            self.visitor = visitor
-            self.z3_solver = solver
-            self._create_vars(vars=vars or (), funcs=funcs or {})
+    def _new_z3_solver(self, ctx):
+        logic = self.logic
+        solver = z3.Solver(ctx=ctx) if logic is None else z3.SolverFor(logic, ctx=ctx)
+        if self.timeout is not None:
+            solver.set("timeout", int(self.timeout * 1000))
+        solver.set("core.validate", self.validate_model)
+        return solver
 
     def push(self):
         self.stk.append(tuple(type(getattr(self, p))(getattr(self, p)) for p in IncrementalSolver.SAVE_PROPS))
@@ -1039,15 +1126,13 @@ class IncrementalSolver(object):
         e = purify(e)
         e = cse(e, verify=False)
         _tock(e, "cse (size: {} --> {})".format(orig_size, len(list(all_exps(e)))))
-        with _LOCK:
-            self._create_vars(vars=free_vars(e), funcs=free_funcs(e))
-            return self.visitor.visit(e, self._env)
+        self._create_vars(vars=free_vars(e), funcs=free_funcs(e))
+        return self.visitor.visit(e, self._env)
 
     def add_assumption(self, e):
         # print("adding assumption {} to {}".format(pprint(e), id(self)))
         try:
-            with _LOCK:
-                self.z3_solver.add(self._convert(e))
+            self.z3_solver.add(self._convert(e))
         except Exception:
             print(" ---> to reproduce: satisfy({e!r}, vars={vars!r}, collection_depth={collection_depth!r}, validate_model={validate_model!r})".format(
                 e=e,
@@ -1066,171 +1151,369 @@ class IncrementalSolver(object):
         vars = self.vars
         visitor = self.visitor
 
-        with _LOCK:
-            _tick()
-
-            def reconstruct(model, value, type):
-                if type == INT or type == LONG:
-                    return model.eval(value, model_completion=True).as_long()
-                elif type == REAL or type == FLOAT:
-                    return model.eval(value, model_completion=True).as_fraction()
-                elif isinstance(type, TNative):
-                    return (type.name, model.eval(value, model_completion=True).as_long())
-                elif type == STRING:
-                    i = model.eval(value, model_completion=True).as_long()
-                    return "a" * i
-                elif type == BOOL:
-                    return bool(model.eval(value, model_completion=True))
-                elif isinstance(type, TBag) or isinstance(type, TSet) or isinstance(type, TList):
-                    mask, elems = value
-                    real_val = []
-                    for i in range(len(elems)):
-                        if reconstruct(model, mask[i], BOOL):
-                            real_val.append(reconstruct(model, elems[i], type.t))
-                    if isinstance(type, TList):
-                        return tuple(real_val)
-                    return evaluation.Bag(real_val)
-                elif isinstance(type, TMap):
-                    default = reconstruct(model, value["default"], type.v)
-                    res = evaluation.Map(type, default)
-                    for (mask, k, v) in value["mapping"]:
-                        # K/V pairs appearing earlier in value["mapping"] have precedence
-                        if reconstruct(model, mask, BOOL):
-                            k = reconstruct(model, k, type.k)
-                            if k not in res.keys():
-                                v = reconstruct(model, v, type.v)
-                                res[k] = v
-                    return res
-                elif isinstance(type, TEnum):
-                    val = model.eval(value, model_completion=True).as_long()
-                    return type.cases[val]
-                elif isinstance(type, THandle):
-                    id, val = value
-                    id = reconstruct(model, id, INT)
-                    val = reconstruct(model, val, type.value_type)
-                    return evaluation.Handle(id, val)
-                elif isinstance(type, TRecord):
-                    res = defaultdict(lambda: None)
-                    for (field, t) in type.fields:
-                        res[field] = reconstruct(model, value[field], t)
-                    return FrozenDict(res)
-                elif isinstance(type, TTuple):
-                    return tuple(reconstruct(model, v, t) for (v, t) in zip(value, type.ts))
-                else:
-                    raise NotImplementedError(type)
-
-            a = self._convert(e)
-            solver.push()
-            solver.add(a)
+        _tick()
 
-            # print(solver.assertions())
-            _tock(e, "encode")
-            res = solver.check()
-            _tock(e, "solve")
-            if res == z3.unsat:
-                solver.pop()
-                return None
-            elif res == z3.unknown:
-                solver.pop()
-                raise SolverReportedUnknown("z3 reported unknown")
+        def reconstruct(model, value, type):
+            if type == INT or type == LONG:
+                return model.eval(value, model_completion=True).as_long()
+            elif type == REAL or type == FLOAT:
+                return model.eval(value, model_completion=True).as_fraction()
+            elif isinstance(type, TNative):
+                return (type.name, model.eval(value, model_completion=True).as_long())
+            elif type == STRING:
+                i = model.eval(value, model_completion=True).as_long()
+                return "a" * i
+            elif type == BOOL:
+                return bool(model.eval(value, model_completion=True))
+            elif isinstance(type, TBag) or isinstance(type, TSet) or isinstance(type, TList):
+                mask, elems = value
+                real_val = []
+                for i in range(len(elems)):
+                    if reconstruct(model, mask[i], BOOL):
+                        real_val.append(reconstruct(model, elems[i], type.t))
+                if isinstance(type, TList):
+                    return tuple(real_val)
+                return evaluation.Bag(real_val)
+            elif isinstance(type, TMap):
+                default = reconstruct(model, value["default"], type.v)
+                res = evaluation.Map(type, default)
+                for (mask, k, v) in value["mapping"]:
+                    # K/V pairs appearing earlier in value["mapping"] have precedence
+                    if reconstruct(model, mask, BOOL):
+                        k = reconstruct(model, k, type.k)
+                        if k not in res.keys():
+                            v = reconstruct(model, v, type.v)
+                            res[k] = v
+                return res
+            elif isinstance(type, TEnum):
+                val = model.eval(value, model_completion=True).as_long()
+                return type.cases[val]
+            elif isinstance(type, THandle):
+                id, val = value
+                id = reconstruct(model, id, INT)
+                val = reconstruct(model, val, type.value_type)
+                return evaluation.Handle(id, val)
+            elif isinstance(type, TRecord):
+                res = defaultdict(lambda: None)
+                for (field, t) in type.fields:
+                    res[field] = reconstruct(model, value[field], t)
+                return FrozenDict(res)
+            elif isinstance(type, TTuple):
+                return tuple(reconstruct(model, v, t) for (v, t) in zip(value, type.ts))
             else:
-                res = { }
-                if model_extraction:
-                    def mkfunc(f, arg_types, out_type):
-                        @lru_cache(maxsize=None)
-                        def extracted_func(*args):
-                            return reconstruct(model, f(*[visitor.unreconstruct(v, t) for (v, t) in zip(args, arg_types)]), out_type)
-                        return extracted_func
-                    model = solver.model()
-                    # print(model)
-                    for name, t in self.funcs.items():
-                        f = _env[name]
-                        out_type = t.ret_type
-                        arg_types = t.arg_types
-                        res[name] = mkfunc(f, arg_types, out_type)
-                    for v in vars:
-                        res[v.id] = reconstruct(model, _env[v.id], v.type)
-                    if self.model_callback is not None:
-                        self.model_callback(res)
-                    if self.validate_model:
+                raise NotImplementedError(type)
+
+        a = self._convert(e)
+        solver.push()
+        solver.add(a)
+
+        # print(solver.assertions())
+        _tock(e, "encode")
+        if solver_worker.solver_workers.value > 0:
+            res = self._remote_check(model_extraction)
+        else:
+            res = self._check()
+        _tock(e, "solve")
+        if res == z3.unsat:
+            solver.pop()
+            return None
+        elif res == z3.unknown:
+            solver.pop()
+            raise SolverReportedUnknown("z3 reported unknown")
+        else:
+            res = { }
+            if model_extraction:
+                def mkfunc(f, arg_types, out_type):
+                    @lru_cache(maxsize=None)
+                    def extracted_func(*args):
+                        return reconstruct(model, f(*[visitor.unreconstruct(v, t) for (v, t) in zip(args, arg_types)]), out_type)
+                    return extracted_func
+                model = solver.model()
+                # print(model)
+                for name, t in self.funcs.items():
+                    f = _env[name]
+                    out_type = t.ret_type
+                    arg_types = t.arg_types
+                    res[name] = mkfunc(f, arg_types, out_type)
+                for v in vars:
+                    res[v.id] = reconstruct(model, _env[v.id], v.type)
+                if self.model_callback is not None:
+                    self.model_callback(res)
+                if self.validate_model:
+                    with phase("validation"):
                         x = evaluation.eval(e, res)
-                        if x is not True:
-                            print("bad example: {}".format(res))
-                            print(" ---> formula: {}".format(pprint(e)))
-                            print(" ---> got {}".format(repr(x)))
-                            print(" ---> model: {}".format(model))
-                            print(" ---> assertions: {}".format(solver.assertions()))
-                            print(" ---> to reproduce: satisfy({e}, vars={vars}, collection_depth={collection_depth}, validate_model={validate_model})".format(
-                                e=repr(e),
-                                vars=repr(vars),
-                                collection_depth=repr(self.collection_depth),
-                                validate_model=repr(self.validate_model)))
-                            if save_solver_testcases.value:
-                                with open(save_solver_testcases.value, "a") as f:
-                                    f.write("satisfy({e}, vars={vars}, collection_depth={collection_depth}, validate_model={validate_model})".format(
-                                        e=repr(e),
-                                        vars=repr(vars),
-                                        collection_depth=repr(self.collection_depth),
-                                        validate_model=repr(self.validate_model)))
-                                    f.write("\n")
-                            wq = [(e, _env, res)]
-                            while wq:
-                                # print("checking ?/{}...".format(len(wq)))
-                                x, solver_env, eval_env = wq.pop()
-                                for x in sorted(all_exps(x), key=lambda xx: xx.size()):
-                                    if all(v.id in eval_env for v in free_vars(x)) and not isinstance(x, ELambda):
-                                        solver_val = reconstruct(model, visitor.visit(x, solver_env), x.type)
-                                        v = fresh_name("tmp")
-                                        eval_env[v] = solver_val
-                                        eval_val = evaluation.eval(EEq(x, EVar(v).with_type(x.type)), eval_env)
-                                        if not eval_val:
-                                            print(" ---> disagreement on {}".format(pprint(x)))
-                                            print(" ---> Solver: {}".format(solver_val))
-                                            print(" ---> Eval'r: {}".format(evaluation.eval(x, eval_env)))
-                                            for v in free_vars(x):
-                                                print(" ---> s[{}] = {}".format(v.id, solver_env[v.id]))
-                                                print(" ---> e[{}] = {}".format(v.id, eval_env[v.id]))
-                                            for i, c in enumerate(x.children()):
-                                                if isinstance(c, Exp) and not isinstance(c, ELambda):
-                                                    print(" ---> solver arg[{}] = {}".format(i, reconstruct(model, visitor.visit(c, solver_env), c.type)))
-                                                    print(" ---> eval'r arg[{}] = {}".format(i, evaluation.eval(c, eval_env)))
-                                            if isinstance(x, EFilter):
-                                                smask, selems = visitor.visit(x.e, solver_env)
-                                                for (mask, elem) in zip(smask, selems):
-                                                    if reconstruct(model, mask, BOOL):
-                                                        # print("recursing on {}".format(elem))
-                                                        senv = dict(solver_env)
-                                                        eenv = dict(eval_env)
-                                                        senv[x.p.arg.id] = elem
-                                                        eenv[x.p.arg.id] = reconstruct(model, elem, x.type.t)
-                                                        wq.append((x.p.body, senv, eenv))
-                                            elif isinstance(x, ELet):
-                                                z = visitor.visit(x.e, solver_env)
-                                                senv = dict(solver_env)
-                                                eenv = dict(eval_env)
-                                                senv[x.f.arg.id] = z
-                                                eenv[x.f.arg.id] = reconstruct(model, z, x.e.type)
-                                                wq.append((x.f.body, senv, eenv))
-                                            break
-                            raise ModelValidationError("model validation failed")
-                    _tock(e, "extract model")
-                solver.pop()
-                return res
+                    if x is not True:
+                        print("bad example: {}".format(res))
+                        print(" ---> formula: {}".format(pprint(e)))
+                        print(" ---> got {}".format(repr(x)))
+                        print(" ---> model: {}".format(model))
+                        print(" ---> assertions: {}".format(solver.assertions()))
+                        print(" ---> to reproduce: satisfy({e}, vars={vars}, collection_depth={collection_depth}, validate_model={validate_model})".format(
+                            e=repr(e),
+                            vars=repr(vars),
+                            collection_depth=repr(self.collection_depth),
+                            validate_model=repr(self.validate_model)))
+                        if save_solver_testcases.value:
+                            with open(save_solver_testcases.value, "a") as f:
+                                f.write("satisfy({e}, vars={vars}, collection_depth={collection_depth}, validate_model={validate_model})".format(
+                                    e=repr(e),
+                                    vars=repr(vars),
+                                    collection_depth=repr(self.collection_depth),
+                                    validate_model=repr(self.validate_model)))
+                                f.write("\n")
+                        wq = [(e, _env, res)]
+                        while wq:
+                            # print("checking ?/{}...".format(len(wq)))
+                            x, solver_env, eval_env = wq.pop()
+                            for x in sorted(all_exps(x), key=lambda xx: xx.size()):
+                                if all(v.id in eval_env for v in free_vars(x)) and not isinstance(x, ELambda):
+                                    solver_val = reconstruct(model, visitor.visit(x, solver_env), x.type)
+                                    v = fresh_name("tmp")
+                                    eval_env[v] = solver_val
+                                    eval_val = evaluation.eval(EEq(x, EVar(v).with_type(x.type)), eval_env)
+                                    if not eval_val:
+                                        print(" ---> disagreement on {}".format(pprint(x)))
+                                        print(" ---> Solver: {}".format(solver_val))
+                                        print(" ---> Eval'r: {}".format(evaluation.eval(x, eval_env)))
+                                        for v in free_vars(x):
+                                            print(" ---> s[{}] = {}".format(v.id, solver_env[v.id]))
+                                            print(" ---> e[{}] = {}".format(v.id, eval_env[v.id]))
+                                        for i, c in enumerate(x.children()):
+                                            if isinstance(c, Exp) and not isinstance(c, ELambda):
+                                                print(" ---> solver arg[{}] = {}".format(i, reconstruct(model, visitor.visit(c, solver_env), c.type)))
+                                                print(" ---> eval'r arg[{}] = {}".format(i, evaluation.eval(c, eval_env)))
+                                        if isinstance(x, EFilter):
+                                            smask, selems = visitor.visit(x.e, solver_env)
+                                            for (mask, elem) in zip(smask, selems):
+                                                if reconstruct(model, mask, BOOL):
+                                                    # print("recursing on {}".format(elem))
+                                                    senv = dict(solver_env)
+                                                    eenv = dict(eval_env)
+                                                    senv[x.p.arg.id] = elem
+                                                    eenv[x.p.arg.id] = reconstruct(model, elem, x.type.t)
+                                                    wq.append((x.p.body, senv, eenv))
+                                        elif isinstance(x, ELet):
+                                            z = visitor.visit(x.e, solver_env)
+                                            senv = dict(solver_env)
+                                            eenv = dict(eval_env)
+                                            senv[x.f.arg.id] = z
+                                            eenv[x.f.arg.id] = reconstruct(model, z, x.e.type)
+                                            wq.append((x.f.body, senv, eenv))
+                                        break
+                        raise ModelValidationError("model validation failed")
+                _tock(e, "extract model")
+            solver.pop()
+            return res
 
     def satisfiable(self, e):
         return self.satisfy(e, model_extraction=False) is not None
 
+    def _remote_check(self, model_extraction):
+        """
+        Check the current assertions in a solver worker. If a model is
+        wanted, the worker's assignment to every constant is asserted here
+        and checked again, which leaves Z3 nothing to search for (besides the
+        interpretations of uninterpreted functions) and gives us a model to
+        reconstruct values from.
+        """
+        solver = self.z3_solver
+        try:
+            res, model = _solver_workers().check(
+                solver.sexpr(),
+                logic=self.logic,
+                timeout=self.timeout,
+                model=model_extraction,
+                stop_callback=self.stop_callback)
+        except WorkerInterrupted as exc:
+            raise SolverInterrupted() from exc
+        if res == "unsat":
+            return z3.unsat
+        if res != "sat":
+            return z3.unknown
+        if model_extraction:
+            ctx = self.visitor.ctx
+            for name, val in model.items():
+                if isinstance(val, bool):
+                    solver.add(z3.Bool(name, ctx) == z3.BoolVal(val, ctx))
+                elif isinstance(val, int):
+                    solver.add(z3.Int(name, ctx) == z3.IntVal(val, ctx))
+                else:
+                    solver.add(z3.Real(name, ctx) == z3.RealVal(val, ctx))
+            return self._check(timeout=self.timeout if self.timeout is not None else _MODEL_CHECK_TIMEOUT)
+        return z3.sat
+
+    def _check(self, timeout=None):
+        """
+        Check the current assertions in this process. If there is a stop
+        callback, a watcher thread interrupts Z3 (Context.interrupt is safe
+        to call from other threads) once the callback returns true, and
+        SolverInterrupted is raised. The given timeout (in seconds) overrides
+        the solver's for this check only.
+        """
+        solver = self.z3_solver
+        stop_callback = self.stop_callback
+        if stop_callback is not None and stop_callback():
+            raise SolverInterrupted()
+        if timeout is not None:
+            solver.set("timeout", int(timeout * 1000))
+        done = threading.Event()
+        if stop_callback is not None:
+            ctx = self.visitor.ctx
+            def watch():
+                while not done.wait(_STOP_POLL_INTERVAL):
+                    if stop_callback():
+                        ctx.interrupt()
+                        return
+            threading.Thread(target=watch, daemon=True).start()
+        try:
+            res = solver.check()
+        finally:
+            done.set()
+            if timeout is not None:
+                solver.set("timeout", int(self.timeout * 1000) if self.timeout is not None else _NO_TIMEOUT)
+        if res == z3.unknown and stop_callback is not None and stop_callback():
+            raise SolverInterrupted()
+        return res
+
     def valid(self, e):
         return not self.satisfiable(ENot(e))
 
+def _cache_key(cache, e, opts):
+    collection_depth = opts.get("collection_depth")
+    if collection_depth is None:
+        collection_depth = collection_depth_opt.value
+    return cache.key(e, collection_depth, opts.get("logic"), opts.get("timeout"))
+
 def satisfy(e, **opts):
+    opts = _with_default_stop_callback(opts)
+    cache = solver_cache.current_cache()
+    if cache is not None:
+        key = _cache_key(cache, e, opts)
+        if cache.get(key) is False:
+            return None
     s = IncrementalSolver(**opts)
-    return s.satisfy(e)
+    res = s.satisfy(e)
+    if cache is not None:
+        cache.put(key, res is not None)
+    return res
+
+# Maximum number of variable encodings a pooled solver keeps before it is
+# replaced.
+_MAX_POOLED_ENCODINGS = 2000
+
+class _PooledSolver(IncrementalSolver):
+    """
+    A long-lived Z3 context for top-level `satisfiable` queries. The
+    encodings of free variables are created once and reused by later queries
+    that mention a variable of the same name and type. Each query gets a
+    fresh Z3 solver in that context, holding only the query and the domain
+    constraints of its variables: Z3's search state carries over between
+    checks on the same solver, which makes later queries slower and can turn
+    their verdicts into "unknown".
+    """
+
+    def __init__(self, **opts):
+        super().__init__(**opts)
+        self.uses = 0
+        self.encodings = { } # maps (name, type) to (encoding, [domain constraints])
+
+    def _create_vars(self, vars, funcs):
+        for f, t in funcs.items():
+            if f not in self._env:
+                self._env[f] = self._encoding(f, t)
+                self.funcs[f] = t
+        for v in vars:
+            if v.id not in self._env:
+                self._env[v.id] = self._encoding(v.id, v.type)
+                self.vars.add(v)
+
+    def _encoding(self, name, type):
+        key = (name, type)
+        res = self.encodings.get(key)
+        if res is None:
+            constraints = []
+            res = (self.visitor.mkvar(self.collection_depth, type, on_z3_assertion=constraints.append), constraints)
+            self.encodings[key] = res
+        encoding, constraints = res
+        for c in constraints:
+            self.z3_solver.add(c)
+        return encoding
+
+    def worn_out(self):
+        return self.uses >= solver_pool_reuse.value or len(self.encodings) > _MAX_POOLED_ENCODINGS
+
+    def query(self, e, stop_callback):
+        self.uses += 1
+        self.stop_callback = stop_callback
+        self.vars = OrderedSet()
+        self.funcs = OrderedDict()
+        self._env = OrderedDict()
+        self.z3_solver = self._new_z3_solver(self.visitor.ctx)
+        self.visitor.solver = self.z3_solver
+        # compiled lambdas belong to the previous query
+        self.visitor._lambdacache = { }
+        return self.satisfiable(e)
+
+# Each thread has its own pool, mapping
+# (logic, timeout, collection_depth, validate_model) -> _PooledSolver
+_POOLS = threading.local()
+_POOLABLE_OPTS = frozenset(("logic", "timeout", "collection_depth", "validate_model", "stop_callback"))
+
+def _pooled_satisfiable(e, opts):
+    """
+    Answer a satisfiability query using a long-lived context (see
+    _PooledSolver). A context whose query fails is dropped; if Z3 itself
+    failed (e.g. ran out of memory), the query is retried in a fresh one.
+    """
+    pid = os.getpid()
+    if getattr(_POOLS, "pid", None) != pid:
+        # Z3 contexts inherited from a parent process are not ours to use.
+        _POOLS.pool = { }
+        _POOLS.pid = pid
+    pool = _POOLS.pool
+    collection_depth = opts.get("collection_depth")
+    if collection_depth is None:
+        collection_depth = collection_depth_opt.value
+    key = (opts.get("logic"), opts.get("timeout"), collection_depth, opts.get("validate_model", True))
+    solver_opts = { k : v for (k, v) in opts.items() if k != "stop_callback" }
+    solver = pool.pop(key, None)
+    if solver is None or solver.worn_out():
+        solver = _PooledSolver(**solver_opts)
+    try:
+        res = solver.query(e, opts.get("stop_callback"))
+    except z3.Z3Exception:
+        solver = _PooledSolver(**solver_opts)
+        res = solver.query(e, opts.get("stop_callback"))
+    pool[key] = solver
+    return res
+
+_WORKERS = None
+_WORKERS_PID = None
+def _solver_workers():
+    global _WORKERS, _WORKERS_PID
+    pid = os.getpid()
+    if _WORKERS is None or _WORKERS_PID != pid:
+        # Workers belonging to a parent process are not ours to use.
+        _WORKERS = solver_worker.SolverWorkerPool(solver_worker.solver_workers.value)
+        _WORKERS_PID = pid
+    return _WORKERS
 
 def satisfiable(e, **opts):
-    s = IncrementalSolver(**opts)
-    return s.satisfiable(e)
+    opts = _with_default_stop_callback(opts)
+    cache = solver_cache.current_cache()
+    if cache is not None:
+        key = _cache_key(cache, e, opts)
+        res = cache.get(key)
+        if res is not None:
+            return res
+    if solver_pool_reuse.value > 0 and _POOLABLE_OPTS.issuperset(opts.keys()):
+        res = _pooled_satisfiable(e, opts)
+    else:
+        s = IncrementalSolver(**opts)
+        res = s.satisfiable(e)
+    if cache is not None:
+        cache.put(key, res)
+    return res
 
 def valid(e, **opts):
-    s = IncrementalSolver(**opts)
-    return s.valid(e)
+    return not satisfiable(ENot(e), **opts)
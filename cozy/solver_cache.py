@@ -0,0 +1,233 @@
+"""
+Persistent, content-addressed cache of solver results.
+
+Many formulas are re-proved from scratch every time Cozy runs on the same
+specification (well-formedness checks, simplifier validation, equivalence
+checks during incrementalization, ...). When the "--solver-cache" option is
+set, the satisfiability of each formula checked by the top-level `satisfy`,
+`satisfiable`, and `valid` functions in cozy.solver is recorded on disk so
+that later runs can skip the call to Z3 entirely.
+
+Formulas are keyed on a canonical serialization in which every variable has
+been renamed by order of first occurrence. Consistently renaming variables
+does not change whether a formula is satisfiable, and it means that formulas
+mentioning fresh variables (whose names differ from run to run) still hit in
+the cache.
+
+The cache is stored in an SQLite database so that it can be shared safely by
+the many processes that Cozy spawns during synthesis.
+"""
+
+import atexit
+import hashlib
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+from cozy.common import ADT
+from cozy.syntax import Exp, EVar, CPull
+from cozy.opts import Option
+
+solver_cache_path = Option("solver-cache", str, "", metavar="PATH",
+    description="File in which to persist solver results between runs (disabled if empty)")
+solver_cache_size = Option("solver-cache-size", int, 100000, metavar="N",
+    description="Maximum number of entries in the persistent solver cache")
+
+# How many insertions happen between checks of the cache size.
+_EVICTION_INTERVAL = 256
+
+# How many cache hits are collected before their last-used times are written.
+# Writing on every hit would turn reads into writes that serialize on the
+# database lock.
+_TOUCH_INTERVAL = 256
+
+def canonical_text(e : Exp, fixed=()) -> str:
+    """
+    Serialize an expression such that two expressions get the same text iff
+    they are identical up to a consistent renaming of their variables. Types
+    are included in the output. Variables whose names are in `fixed` are not
+    renamed.
+    """
+    names = { }
+    out = []
+
+    def rename(name):
+        n = names.get(name)
+        if n is None:
+            n = "!" + name if name in fixed else "v{}".format(len(names))
+            names[name] = n
+        return n
+
+    def visit(x):
+        if isinstance(x, EVar):
+            out.append("EVar(")
+            out.append(rename(x.id))
+            out.append(")")
+        elif isinstance(x, CPull):
+            out.append("CPull(")
+            out.append(rename(x.id))
+            out.append(",")
+            visit(x.e)
+            out.append(")")
+        elif isinstance(x, ADT):
+            out.append(type(x).__name__)
+            out.append("(")
+            for child in x.children():
+                visit(child)
+                out.append(",")
+            out.append(")")
+        elif isinstance(x, tuple) or isinstance(x, list):
+            out.append("[")
+            for child in x:
+                visit(child)
+                out.append(",")
+            out.append("]")
+        else:
+            out.append(repr(x))
+        if isinstance(x, Exp) and hasattr(x, "type"):
+            out.append(":")
+            visit(x.type)
+
+    visit(e)
+    return "".join(out)
+
+class SolverCache(object):
+    """
+    Size-bounded, least-recently-used map from formulas to their
+    satisfiability.
+    """
+
+    def __init__(self, path : str, max_entries : int):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.insertions = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._touched = { } # maps keys of recent hits to the time they were used
+        self._warned = False
+
+    def _connection(self):
+        # SQLite connections must not be shared across a fork(), and Cozy
+        # forks a new process for every synthesis job. They must not be
+        # shared between threads either.
+        local = self._local
+        pid = os.getpid()
+        if getattr(local, "pid", None) != pid:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, sat INTEGER NOT NULL, last_used REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS results_by_age ON results (last_used)")
+            local.conn = conn
+            local.pid = pid
+        return local.conn
+
+    def key(self, e : Exp, collection_depth : int, logic : str, timeout : float) -> str:
+        import z3
+        h = hashlib.sha256()
+        h.update(canonical_text(e).encode("utf-8"))
+        h.update("|depth={}|logic={}|timeout={}|z3={}".format(
+            collection_depth, logic, timeout, z3.get_version_string()).encode("utf-8"))
+        return h.hexdigest()
+
+    def get(self, key : str):
+        """
+        Returns True or False if the satisfiability of the formula with the
+        given key is known, or None otherwise.
+        """
+        try:
+            row = self._connection().execute("SELECT sat FROM results WHERE key = ?", (key,)).fetchone()
+        except sqlite3.Error as exc:
+            self._unavailable(exc)
+            row = None
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._touch(key)
+        return bool(row[0])
+
+    def put(self, key : str, sat : bool):
+        try:
+            conn = self._connection()
+            conn.execute("INSERT OR REPLACE INTO results (key, sat, last_used) VALUES (?, ?, ?)", (key, int(sat), time.time()))
+            self.insertions += 1
+            if self.insertions % _EVICTION_INTERVAL == 0:
+                self.evict()
+        except sqlite3.Error as exc:
+            self._unavailable(exc)
+
+    def _touch(self, key):
+        with self._lock:
+            self._touched[key] = time.time()
+            if len(self._touched) < _TOUCH_INTERVAL:
+                return
+        self.flush()
+
+    def flush(self):
+        """Write the last-used times of recent hits in a single transaction."""
+        with self._lock:
+            touched = self._touched
+            self._touched = { }
+        if not touched:
+            return
+        try:
+            conn = self._connection()
+            conn.execute("BEGIN")
+            try:
+                conn.executemany("UPDATE results SET last_used = ? WHERE key = ?", ((t, k) for (k, t) in touched.items()))
+                conn.execute("COMMIT")
+            except sqlite3.Error:
+                conn.execute("ROLLBACK")
+                raise
+        except sqlite3.Error as exc:
+            self._unavailable(exc)
+
+    def _unavailable(self, exc):
+        if not self._warned:
+            self._warned = True
+            print("WARNING: solver cache unavailable: {}".format(exc), file=sys.stderr)
+
+    def evict(self):
+        """Drop the least-recently-used entries until the cache fits."""
+        self.flush()
+        conn = self._connection()
+        conn.execute("DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY last_used DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+
+    def close(self):
+        """Write pending last-used times and close this thread's connection."""
+        self.flush()
+        local = self._local
+        if getattr(local, "pid", None) == os.getpid():
+            local.conn.close()
+            local.pid = None
+
+    def __len__(self):
+        return self._connection().execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    def stats(self):
+        return { "hits": self.hits, "misses": self.misses }
+
+_CACHE = None
+def current_cache():
+    """
+    Returns the SolverCache selected by the command-line options, or None if
+    persistent caching is disabled.
+    """
+    global _CACHE
+    path = solver_cache_path.value
+    if not path:
+        return None
+    if _CACHE is None or _CACHE.path != path:
+        if _CACHE is not None:
+            _CACHE.close()
+        _CACHE = SolverCache(path, solver_cache_size.value)
+    _CACHE.max_entries = solver_cache_size.value
+    return _CACHE
+
+@atexit.register
+def _close_cache():
+    if _CACHE is not None:
+        _CACHE.close()
@@ -0,0 +1,98 @@
+"""
+Out-of-process satisfiability checks.
+
+Z3Py calls cannot be interrupted, and a crash inside Z3 takes the whole
+Python process down with it. When the "--solver-workers" option is positive,
+cozy.solver encodes each query in-process (exactly as it would for a local
+check) and ships the resulting SMT-LIB2 text to one of a pool of long-lived
+worker subprocesses. If the caller wants a model, the worker sends back the
+value of every constant. The parent enforces wall-clock deadlines and honors
+stop requests by killing the worker that is handling the query.
+
+Running this module as a script starts a worker.
+"""
+
+import time
+
+from cozy.opts import Option
+from cozy.jobs import SubprocessWorker, WorkerDied, serve
+from cozy.timeouts import TimeoutException
+
+solver_workers = Option("solver-workers", int, 0, metavar="N",
+    description="Number of Z3 subprocesses to use for satisfiability checks (0 to run Z3 in-process)")
+
+# Extra time a worker gets to respond past the query's own timeout before it
+# is killed.
+_GRACE_PERIOD = 1.0
+
+def check(request):
+    """Handle a request in the worker process."""
+    import z3
+    smt2, logic, timeout, want_model = request
+    solver = z3.Solver() if logic is None else z3.SolverFor(logic)
+    if timeout is not None:
+        solver.set("timeout", int(timeout * 1000))
+    solver.from_string(smt2)
+    res = solver.check()
+    model = None
+    if want_model and res == z3.sat:
+        m = solver.model()
+        model = { }
+        for d in m.decls():
+            if d.arity() != 0:
+                continue
+            val = m[d]
+            if z3.is_true(val) or z3.is_false(val):
+                model[d.name()] = z3.is_true(val)
+            elif z3.is_int_value(val):
+                model[d.name()] = val.as_long()
+            elif z3.is_rational_value(val):
+                model[d.name()] = str(val.as_fraction())
+    return (str(res), model)
+
+class SolverWorkerPool(object):
+    def __init__(self, size : int):
+        self.size = size
+        self.idle = []
+
+    def check(self, smt2 : str, logic : str = None, timeout : float = None, model : bool = False, stop_callback = None):
+        """
+        Check the satisfiability of the given SMT-LIB2 assertions. Returns a
+        pair (verdict, values) where the verdict is "sat", "unsat", or
+        "unknown". Deadline expiry and crashed workers both produce
+        "unknown". If `model` is true and the verdict is "sat", `values` maps
+        the name of each constant in the model to its value (a bool, an int,
+        or a fraction as a string); otherwise it is None. Raises
+        jobs.WorkerInterrupted if `stop_callback()` becomes true before an
+        answer arrives.
+        """
+        try:
+            worker = self.idle.pop()
+        except IndexError:
+            worker = SubprocessWorker("cozy.solver_worker")
+        deadline = time.time() + timeout + _GRACE_PERIOD if timeout is not None else None
+        try:
+            worker.send((smt2, logic, timeout, model))
+            res = worker.recv(deadline=deadline, stop_callback=stop_callback)
+        except TimeoutException:
+            worker.kill()
+            return ("unknown", None)
+        except WorkerDied:
+            worker.kill()
+            print("Warning: Z3 worker died (exit code {})".format(worker.proc.returncode))
+            return ("unknown", None)
+        except BaseException:
+            worker.kill()
+            raise
+        if len(self.idle) < self.size:
+            self.idle.append(worker)
+        else:
+            worker.kill()
+        return res
+
+    def close(self):
+        while self.idle:
+            self.idle.pop().kill()
+
+if __name__ == "__main__":
+    serve(check)
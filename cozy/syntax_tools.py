@@ -9,6 +9,7 @@ import collections
 from contextlib import contextmanager
 import sys
 import itertools
+import weakref
 
 from cozy import common
 from cozy import syntax
@@ -788,15 +789,19 @@ def subst_lval(lval, replacements):
 def tease_apart(exp : syntax.Exp) -> ([(syntax.EVar, syntax.Exp)], syntax.Exp):
     new_state = []
 
+    new_state_by_key = { }
+
     class V(BottomUpRewriter):
         def visit_EStateVar(self, e):
             e = e.e
-            x = common.find_one(x for x in new_state if alpha_equivalent(x[1], e))
-            if x is not None:
-                return x[0]
+            k = alpha_key(e)
+            v = new_state_by_key.get(k)
+            if v is not None:
+                return v
             else:
                 v = fresh_var(e.type)
                 new_state.append((v, e))
+                new_state_by_key[k] = v
                 return v
 
     new_exp = V().visit(exp)
@@ -961,6 +966,67 @@ def qsubst(
         e = e.with_type(haystack.type)
     return e
 
+_EVAR_HASH = hash(syntax.EVar)
+def alpha_hash(x) -> int:
+    """
+    A hash code that ignores variable names, so that alpha_equivalent(e1, e2)
+    implies alpha_hash(e1) == alpha_hash(e2). The result is cached on each
+    node.
+    """
+    if isinstance(x, syntax.EVar):
+        return _EVAR_HASH
+    if isinstance(x, common.ADT):
+        h = x.__dict__.get("_alpha_hash")
+        if h is None:
+            if isinstance(x, syntax.CPull):
+                h = hash((syntax.CPull, alpha_hash(x.e)))
+            else:
+                h = hash((type(x),) + tuple(alpha_hash(c) for c in x.children()))
+            x._alpha_hash = h
+        return h
+    if isinstance(x, tuple) or isinstance(x, list):
+        return hash(tuple(alpha_hash(c) for c in x))
+    try:
+        return hash(x)
+    except TypeError:
+        return 0
+
+def _alpha_key(x, env, depth):
+    if isinstance(x, syntax.EVar):
+        level = env.get(x.id)
+        return (syntax.EVar, x.id if level is None else level)
+    if isinstance(x, target_syntax.ELambda):
+        with common.extend(env, x.arg.id, depth):
+            return (target_syntax.ELambda, _alpha_key(x.body, env, depth + 1))
+    if isinstance(x, syntax.EListComprehension):
+        env = dict(env)
+        clauses = []
+        for c in x.clauses:
+            clauses.append((type(c), _alpha_key(c.e, env, depth)))
+            if isinstance(c, syntax.CPull):
+                env[c.id] = depth
+                depth += 1
+        return (syntax.EListComprehension, tuple(clauses), _alpha_key(x.e, env, depth))
+    if isinstance(x, common.ADT):
+        return (type(x),) + tuple(_alpha_key(c, env, depth) for c in x.children())
+    if isinstance(x, tuple) or isinstance(x, list):
+        return tuple(_alpha_key(c, env, depth) for c in x)
+    return x
+
+def alpha_key(e : syntax.Exp):
+    """
+    A hashable, nameless representation of `e` in which bound variables are
+    replaced by their binding depth (de Bruijn levels) and free variables
+    keep their names. As with alpha_equivalent, types are ignored.
+        alpha_key(e1) == alpha_key(e2) iff e1 and e2 are alpha-equivalent
+    The key is computed once and cached on `e`.
+    """
+    k = e.__dict__.get("_alpha_key")
+    if k is None:
+        k = _alpha_key(e, { }, 0)
+        e._alpha_key = k
+    return k
+
 @common.typechecked
 def alpha_equivalent(e1 : syntax.Exp, e2 : syntax.Exp) -> bool:
     """
@@ -970,6 +1036,11 @@ def alpha_equivalent(e1 : syntax.Exp, e2 : syntax.Exp) -> bool:
     However, alpha equivalence allows renaming of variables, so
         alpha_equivalent([x | x <- L], [y | y <- L]) == True.
     """
+    if e1 is e2:
+        return True
+    if isinstance(e1, syntax.Exp) and isinstance(e2, syntax.Exp) and alpha_hash(e1) != alpha_hash(e2):
+        return False
+
     class V(common.Visitor):
         def __init__(self):
             self.depth = 0
@@ -1013,10 +1084,12 @@ def alpha_equivalent(e1 : syntax.Exp, e2 : syntax.Exp) -> bool:
             if isinstance(c1, syntax.CPull):
                 if not isinstance(c2, syntax.CPull):
                     return False
-                with self.unify([(c1, c2)]):
+                if not self.visit(c1.e, c2.e):
+                    return False
+                with self.unify([(syntax.EVar(c1.id), syntax.EVar(c2.id))]):
                     return self.visit_clauses(i + 1, clauses1, clauses2, e1, e2)
             elif isinstance(c1, syntax.CCond):
-                return self.visit(c1.e, c2.e) and self.visit_clauses(i + 1, clauses1, clauses2, e1, e2)
+                return isinstance(c2, syntax.CCond) and self.visit(c1.e, c2.e) and self.visit_clauses(i + 1, clauses1, clauses2, e1, e2)
             else:
                 raise NotImplementedError(pprint(c1))
         def visit_str(self, s1, s2):
@@ -1109,29 +1182,74 @@ class Aeq(object):
     def __init__(self, e : syntax.Exp):
         self.e = e
     def __hash__(self):
-        res = 0
-        q = [self.e]
-        while q:
-            x = q[-1]
-            del q[-1]
-            if isinstance(x, syntax.EVar):
-                continue
-            elif isinstance(x, common.ADT):
-                res *= 31
-                res += hash(type(x))
-                res %= 2**64
-                q.extend(x.children())
-            elif isinstance(x, tuple) or isinstance(x, list):
-                q.extend(x)
-            else:
-                res += hash(x)
-                # raise NotImplementedError(repr(x))
-        return res % (2**64)
+        return alpha_hash(self.e)
     def __eq__(self, other):
         return isinstance(other, Aeq) and alpha_equivalent(self.e, other.e)
     def __ne__(self, other):
         return not (self == other)
 
+# Maps (class, type, annotations, children) to the unique live node with
+# that description. Children are identified by their ids, which is safe
+# because each node keeps its children alive. Interned nodes are shared, so
+# they must not be annotated after they have been interned.
+_INTERNED = weakref.WeakValueDictionary()
+_NODE = object()
+# Attributes that do not distinguish one node from another.
+_UNDISTINGUISHING_ATTRS = frozenset(("type", "_hash", "_alpha_hash", "_alpha_key", "_fvs"))
+
+def _intern_key(x):
+    if isinstance(x, common.ADT):
+        return (_NODE, id(x))
+    if isinstance(x, tuple):
+        return tuple(_intern_key(y) for y in x)
+    return x
+
+def _hash_cons(x):
+    if isinstance(x, tuple):
+        return tuple(_hash_cons(y) for y in x)
+    if not isinstance(x, common.ADT):
+        return x
+    children = x.children()
+    new_children = tuple(_hash_cons(c) for c in children)
+    if any(a is not b for (a, b) in zip(children, new_children)):
+        y = type(x).__new__(type(x))
+        y.__dict__.update((k, v) for (k, v) in x.__dict__.items() if k not in common._TRANSIENT_ATTRS)
+        y.__init__(*new_children)
+        x = y
+    d = x.__dict__
+    # Some classes (e.g. ELambda) keep their children in __dict__; those
+    # are already part of the key.
+    child_ids = set(id(c) for c in new_children if isinstance(c, common.ADT))
+    try:
+        key = (
+            type(x),
+            d.get("type"),
+            tuple(sorted((a, v) for (a, v) in d.items() if a not in _UNDISTINGUISHING_ATTRS and id(v) not in child_ids)),
+            _intern_key(new_children))
+        res = _INTERNED.get(key)
+    except TypeError:
+        # some part of the node is unhashable
+        return x
+    if res is None:
+        _INTERNED[key] = x
+        res = x
+    if "_hash" not in res.__dict__:
+        try:
+            hash(res)
+        except TypeError:
+            pass
+    return res
+
+def hash_cons(e):
+    """
+    Returns an expression equal to `e` (including types and annotations such
+    as `_accel`) in which every subtree is shared with all identical subtrees
+    of other live hash-consed expressions. Equality tests between hash-consed
+    expressions usually succeed on the identity check or fail on the cached
+    hash codes, rather than walking both trees.
+    """
+    return _hash_cons(e)
+
 class ExpMap(object):
     def __init__(self, items=(), ordered=True):
         self.by_id = collections.OrderedDict()
@@ -1,2 +1,2 @@
 from .impls import Implementation, construct_initial_implementation
-from .high_level_interface import improve_implementation
+from .high_level_interface import improve_implementation, JobMetrics
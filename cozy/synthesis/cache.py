@@ -1,8 +1,10 @@
-from collections import OrderedDict
+from array import array
+from collections import OrderedDict, Counter
+import hashlib
 
-from cozy.common import nested_dict, find_one, typechecked
+from cozy.common import nested_dict, typechecked, OrderedSet
 from cozy.target_syntax import Type, Exp, EVar
-from cozy.syntax_tools import alpha_equivalent
+from cozy.syntax_tools import alpha_key, alpha_equivalent, all_exps
 from cozy.typecheck import COLLECTION_TYPES
 from cozy.pools import ALL_POOLS
 from cozy.cost_model import Cost
@@ -39,9 +41,17 @@ class NatDict(object):
 
 class Cache(object):
     def __init__(self, binders : [EVar], args : [EVar], items : [(Exp, int)]=None):
-        # self.data[pool][type_tag][type][size] is list of exprs
-        self.data = [nested_dict(2, lambda: NatDict(list)) for i in range(len(ALL_POOLS))]
+        # self.data[pool][type_tag][type][size] is an OrderedSet of exprs
+        self.data = [nested_dict(2, lambda: NatDict(OrderedSet)) for i in range(len(ALL_POOLS))]
         self.size = 0
+        # self.keys[(pool, type, alpha_key(e))] is how many exprs e in the
+        # cache are alpha-equivalent to one another
+        self.keys = Counter()
+        # self.containing[(pool, x)] is an OrderedSet of the (e, type, size)
+        # entries in the cache such that x is a subexpression of e
+        self.containing = { }
+        self.nodes = 0 # sum of the sizes of all entries
+        self.index_entries = 0 # total size of the sets in self.containing
         self.binders = set(binders)
         self.args = set(args)
         if items:
@@ -52,17 +62,48 @@ class Cache(object):
     def is_tag(self, t):
         return isinstance(t, type)
     def contains(self, e, pool):
-        return find_one(self.find(pool=pool, type=e.type), lambda x: alpha_equivalent(x, e)) is not None
+        return self.keys[(pool, e.type, alpha_key(e))] > 0
     def add(self, e, size, pool):
-        self.data[pool][self.tag(e.type)][e.type][size].append(e)
+        bucket = self.data[pool][self.tag(e.type)][e.type][size]
+        if e in bucket:
+            return
+        bucket.add(e)
+        self.keys[(pool, e.type, alpha_key(e))] += 1
+        entry = (e, e.type, size)
+        subexps = set(all_exps(e))
+        for x in subexps:
+            s = self.containing.get((pool, x))
+            if s is None:
+                s = OrderedSet()
+                self.containing[(pool, x)] = s
+            s.add(entry)
+        self.index_entries += len(subexps)
         self.size += 1
+        self.nodes += size
     def evict(self, e, size, pool):
-        try:
-            self.data[pool][self.tag(e.type)][e.type][size].remove(e)
-            self.size -= 1
-        except ValueError:
-            # this happens if e is not in the list, which is fine
-            pass
+        bucket = self.data[pool].get(self.tag(e.type), {}).get(e.type, {}).get(size)
+        if bucket is None or e not in bucket:
+            # e is not in the cache, which is fine
+            return
+        bucket.discard(e)
+        self.size -= 1
+        self.nodes -= size
+        k = (pool, e.type, alpha_key(e))
+        self.keys[k] -= 1
+        if self.keys[k] <= 0:
+            del self.keys[k]
+        entry = (e, e.type, size)
+        subexps = set(all_exps(e))
+        for x in subexps:
+            s = self.containing.get((pool, x))
+            if s is not None:
+                s.discard(entry)
+                if not s:
+                    del self.containing[(pool, x)]
+        self.index_entries -= len(subexps)
+    def find_containing(self, x, pool):
+        """returns a list of the (e, size) entries in `pool` that have `x` as a subexpression"""
+        return [(e, size) for (e, t, size) in self.containing.get((pool, x), ())]
     def _raw_find(self, pool, type=None, size=None):
         type_tag = None
         if type is not None:
@@ -81,6 +122,9 @@ class Cache(object):
             yield from self.find(pool=pool, type=t, size=size)
     def find(self, pool, type=None, size=None):
         return list(self._raw_find(pool, type, size))
+    def find_types(self, pool, size):
+        """returns the types of the expressions in `pool` with the given size"""
+        return [t for x in self.data[pool].values() for (t, y) in x.items() if y.get(size)]
     def types(self):
         for p in ALL_POOLS:
             for y in self.data[p].values():
@@ -102,6 +146,10 @@ class Cache(object):
 class SeenSet(object):
     def __init__(self):
         self.data = OrderedDict() # maps (pool, fingerprint) to list of (e, size, cost)
+        self.evaluations = { } # maps id(e) to (e, (values, free binders))
+        self.keys = Counter() # maps (pool, type, alpha_key(e)) to number of entries
+        self.size = 0
+        self.nodes = 0 # sum of the sizes, fingerprint lengths, and evaluation lengths of all entries
     def _find(self, pool, fingerprint, create=False):
         key = (pool, fingerprint)
         l = self.data.get(key)
@@ -113,10 +161,28 @@ class SeenSet(object):
                 return ()
         return l
     @typechecked
-    def add(self, e : Exp, pool : int, fingerprint : tuple, size : int, cost : Cost):
+    def add(self, e : Exp, pool : int, fingerprint : tuple, size : int, cost : Cost, evaluation : tuple = None):
         l = self._find(pool, fingerprint, create=True)
         assert all(v[0] != e for v in l)
         l.append((e, size, cost))
+        self.keys[(pool, e.type, alpha_key(e))] += 1
+        self.size += 1
+        self.nodes += size + len(fingerprint)
+        if evaluation is not None:
+            self.evaluations[id(e)] = (e, evaluation)
+            self.nodes += len(evaluation[0])
+    def evaluation_of(self, e):
+        """returns the `evaluation` given when `e` was added, or None"""
+        x = self.evaluations.get(id(e))
+        if x is not None and x[0] is e:
+            return x[1]
+        return None
+    def contains(self, e, pool, fingerprint):
+        """true if `e` itself is an entry in `pool` with the given fingerprint"""
+        return any(x[0] is e for x in self._find(pool, fingerprint))
+    def contains_alpha_equivalent(self, e, pool, fingerprint):
+        """true if some entry in `pool` is alpha-equivalent to `e` and has the same type"""
+        return self.keys[(pool, e.type, alpha_key(e))] > 0
     def find_all(self, pool, fingerprint):
         """yields (e, size, cost) tuples"""
         yield from self._find(pool, fingerprint)
@@ -130,11 +196,188 @@ class SeenSet(object):
         for (pool, fp), l in self.data.items():
             for (e, size, cost) in l:
                 yield (e, pool, fp, size, cost)
+    def entries(self):
+        """yields (e, pool, fingerprint, size) tuples"""
+        for (pool, fp), l in self.data.items():
+            for (e, size, cost) in l:
+                yield (e, pool, fp, size)
+    def crowded(self):
+        """
+        yields (e, pool, fingerprint, size) tuples for every entry except the
+        smallest one in each fingerprint class with more than one entry
+        """
+        for (pool, fp), l in self.data.items():
+            if len(l) > 1:
+                keep = min(l, key=lambda x: x[1])
+                for (e, size, cost) in l:
+                    if e is not keep[0]:
+                        yield (e, pool, fp, size)
+    def digest(self, fingerprint):
+        """the form in which `fingerprint` is returned from items()"""
+        return fingerprint
     def remove(self, e, pool, fingerprint):
         l = self._find(pool, fingerprint)
         for i in range(len(l)):
             if l[i][0] is e:
+                size = l[i][1]
                 del l[i]
+                if not l:
+                    del self.data[(pool, fingerprint)]
+                self.size -= 1
+                self.nodes -= size + len(fingerprint)
+                x = self.evaluations.get(id(e))
+                if x is not None and x[0] is e:
+                    del self.evaluations[id(e)]
+                    self.nodes -= len(x[1][0])
+                k = (pool, e.type, alpha_key(e))
+                self.keys[k] -= 1
+                if self.keys[k] <= 0:
+                    del self.keys[k]
                 return
+    def __len__(self):
+        return self.size
     def clear(self):
         self.data.clear()
+        self.evaluations.clear()
+        self.keys.clear()
+        self.size = 0
+        self.nodes = 0
+
+def fingerprint_digest(fingerprint : tuple) -> int:
+    """
+    64-bit digest of a fingerprint. Equal digests mean (with overwhelming
+    probability) equal fingerprints. Since the digest is computed from the
+    repr of the values, equal values printed differently get different
+    digests; that only costs a missed comparison.
+    """
+    h = hashlib.blake2b(repr(fingerprint).encode("utf-8"), digest_size=8)
+    return int.from_bytes(h.digest(), "little")
+
+class CompactSeenSet(object):
+    """
+    Drop-in replacement for SeenSet that uses far less memory per entry.
+
+    Fingerprints are replaced by 64-bit digests (see fingerprint_digest) and
+    entries are kept in parallel arrays, chained together by fingerprint
+    class. Evaluations are not stored. The expressions and costs themselves
+    are shared with the Cache and the caller, so storing a reference to
+    each one costs a single pointer.
+
+    Wherever SeenSet yields a fingerprint, this class yields its digest
+    instead. Any method that takes a fingerprint also accepts a digest.
+    """
+
+    _NIL = -1
+
+    def __init__(self):
+        self.exps = []           # slot -> e, or None if the slot is free
+        self.costs = []          # slot -> cost, or None if the slot is free
+        self.digests = array("Q") # slot -> fingerprint digest
+        self.pools = array("B")   # slot -> pool
+        self.sizes = array("I")   # slot -> size
+        self.next = array("l")    # slot -> next slot in the same class
+        self.heads = { }         # class key -> first slot in the class
+        self.free = array("l")    # unused slots
+        self.nodes = 0 # sum of the sizes of all entries
+    def digest(self, fingerprint):
+        return fingerprint if isinstance(fingerprint, int) else fingerprint_digest(fingerprint)
+    def _class_key(self, pool, digest):
+        return (digest << 2) | pool
+    def _slots(self, pool, fingerprint):
+        slot = self.heads.get(self._class_key(pool, self.digest(fingerprint)), self._NIL)
+        while slot != self._NIL:
+            yield slot
+            slot = self.next[slot]
+    @typechecked
+    def add(self, e : Exp, pool : int, fingerprint : tuple, size : int, cost : Cost, evaluation : tuple = None):
+        digest = self.digest(fingerprint)
+        key = self._class_key(pool, digest)
+        tail = self._NIL
+        for slot in self._slots(pool, digest):
+            assert self.exps[slot] != e
+            tail = slot
+        if self.free:
+            slot = self.free.pop()
+            self.exps[slot] = e
+            self.costs[slot] = cost
+            self.digests[slot] = digest
+            self.pools[slot] = pool
+            self.sizes[slot] = size
+            self.next[slot] = self._NIL
+        else:
+            slot = len(self.exps)
+            self.exps.append(e)
+            self.costs.append(cost)
+            self.digests.append(digest)
+            self.pools.append(pool)
+            self.sizes.append(size)
+            self.next.append(self._NIL)
+        if tail == self._NIL:
+            self.heads[key] = slot
+        else:
+            self.next[tail] = slot
+        self.nodes += size
+    def evaluation_of(self, e):
+        return None
+    def contains(self, e, pool, fingerprint):
+        return any(self.exps[slot] is e for slot in self._slots(pool, fingerprint))
+    def contains_alpha_equivalent(self, e, pool, fingerprint):
+        for slot in self._slots(pool, fingerprint):
+            ee = self.exps[slot]
+            if ee.type == e.type and alpha_equivalent(ee, e):
+                return True
+        return False
+    def find_all(self, pool, fingerprint):
+        """yields (e, size, cost) tuples"""
+        for slot in list(self._slots(pool, fingerprint)):
+            yield (self.exps[slot], self.sizes[slot], self.costs[slot])
+    def find_one(self, pool, fingerprint):
+        for x in self.find_all(pool, fingerprint):
+            return x
+        return None
+    def entries(self):
+        """yields (e, pool, digest, size) tuples"""
+        for slot in range(len(self.exps)):
+            e = self.exps[slot]
+            if e is not None:
+                yield (e, self.pools[slot], self.digests[slot], self.sizes[slot])
+    def items(self):
+        """yields (e, pool, digest, size, cost) tuples"""
+        for slot in range(len(self.exps)):
+            e = self.exps[slot]
+            if e is not None:
+                yield (e, self.pools[slot], self.digests[slot], self.sizes[slot], self.costs[slot])
+    def crowded(self):
+        for key, head in self.heads.items():
+            if self.next[head] == self._NIL:
+                continue
+            pool = key & 3
+            slots = list(self._slots(pool, key >> 2))
+            keep = min(slots, key=lambda slot: self.sizes[slot])
+            for slot in slots:
+                if slot != keep:
+                    yield (self.exps[slot], pool, key >> 2, self.sizes[slot])
+    def remove(self, e, pool, fingerprint):
+        key = self._class_key(pool, self.digest(fingerprint))
+        prev = self._NIL
+        slot = self.heads.get(key, self._NIL)
+        while slot != self._NIL:
+            if self.exps[slot] is e:
+                if prev == self._NIL:
+                    if self.next[slot] == self._NIL:
+                        del self.heads[key]
+                    else:
+                        self.heads[key] = self.next[slot]
+                else:
+                    self.next[prev] = self.next[slot]
+                self.exps[slot] = None
+                self.costs[slot] = None
+                self.nodes -= self.sizes[slot]
+                self.free.append(slot)
+                return
+            prev = slot
+            slot = self.next[slot]
+    def __len__(self):
+        return len(self.exps) - len(self.free)
+    def clear(self):
+        self.__init__()
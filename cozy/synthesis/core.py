@@ -1,20 +1,28 @@
 from collections import defaultdict, OrderedDict
+from concurrent.futures import Future
+import copy
 import datetime
+import heapq
 import itertools
+import queue
 import sys
+import threading
 import traceback
 
 from cozy.target_syntax import *
-from cozy.syntax_tools import subst, pprint, free_vars, free_funcs, BottomUpExplorer, BottomUpRewriter, equal, fresh_var, alpha_equivalent, all_exps, implies, mk_lambda, enumerate_fragments2, strip_EStateVar
-from cozy.wf import ExpIsNotWf, exp_wf, exp_wf_nonrecursive
+from cozy.syntax_tools import subst, pprint, free_vars, free_funcs, BottomUpExplorer, BottomUpRewriter, equal, fresh_var, alpha_equivalent, all_exps, implies, mk_lambda, enumerate_fragments2, strip_EStateVar, hash_cons
+from cozy.wf import ExpIsNotWf, exp_wf, exp_wf_nonrecursive, verdict_count, forget_verdicts
 from cozy.common import OrderedSet, ADT, Visitor, fresh_name, typechecked, unique, pick_to_sum, cross_product, OrderedDefaultDict, OrderedSet, group_by, find_one
-from cozy.solver import satisfy, satisfiable, valid, IncrementalSolver
-from cozy.evaluation import eval, eval_bulk, mkval, construct_value, uneval
+from cozy.solver import satisfy, satisfiable, valid, IncrementalSolver, SolverInterrupted, solver_stats
+from cozy.solver_cache import canonical_text
+from cozy.evaluation import eval, eval_bulk, mkval, construct_value, uneval, compile_cache_stats
 from cozy.cost_model import CostModel, Cost
 from cozy.opts import Option
+from cozy import instrumentation
+from cozy.instrumentation import timed, phase, timed_iter
 from cozy.pools import ALL_POOLS, RUNTIME_POOL, STATE_POOL, pool_name
 
-from .cache import Cache, SeenSet
+from .cache import Cache, SeenSet, CompactSeenSet
 
 save_testcases = Option("save-testcases", str, "", metavar="PATH")
 hyperaggressive_culling = Option("hyperaggressive-culling", bool, False)
@@ -28,11 +36,28 @@ enforce_exprs_wf = Option("enforce-expressions-well-formed", bool, False)
 preopt = Option("optimize-accelerated-exps", bool, True)
 check_depth = Option("proof-depth", int, 4)
 incremental = Option("incremental", bool, False, description="Experimental option that can greatly improve performance.")
+compact_seen_set = Option("compact-seen-set", bool, False, description="Store the fingerprints of candidate expressions as digests to save memory.")
+cache_memory_budget = Option("cache-memory-budget", int, 0, metavar="MB", description="Approximate limit on the memory used to store candidate expressions during synthesis (0 for no limit).")
+parallel_enumeration = Option("parallel-enumeration", int, 0, metavar="N", description="Number of subprocesses to use for enumerating candidate expressions (0 or 1 to enumerate in-process).")
+batch_enumeration = Option("batch-enumeration", bool, False, description="Generate each size of candidate expressions all at once and only consider the smallest candidate with each fingerprint.")
+threaded_verification = Option("threaded-verification", bool, False, description="Compare the cost of each candidate on a separate thread while checking its correctness.")
 
 # When are costs checked?
 CHECK_FINAL_COST = True  # compare overall cost of each candidiate to target
 CHECK_SUBST_COST = False # compare cost of each subexp. to its replacement
 
+# Rough memory footprints used to enforce --cache-memory-budget: one AST
+# node, fingerprint value, or stored value; one entry in an index (e.g.
+# Cache.containing or the eviction queue); one memoized cost comparison;
+# one memoized well-formedness verdict (see cozy.wf).
+_BYTES_PER_NODE = 400
+_BYTES_PER_INDEX_ENTRY = 150
+_BYTES_PER_COST_COMPARISON = 1000
+_BYTES_PER_WF_VERDICT = 1000
+
+# Maximum number of cost comparisons a Learner remembers.
+_MAX_COST_COMPARISONS = 100000
+
 class ExpBuilder(object):
     def check(self, e, pool):
         if enforce_exprs_wf.value:
@@ -54,6 +79,55 @@ def instantiate_examples(examples, binders : [EVar]):
 def fingerprint(e, examples):
     return (e.type,) + tuple(eval_bulk(e, examples))
 
+class _UnknownChild(Exception):
+    pass
+
+def evaluate_from_children(e, examples, binders, known):
+    """
+    Compute the values of `e` on the given examples and the set of binders
+    that occur free in `e`. The function `known` should return the same
+    information for an expression if it has already been computed, or None
+    otherwise. When the results for all of e's non-lambda children are known,
+    only a shallow copy of `e`---whose children are replaced with variables
+    bound to the children's values---needs to be evaluated.
+    """
+    placeholders = OrderedDict()
+    free_binders = set()
+    def shallow(x):
+        if isinstance(x, ELambda):
+            # Lambda bodies cannot be summarized by a single value per
+            # example; evaluate them along with the shallow copy.
+            free_binders.update(v for v in free_vars(x) if v in binders)
+            return x
+        if isinstance(x, Exp):
+            res = known(x)
+            if res is None:
+                raise _UnknownChild()
+            vals, fbs = res
+            free_binders.update(fbs)
+            v = EVar("@child{}".format(len(placeholders))).with_type(x.type)
+            placeholders[v.id] = vals
+            return v
+        if isinstance(x, tuple):
+            return tuple(shallow(y) for y in x)
+        return x
+    try:
+        new_children = tuple(shallow(c) for c in e.children())
+    except _UnknownChild:
+        placeholders.clear()
+    if not placeholders:
+        return (tuple(eval_bulk(e, examples)), frozenset(v for v in free_vars(e) if v in binders))
+    envs = []
+    for (i, ex) in enumerate(examples):
+        env = dict(ex)
+        for (v, vals) in placeholders.items():
+            env[v] = vals[i]
+        envs.append(env)
+    # The shallow copy is a new object every time, so caching its compiled
+    # code would be pointless.
+    shallow_e = type(e)(*new_children).with_type(e.type)
+    return (tuple(eval_bulk(shallow_e, envs, use_cache=False)), frozenset(free_binders))
+
 class StopException(Exception):
     pass
 
@@ -125,20 +199,47 @@ class Learner(object):
         self.stop_callback = stop_callback
         self.cost_model = cost_model
         self.builder = builder
-        self.seen = SeenSet()
-        self.assumptions = assumptions
+        self.seen = CompactSeenSet() if compact_seen_set.value else SeenSet()
         self.hints = list(hints)
         self.solver = solver
+        self.assumptions = assumptions
         self.reset(examples)
         self.watch(target)
 
+    @property
+    def assumptions(self):
+        return self._assumptions
+
+    @assumptions.setter
+    def assumptions(self, assumptions):
+        # Cost comparisons survive `reset`: the outcome of a comparison only
+        # depends on the two costs and on the assumptions. Keys are
+        # alpha-normalized so that the fresh names used for cardinalities do
+        # not matter; variables that could appear in the assumptions keep
+        # their names. The memo is a bounded LRU.
+        self._assumptions = assumptions
+        self.cost_comparisons = OrderedDict()
+        self._fixed_names = frozenset(v.id for v in itertools.chain(self.binders, self.state_vars, self.args, free_vars(assumptions)))
+
+    @timed("cost")
     def compare_costs(self, c1, c2):
         self._on_cost_cmp()
+        key = canonical_text((c1.comparison_key(), c2.comparison_key()), fixed=self._fixed_names)
+        memo = self.cost_comparisons
+        res = memo.get(key)
+        if res is not None:
+            memo.move_to_end(key)
+            self.cchits += 1
+            return res
         solver = self.solver
         if solver is not None:
-            return c1.compare_to(c2, solver=solver)
+            res = c1.compare_to(c2, solver=solver)
         else:
-            return c1.compare_to(c2, assumptions=self.assumptions)
+            res = c1.compare_to(c2, assumptions=self.assumptions)
+        memo[key] = res
+        if len(memo) > _MAX_COST_COMPARISONS:
+            memo.popitem(last=False)
+        return res
 
     def reset(self, examples):
         _fates.clear()
@@ -147,7 +248,13 @@ class Learner(object):
         self.examples = list(examples)
         self.all_examples = instantiate_examples(self.examples, self.binders)
         self.seen.clear()
+        # heap of (crowded?, -size, n, e, pool, fp) for the entries of
+        # self.seen, in the order they should be evicted to save memory
+        # (maintained only if there is a memory budget). Entries may be stale.
+        self.eviction_queue = []
+        self.eviction_counter = itertools.count()
         self.builder_iter = ()
+        self.batch_evaluations = { } # maps id(e) to (e, evaluation) for candidates from _batch
         self.last_progress = 0
         self.backlog = None
         self.backlog_counter = 0
@@ -155,9 +262,9 @@ class Learner(object):
 
     def _check_seen_wf(self):
         if enforce_seen_wf.value:
-            for (e, pool, fp, size, cost) in self.seen.items():
+            for (e, pool, fp, size) in self.seen.entries():
                 fpnow = self._fingerprint(e)
-                if fp != fpnow:
+                if fp != self.seen.digest(fpnow):
                     print("#" * 40)
                     print(pprint(e))
                     print(fp)
@@ -186,6 +293,9 @@ class Learner(object):
                 fvs = free_vars(exp)
                 if all(v in self.legal_free_vars for v in fvs) and self.is_legal_in_pool(exp, pool):
                     _on_exp(exp, "new root", pool_name(pool))
+                    # `exp` may be shared with cached (hash-consed)
+                    # expressions; annotate a copy of it instead.
+                    exp = copy.copy(exp)
                     exp._root = True
                     self.roots.add((exp, pool))
                     if pool == STATE_POOL and all(v in self.state_vars for v in fvs):
@@ -205,11 +315,48 @@ class Learner(object):
             v=lambda ctxs: sorted(ctxs, key=lambda ctx: -ctx.e.size()))
         print("done!")
 
-    def _fingerprint(self, e):
+    @timed("fingerprint")
+    def _evaluate(self, e):
+        """
+        Returns the values of `e` on self.all_examples and its free binders,
+        re-using the results stored in self.seen for its children.
+        """
         self.fpcount += 1
-        # bs = tuple(sorted(free_vars(e) & self.binders))
-        bs = (len(free_vars(e) & self.binders),)
-        return fingerprint(e, self.all_examples) + bs
+        return evaluate_from_children(e, self.all_examples, self.binders, self.seen.evaluation_of)
+
+    def _fingerprint(self, e, evaluation=None):
+        values, free_binders = evaluation or self._evaluate(e)
+        # bs = tuple(sorted(free_binders))
+        bs = (len(free_binders),)
+        return (e.type,) + values + bs
+
+    def _batch(self, candidates):
+        """
+        Generate all the given candidates up front and group them by
+        fingerprint. Only the smallest candidate in each group is yielded, so
+        the others never reach the (expensive) cost comparisons in `next`.
+        """
+        self.batch_evaluations.clear()
+        groups = OrderedDict() # maps (pool, fingerprint) to (size, e, evaluation)
+        n = 0
+        for (e, pool) in candidates:
+            if self.stop_callback():
+                raise StopException()
+            n += 1
+            evaluation = self._evaluate(e)
+            key = (pool, self._fingerprint(e, evaluation))
+            size = e.size()
+            best = groups.get(key)
+            if best is None or size < best[0]:
+                if best is not None:
+                    _on_exp(best[1], "pruned by smaller equivalent", e)
+                groups[key] = (size, e, evaluation)
+            else:
+                _on_exp(e, "pruned by smaller equivalent", best[1])
+        self.batch_pruned += n - len(groups)
+        for (pool, fp), (size, e, evaluation) in groups.items():
+            self.batch_evaluations[id(e)] = (e, evaluation)
+            yield (e, pool)
 
     def _watched_contexts(self, pool, type):
         return self._watches.get((pool, type), ())
@@ -288,7 +435,8 @@ class Learner(object):
                 prev_exp, prev_size, prev_cost = prev
                 if prev_exp == e:
                     return prev_exp
-                cost = self.cost_model.cost(e, pool)
+                with phase("cost"):
+                    cost = self.cost_model.cost(e, pool)
                 ordering = self.compare_costs(cost, prev_cost)
                 if ordering == Cost.BETTER:
                     return super().visit_ADT(e) # optimize children
@@ -320,14 +468,87 @@ class Learner(object):
             print("> total exps:       {}".format(self.ecount))
             print("> exps/s:           {}".format(self.ecount / duration.total_seconds()))
             print("> cost comparisons: {}".format(self.ccount))
+            print("> cost memo hits:   {} ({:.1%}; {} memoized)".format(self.cchits, self.cchits / self.ccount if self.ccount else 0, len(self.cost_comparisons)))
             print("> fingerprints:     {}".format(self.fpcount))
+            print("> compile cache:    {hits} hits, {misses} misses, {size} entries".format(**compile_cache_stats()))
+            print("> batch pruned:     {}".format(self.batch_pruned))
+            print("> memory evictions: {} crowded, {} large (~{:.1f} MB in use)".format(self.crowded_evictions, self.large_evictions, self._memory_estimate() / (1024 * 1024)))
+            phases = instrumentation.end_iteration()
+            print("> phase times:      {}".format(instrumentation.format_times(phases)))
+            instrumentation.emit("minor_iteration",
+                size=self.msize,
+                duration=duration.total_seconds(),
+                exps=self.ecount,
+                cost_comparisons=self.ccount,
+                cost_memo_hits=self.cchits,
+                fingerprints=self.fpcount,
+                cache_size=len(self.cache),
+                solver=solver_stats(),
+                phases=phases)
         if self.current_size >= 0:
             print("minor iteration {}, |cache|={}".format(self.current_size, len(self.cache)))
         self.mstart = now
+        self.msize = self.current_size
         self.ecount = 0
         self.ccount = 0
+        self.cchits = 0
         self.fpcount = 0
         self.ncount = 0
+        self.crowded_evictions = 0
+        self.large_evictions = 0
+        self.batch_pruned = 0
+
+    def _memory_estimate(self):
+        """rough number of bytes used by the cache, seen set, cost memo, and wf memo"""
+        return ((self.cache.nodes + self.seen.nodes) * _BYTES_PER_NODE
+            + (self.cache.index_entries + len(self.eviction_queue)) * _BYTES_PER_INDEX_ENTRY
+            + len(self.cost_comparisons) * _BYTES_PER_COST_COMPARISON
+            + verdict_count() * _BYTES_PER_WF_VERDICT)
+
+    def _enqueue_for_eviction(self, e, pool, fp, size, crowded):
+        """
+        Note that the new entry `e` of self.seen may be evicted to save
+        memory. Crowded entries (ones whose fingerprint class already had an
+        entry) go first, then the largest ones.
+        """
+        if cache_memory_budget.value <= 0:
+            return
+        q = self.eviction_queue
+        heapq.heappush(q, (not crowded, -size, next(self.eviction_counter), e, pool, self.seen.digest(fp)))
+        if len(q) > 2 * len(self.seen) + 1000:
+            # drop entries for expressions that have been removed already
+            q[:] = [x for x in q if self.seen.contains(x[3], x[4], x[5])]
+            heapq.heapify(q)
+
+    def _enforce_memory_budget(self):
+        budget = cache_memory_budget.value * 1024 * 1024
+        if budget <= 0 or self._memory_estimate() <= budget:
+            return
+        # Go a bit below the budget so that this does not happen on every
+        # insertion.
+        target = budget * 9 // 10
+        # The cost memo and the wf memo may each use at most a quarter of the
+        # budget; they forget their least recently used entries first.
+        memo = self.cost_comparisons
+        while memo and len(memo) * _BYTES_PER_COST_COMPARISON > budget // 4:
+            memo.popitem(last=False)
+        forget_verdicts(budget // 4 // _BYTES_PER_WF_VERDICT)
+        # Then drop alternatives that have the same behavior as a smaller
+        # expression, then the largest expressions. Large expressions are the
+        # least useful as building blocks for later minor iterations.
+        q = self.eviction_queue
+        while q and self._memory_estimate() > target:
+            not_crowded, neg_size, n, e, pool, fp = heapq.heappop(q)
+            if not self.seen.contains(e, pool, fp):
+                continue
+            if not_crowded:
+                _on_exp(e, "evicted to save memory (large)")
+                self.large_evictions += 1
+            else:
+                _on_exp(e, "evicted to save memory (crowded)")
+                self.crowded_evictions += 1
+            self.cache.evict(e, size=-neg_size, pool=pool)
+            self.seen.remove(e, pool, fp)
 
     def _on_exp(self, e, pool):
         # print("next() <<< {p:10} {e}".format(e=pprint(e), p=pool_name(pool)))
@@ -352,7 +573,7 @@ class Learner(object):
                 else:
                     self.backlog = None
                     self.backlog_counter = 0
-            for (e, pool) in self.builder_iter:
+            for (e, pool) in timed_iter(self.builder_iter, "enumeration"):
                 self._on_exp(e, pool)
                 if self.stop_callback():
                     raise StopException()
@@ -372,18 +593,22 @@ class Learner(object):
                     _on_exp(e, "preoptimized", new_e)
                     e = new_e
 
-                cost = self.cost_model.cost(e, pool)
+                with phase("cost"):
+                    cost = self.cost_model.cost(e, pool)
 
                 if pool == RUNTIME_POOL and (self.cost_model.is_monotonic() or hyperaggressive_culling.value) and self.compare_costs(cost, target_cost) == Cost.WORSE:
                     _on_exp(e, "too expensive", cost, target_cost)
                     continue
 
-                fp = self._fingerprint(e)
+                x = self.batch_evaluations.pop(id(e), None)
+                evaluation = x[1] if x is not None and x[0] is e else self._evaluate(e)
+                fp = self._fingerprint(e, evaluation)
                 prev = list(self.seen.find_all(pool, fp))
+                n_prev = len(prev)
                 should_add = True
                 if not prev:
                     _on_exp(e, "new", pool_name(pool))
-                elif any(alpha_equivalent(e, ee) for (ee, _, _) in prev):
+                elif self.seen.contains_alpha_equivalent(e, pool, fp):
                     _on_exp(e, "duplicate")
                     should_add = False
                 else:
@@ -407,13 +632,11 @@ class Learner(object):
                             _on_exp(prev_exp, "found better alternative", e)
                             self.cache.evict(prev_exp, size=prev_size, pool=pool)
                             self.seen.remove(prev_exp, pool, fp)
+                            n_prev -= 1
                             if (self.cost_model.is_monotonic() or hyperaggressive_culling.value) and hyperaggressive_eviction.value:
-                                for (cached_e, size, p) in list(self.cache):
-                                    if p != pool:
-                                        continue
-                                    if prev_exp in all_exps(cached_e):
-                                        _on_exp(cached_e, "evicted since it contains", prev_exp)
-                                        self.cache.evict(cached_e, size=size, pool=pool)
+                                for (cached_e, size) in self.cache.find_containing(prev_exp, pool):
+                                    _on_exp(cached_e, "evicted since it contains", prev_exp)
+                                    self.cache.evict(cached_e, size=size, pool=pool)
                         else:
                             should_add = False
                             worse_than = (prev_exp, prev_size, prev_cost)
@@ -432,9 +655,15 @@ class Learner(object):
                         # raise Exception("insane cost model behavior")
 
                 if should_add:
+                    # Share structure with everything else in the cache so
+                    # that later equality tests (e.g. during eviction) are
+                    # mostly identity checks.
+                    e = hash_cons(e)
                     self.cache.add(e, pool=pool, size=self.current_size)
-                    self.seen.add(e, pool, fp, self.current_size, cost)
+                    self.seen.add(e, pool, fp, self.current_size, cost, evaluation=evaluation)
+                    self._enqueue_for_eviction(e, pool, fp, self.current_size, crowded=n_prev > 0)
                     self.last_progress = self.current_size
+                    self._enforce_memory_budget()
                 else:
                     continue
 
@@ -450,6 +679,8 @@ class Learner(object):
             self.builder_iter = self.builder.build(self.cache, self.current_size)
             if self.current_size == 0:
                 self.builder_iter = itertools.chain(self.builder_iter, list(self.roots))
+            if batch_enumeration.value:
+                self.builder_iter = self._batch(self.builder_iter)
             for f, ct in sorted(_fates.items(), key=lambda x: x[1], reverse=True):
                 print("  {:6} | {}".format(ct, f))
             _fates.clear()
@@ -558,6 +789,60 @@ def heuristic_done(e : Exp, args : [EVar] = []):
 def never_stop():
     return False
 
+def _compare_final_cost(cost_model, new_target, target_cost, assumptions, solver):
+    new_cost = cost_model.cost(new_target, RUNTIME_POOL)
+    if solver is not None:
+        ordering = new_cost.compare_to(target_cost, solver=solver)
+    else:
+        ordering = new_cost.compare_to(target_cost, assumptions=assumptions)
+    return (new_cost, ordering)
+
+class _CostChecker(object):
+    """
+    Runs _compare_final_cost on a daemon thread, one comparison at a time,
+    so that comparisons can overlap the search for a counterexample.
+
+    A caller that no longer wants a result abandons it: a comparison that
+    has already started finishes in the background, delaying only the next
+    one. Once `stop_callback` returns true, pending comparisons fail with
+    SolverInterrupted, and so do the solver calls of a running one (through
+    `solver` or, without one, the default stop callback of the job; see
+    cozy.solver.default_stop_callback).
+    """
+    def __init__(self, cost_model, assumptions, solver, stop_callback):
+        self.cost_model = cost_model
+        self.assumptions = assumptions
+        self.solver = solver
+        self.stop_callback = stop_callback
+        self.closed = False
+        self.requests = queue.Queue()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, new_target, target_cost) -> Future:
+        res = Future()
+        self.requests.put((new_target, target_cost, res))
+        return res
+
+    def close(self):
+        self.closed = True
+        self.requests.put(None)
+
+    def _run(self):
+        while True:
+            request = self.requests.get()
+            if request is None or self.closed:
+                return
+            new_target, target_cost, res = request
+            if not res.set_running_or_notify_cancel():
+                continue
+            if self.stop_callback():
+                res.set_exception(SolverInterrupted())
+                continue
+            try:
+                res.set_result(_compare_final_cost(self.cost_model, new_target, target_cost, self.assumptions, self.solver))
+            except BaseException as e:
+                res.set_exception(e)
+
 @typechecked
 def improve(
         target : Exp,
@@ -631,6 +916,9 @@ def improve(
     target = fixup_binders(target, binders, allow_add=False)
     hints = [fixup_binders(h, binders, allow_add=False) for h in (hints or ())]
     assumptions = fixup_binders(assumptions, binders, allow_add=False)
+    if parallel_enumeration.value > 1:
+        from .parallel import ShardedBuilder, ParallelBuilder
+        sharder = builder = ShardedBuilder(builder)
     builder = FixedBuilder(builder, state_vars, args, binders, assumptions)
     target_cost = cost_model.cost(target, RUNTIME_POOL)
 
@@ -638,16 +926,20 @@ def improve(
         print("This job does not depend on state_vars.")
         builder = StateElimBuilder(builder)
 
+    if parallel_enumeration.value > 1:
+        builder = ParallelBuilder(builder, sharder, parallel_enumeration.value, stop_callback)
+
     vars = list(free_vars(target) | free_vars(assumptions))
     funcs = free_funcs(EAll([target, assumptions]))
+    instrumentation.emit("target", cost=str(target_cost), size=target.size())
 
     solver = None
     if incremental.value:
-        solver = IncrementalSolver(vars=vars, funcs=funcs, collection_depth=check_depth.value)
+        solver = IncrementalSolver(vars=vars, funcs=funcs, collection_depth=check_depth.value, stop_callback=stop_callback)
         solver.add_assumption(assumptions)
-        _sat = solver.satisfy
+        _sat = timed("counterexample")(solver.satisfy)
     else:
-        _sat = lambda e: satisfy(e, vars=vars, funcs=funcs, collection_depth=check_depth.value)
+        _sat = timed("counterexample")(lambda e: satisfy(e, vars=vars, funcs=funcs, collection_depth=check_depth.value, stop_callback=stop_callback))
 
     if _sat(T) is None:
         print("assumptions are unsat; this query will never be called")
@@ -657,6 +949,15 @@ def improve(
     if examples is None:
         examples = []
     learner = Learner(target, assumptions, binders, state_vars, args, vars + binders, examples, cost_model, builder, stop_callback, hints, solver=solver)
+    checker = None
+    if threaded_verification.value and CHECK_FINAL_COST:
+        # `solver` is only ever used from this thread, so in incremental mode
+        # the checker gets an incremental solver of its own.
+        cost_solver = None
+        if incremental.value:
+            cost_solver = IncrementalSolver(vars=vars, funcs=funcs, collection_depth=check_depth.value, stop_callback=stop_callback)
+            cost_solver.add_assumption(assumptions)
+        checker = _CostChecker(cost_model, assumptions, cost_solver, stop_callback)
     try:
         while True:
             # 1. find any potential improvement to any sub-exp of target
@@ -671,6 +972,9 @@ def improve(
             new_target = repl(new_e)
 
             # 3. check
+            cost_check = None
+            if checker is not None:
+                cost_check = checker.submit(new_target, target_cost)
             if incremental.value:
                 solver.push()
                 solver.add_assumption(ENot(EBinOp(target, "==", new_target).with_type(BOOL)))
@@ -679,6 +983,9 @@ def improve(
                 formula = EAll([assumptions, ENot(EBinOp(target, "==", new_target).with_type(BOOL))])
                 counterexample = _sat(formula)
             if counterexample is not None:
+                if cost_check is not None:
+                    # abandon the comparison if it has already started
+                    cost_check.cancel()
 
                 # Ok they aren't equal.  Now we need an example that
                 # differentiates BOTH target/new_target AND old_e/new_e.
@@ -721,12 +1028,11 @@ def improve(
                 # b. if correct: yield it, watch the new target, goto 1
 
                 if CHECK_FINAL_COST:
-                    new_cost = cost_model.cost(new_target, RUNTIME_POOL)
-                    print("cost: {} -----> {}".format(target_cost, new_cost))
-                    if incremental.value:
-                        ordering = new_cost.compare_to(target_cost, solver=solver)
+                    if cost_check is not None:
+                        new_cost, ordering = cost_check.result()
                     else:
-                        ordering = new_cost.compare_to(target_cost, assumptions=assumptions)
+                        new_cost, ordering = _compare_final_cost(cost_model, new_target, target_cost, assumptions, solver)
+                    print("cost: {} -----> {}".format(target_cost, new_cost))
                     if ordering == Cost.WORSE:
                         if CHECK_SUBST_COST:
                             print("WHOOPS! COST GOT WORSE!")
@@ -764,6 +1070,7 @@ def improve(
                 if any(v in binders for v in free_vars(new_target)):
                     print("WARNING: stripping binders in {}".format(pprint(new_target)), file=sys.stderr)
                     to_yield = subst(new_target, { b.id : construct_value(b.type) for b in binders })
+                instrumentation.emit("target", cost=str(target_cost), size=to_yield.size())
                 yield to_yield
 
                 if reset_on_success.value and (not CHECK_FINAL_COST or ordering != Cost.UNORDERED):
@@ -781,3 +1088,8 @@ def improve(
         for e in learner.cache.random_sample(50):
             print(pprint(e))
         raise
+    finally:
+        if checker is not None:
+            checker.close()
+        if parallel_enumeration.value > 1:
+            builder.close()
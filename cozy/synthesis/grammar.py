@@ -5,12 +5,41 @@ from cozy.target_syntax import *
 from cozy.syntax_tools import subst, mk_lambda, free_vars, is_scalar, pprint, strip_EStateVar
 from cozy.typecheck import is_collection, is_numeric
 from cozy.pools import STATE_POOL, RUNTIME_POOL, ALL_POOLS
+from cozy.wf import type_wf, may_be_wf
 from cozy.opts import Option
 
 from .core import ExpBuilder
 
 build_exprs = Option("build-exprs", bool, True)
 
+# For each family of binary productions, a function from the type of the
+# first operand to the type the second operand must have, or None if no
+# production in the family accepts a first operand of that type.
+_SAME_NUMERIC_TYPE    = lambda t: t if is_numeric(t) else None
+_SAME_COLLECTION_TYPE = lambda t: t if is_collection(t) else None
+_ELEMENT_TYPE         = lambda t: t.t if is_collection(t) else None
+_SAME_NON_MAP_TYPE    = lambda t: None if isinstance(t, TMap) else t
+_KEY_TYPE             = lambda t: t.k if isinstance(t, TMap) else None
+_SAME_TYPE            = lambda t: t
+
+def operand_pairs(cache, pool, sz1, sz2, second_type):
+    """
+    Yields (a1, a2) pairs of cached expressions of sizes sz1 and sz2 such that
+    a2.type == second_type(a1.type). Enumeration is driven by the types that
+    are actually present in the cache, so no time is spent on expressions
+    whose type cannot appear in the production.
+    """
+    for t1 in cache.find_types(pool=pool, size=sz1):
+        t2 = second_type(t1)
+        if t2 is None:
+            continue
+        a2s = cache.find(pool=pool, type=t2, size=sz2)
+        if not a2s:
+            continue
+        for a1 in cache.find(pool=pool, type=t1, size=sz1):
+            for a2 in a2s:
+                yield (a1, a2)
+
 class BinderBuilder(ExpBuilder):
     def __init__(self, binders : [EVar], state_vars : [EVar], args : [EVar] = []):
         super().__init__()
@@ -51,10 +80,15 @@ class BinderBuilder(ExpBuilder):
                 if all(v in self.state_vars for v in free_vars(e)):
                     yield self.check(EStateVar(e).with_type(e.type), RUNTIME_POOL)
 
-            for e in cache.find(pool=pool, size=size-1):
-                t = TBag(e.type)
-                yield self.check(EEmptyList().with_type(t), pool)
-                yield self.check(ESingleton(e).with_type(t), pool)
+            for et in cache.find_types(pool=pool, size=size-1):
+                t = TBag(et)
+                if not type_wf(t):
+                    continue
+                singleton_ok = may_be_wf(ESingleton, t, pool)
+                for e in cache.find(pool=pool, type=et, size=size-1):
+                    yield self.check(EEmptyList().with_type(t), pool)
+                    if singleton_ok:
+                        yield self.check(ESingleton(e).with_type(t), pool)
 
             for e in cache.find(pool=pool, type=TRecord, size=size-1):
                 for (f,t) in e.type.fields:
@@ -75,42 +109,41 @@ class BinderBuilder(ExpBuilder):
             for m in cache.find(pool=pool, type=TMap, size=size-1):
                 yield self.check(EMapKeys(m).with_type(TBag(m.type.k)), pool)
 
+            arithmetic_ok = may_be_wf(EBinOp, INT, pool)
             for (sz1, sz2) in pick_to_sum(2, size - 1):
-                for a1 in cache.find(pool=pool, size=sz1):
-                    if not is_numeric(a1.type):
-                        continue
-                    for a2 in cache.find(pool=pool, type=a1.type, size=sz2):
+                for (a1, a2) in operand_pairs(cache, pool, sz1, sz2, _SAME_NUMERIC_TYPE):
+                    if arithmetic_ok:
                         yield self.check(EBinOp(a1, "+", a2).with_type(INT), pool)
                         yield self.check(EBinOp(a1, "-", a2).with_type(INT), pool)
-                        yield self.check(EBinOp(a1, ">", a2).with_type(BOOL), pool)
-                        yield self.check(EBinOp(a1, "<", a2).with_type(BOOL), pool)
-                        yield self.check(EBinOp(a1, ">=", a2).with_type(BOOL), pool)
-                        yield self.check(EBinOp(a1, "<=", a2).with_type(BOOL), pool)
-                for a1 in cache.find_collections(pool=pool, size=sz1):
-                    for a2 in cache.find(pool=pool, type=a1.type, size=sz2):
-                        yield self.check(EBinOp(a1, "+", a2).with_type(a1.type), pool)
+                    yield self.check(EBinOp(a1, ">", a2).with_type(BOOL), pool)
+                    yield self.check(EBinOp(a1, "<", a2).with_type(BOOL), pool)
+                    yield self.check(EBinOp(a1, ">=", a2).with_type(BOOL), pool)
+                    yield self.check(EBinOp(a1, "<=", a2).with_type(BOOL), pool)
+                for (a1, a2) in operand_pairs(cache, pool, sz1, sz2, _SAME_COLLECTION_TYPE):
+                    yield self.check(EBinOp(a1, "+", a2).with_type(a1.type), pool)
+                    if may_be_wf(EBinOp, a1.type, pool, "-"):
                         yield self.check(EBinOp(a1, "-", a2).with_type(a1.type), pool)
-                    for a2 in cache.find(pool=pool, type=a1.type.t, size=sz2):
-                        yield self.check(EBinOp(a2, BOp.In, a1).with_type(BOOL), pool)
+                for (a1, a2) in operand_pairs(cache, pool, sz1, sz2, _ELEMENT_TYPE):
+                    yield self.check(EBinOp(a2, BOp.In, a1).with_type(BOOL), pool)
                 for a1 in cache.find(pool=pool, type=BOOL, size=sz1):
                     for a2 in cache.find(pool=pool, type=BOOL, size=sz2):
                         yield self.check(EBinOp(a1, BOp.And, a2).with_type(BOOL), pool)
                         yield self.check(EBinOp(a1, BOp.Or, a2).with_type(BOOL), pool)
-                for a1 in cache.find(pool=pool, size=sz1):
-                    if not isinstance(a1.type, TMap):
-                        for a2 in cache.find(pool=pool, type=a1.type, size=sz2):
-                            yield self.check(EEq(a1, a2), pool)
-                            yield self.check(EBinOp(a1, "!=", a2).with_type(BOOL), pool)
-                for m in cache.find(pool=pool, type=TMap, size=sz1):
-                    for k in cache.find(pool=pool, type=m.type.k, size=sz2):
-                        yield self.check(EMapGet(m, k).with_type(m.type.v), pool)
-                        yield self.check(EHasKey(m, k).with_type(BOOL), pool)
-
-            for (sz1, sz2, sz3) in pick_to_sum(3, size-1):
-                for cond in cache.find(pool=pool, type=BOOL, size=sz1):
-                    for then_branch in cache.find(pool=pool, size=sz2):
-                        for else_branch in cache.find(pool=pool, size=sz3, type=then_branch.type):
-                            yield self.check(ECond(cond, then_branch, else_branch).with_type(then_branch.type), pool)
+                for (a1, a2) in operand_pairs(cache, pool, sz1, sz2, _SAME_NON_MAP_TYPE):
+                    yield self.check(EEq(a1, a2), pool)
+                    yield self.check(EBinOp(a1, "!=", a2).with_type(BOOL), pool)
+                for (m, k) in operand_pairs(cache, pool, sz1, sz2, _KEY_TYPE):
+                    yield self.check(EMapGet(m, k).with_type(m.type.v), pool)
+                    yield self.check(EHasKey(m, k).with_type(BOOL), pool)
+
+            for (sz1, sz2, sz3) in (pick_to_sum(3, size-1) if may_be_wf(ECond, None, pool) else ()):
+                conds = cache.find(pool=pool, type=BOOL, size=sz1)
+                if not conds:
+                    continue
+                branches = list(operand_pairs(cache, pool, sz2, sz3, _SAME_TYPE))
+                for cond in conds:
+                    for (then_branch, else_branch) in branches:
+                        yield self.check(ECond(cond, then_branch, else_branch).with_type(then_branch.type), pool)
 
             for bag in cache.find_collections(pool=pool, size=size-1):
                 # len of bag
@@ -135,7 +168,8 @@ class BinderBuilder(ExpBuilder):
                 for bag in cache.find_collections(pool=pool, size=sz1):
                     for binder in binders_by_type[bag.type.t]:
                         for body in itertools.chain(cache.find(pool=pool, size=sz2), (binder,)):
-                            yield self.check(EMap(bag, ELambda(binder, body)).with_type(TBag(body.type)), pool)
+                            if type_wf(TBag(body.type)):
+                                yield self.check(EMap(bag, ELambda(binder, body)).with_type(TBag(body.type)), pool)
                             if body.type == BOOL:
                                 yield self.check(EFilter(bag, ELambda(binder, body)).with_type(bag.type), pool)
                             if body.type == INT:
@@ -151,5 +185,7 @@ class BinderBuilder(ExpBuilder):
                 for b in binders_by_type[bag.type.t]:
                     for val in cache.find(pool=STATE_POOL, size=sz2):
                         t = TMap(bag.type.t, val.type)
+                        if not type_wf(t):
+                            continue
                         m = EMakeMap2(bag, ELambda(b, val)).with_type(t)
                         yield self.check(m, STATE_POOL)
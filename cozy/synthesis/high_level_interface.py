@@ -3,6 +3,8 @@ import datetime
 import itertools
 import sys
 import os
+import threading
+import time
 from queue import Empty
 
 from cozy.common import typechecked, fresh_name, pick_to_sum, nested_dict, find_one, OrderedSet
@@ -12,8 +14,8 @@ from cozy.syntax_tools import all_types, alpha_equivalent, BottomUpExplorer, Bot
 import cozy.incrementalization as inc
 from cozy.timeouts import Timeout, TimeoutException
 from cozy.cost_model import CompositeCostModel
-from cozy import jobs
-from cozy.solver import valid
+from cozy import jobs, instrumentation
+from cozy.solver import valid, SolverInterrupted, default_stop_callback
 from cozy.opts import Option
 from cozy.pools import STATE_POOL
 
@@ -38,7 +40,8 @@ class ImproveQueryJob(jobs.Job):
             q : Query,
             k,
             hints : [Exp] = [],
-            examples : [dict] = None):
+            examples : [dict] = None,
+            metrics_q = None):
         super().__init__()
         self.ctx = ctx
         self.state = state
@@ -49,6 +52,7 @@ class ImproveQueryJob(jobs.Job):
         self.hints = hints
         self.examples = examples
         self.k = k
+        self.metrics_q = metrics_q
     def __str__(self):
         return "ImproveQueryJob[{}]".format(self.q.name)
     def run(self):
@@ -57,42 +61,56 @@ class ImproveQueryJob(jobs.Job):
         with open(os.path.join(log_dir.value, "{}.log".format(self.q.name)), "w", buffering=LINE_BUFFER_MODE) as f:
             sys.stdout = f
             print("STARTING IMPROVEMENT JOB {} (|examples|={})".format(self.q.name, len(self.examples or ())))
-            print(pprint(self.q))
-
-            if nice_children.value:
-                os.nice(20)
-
-            all_types = self.ctx.all_types
-            n_binders = 1
-            done = False
-            expr = ETuple((EAll(self.assumptions), self.q.ret)).with_type(TTuple((BOOL, self.q.ret.type)))
-            while not done:
-                binders = []
-                for t in all_types:
-                    # if isinstance(t, TBag):
-                    #     binders += [fresh_var(t.t) for i in range(n_binders)]
-                    for i in range(n_binders):
-                        b = fresh_var(t)
-                        binders.append(b)
-                try:
-                    core.fixup_binders(expr, binders, throw=True)
-                    done = True
-                except:
-                    pass
-                n_binders += 1
-
-            binders = [fresh_var(t) for t in all_types if is_scalar(t) for i in range(n_binders)]
-            print("Using {} binders".format(n_binders))
-            relevant_state_vars = [v for v in self.state if v in free_vars(EAll(self.assumptions)) | free_vars(self.q.ret)]
-            used_vars = free_vars(self.q.ret)
-            for a in self.q.assumptions:
-                used_vars |= free_vars(a)
-            args = [EVar(v).with_type(t) for (v, t) in self.q.args]
-            args = [a for a in args if a in used_vars]
-            b = BinderBuilder(binders, relevant_state_vars, args)
-            if accelerate.value:
-                b = AcceleratedBuilder(b, binders, relevant_state_vars, args)
+            if instrumentation.trace.value:
+                instrumentation.start_trace(os.path.join(log_dir.value, "{}.trace.jsonl".format(self.q.name)), query=self.q.name)
+            if self.metrics_q is not None:
+                instrumentation.add_listener(lambda record: self.metrics_q.put((self.q.name, record)))
+            try:
+                self._improve()
+            finally:
+                phases = instrumentation.total_times()
+                print("phase times: {}".format(instrumentation.format_times(phases)))
+                instrumentation.emit("job", phases=phases)
+                instrumentation.stop_trace()
+
+    def _improve(self):
+        print(pprint(self.q))
+
+        if nice_children.value:
+            os.nice(20)
 
+        all_types = self.ctx.all_types
+        n_binders = 1
+        done = False
+        expr = ETuple((EAll(self.assumptions), self.q.ret)).with_type(TTuple((BOOL, self.q.ret.type)))
+        while not done:
+            binders = []
+            for t in all_types:
+                # if isinstance(t, TBag):
+                #     binders += [fresh_var(t.t) for i in range(n_binders)]
+                for i in range(n_binders):
+                    b = fresh_var(t)
+                    binders.append(b)
+            try:
+                core.fixup_binders(expr, binders, throw=True)
+                done = True
+            except:
+                pass
+            n_binders += 1
+
+        binders = [fresh_var(t) for t in all_types if is_scalar(t) for i in range(n_binders)]
+        print("Using {} binders".format(n_binders))
+        relevant_state_vars = [v for v in self.state if v in free_vars(EAll(self.assumptions)) | free_vars(self.q.ret)]
+        used_vars = free_vars(self.q.ret)
+        for a in self.q.assumptions:
+            used_vars |= free_vars(a)
+        args = [EVar(v).with_type(t) for (v, t) in self.q.args]
+        args = [a for a in args if a in used_vars]
+        b = BinderBuilder(binders, relevant_state_vars, args)
+        if accelerate.value:
+            b = AcceleratedBuilder(b, binders, relevant_state_vars, args)
+
+        with default_stop_callback(lambda: self.stop_requested):
             try:
                 for expr in itertools.chain((self.q.ret,), core.improve(
                         target=self.q.ret,
@@ -109,15 +127,65 @@ class ImproveQueryJob(jobs.Job):
                     new_rep, new_ret = tease_apart(expr)
                     self.k(new_rep, new_ret)
                 print("PROVED OPTIMALITY FOR {}".format(self.q.name))
-            except core.StopException:
+            except (core.StopException, SolverInterrupted):
                 print("stopping synthesis of {}".format(self.q.name))
                 return
 
+class JobMetrics(object):
+    """
+    Live statistics about the query jobs of improve_implementation, built
+    from the instrumentation events they send back. Safe to read from other
+    threads (e.g. the progress server).
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queries = OrderedDict()
+    def _query(self, query):
+        m = self.queries.get(query)
+        if m is None:
+            m = OrderedDict([
+                ("status", "running"),
+                ("best_cost", None),
+                ("best_size", None),
+                ("improvements", 0),
+                ("size", None),
+                ("exps_per_second", 0.0),
+                ("cache_size", 0),
+                ("solver", None),
+                ("phases", { }),
+                ("updated", None)])
+            self.queries[query] = m
+        return m
+    def update(self, query, record):
+        with self.lock:
+            m = self._query(query)
+            event = record["event"]
+            if event == "minor_iteration":
+                m["size"] = record["size"]
+                m["exps_per_second"] = record["exps"] / record["duration"] if record["duration"] else 0.0
+                m["cache_size"] = record["cache_size"]
+                m["solver"] = record.get("solver")
+            elif event == "target":
+                if m["best_cost"] is not None:
+                    m["improvements"] += 1
+                m["best_cost"] = record["cost"]
+                m["best_size"] = record["size"]
+            elif event == "job":
+                m["phases"] = record["phases"]
+            m["updated"] = record["time"]
+    def set_status(self, query, status):
+        with self.lock:
+            self._query(query)["status"] = status
+    def snapshot(self):
+        with self.lock:
+            return { "time": time.time(), "queries": { q: dict(m) for (q, m) in self.queries.items() } }
+
 @typechecked
 def improve_implementation(
         impl              : Implementation,
         timeout           : datetime.timedelta = datetime.timedelta(seconds=60),
-        progress_callback = None) -> Implementation:
+        progress_callback = None,
+        metrics           = None) -> Implementation:
 
     start_time = datetime.datetime.now()
 
@@ -143,13 +211,17 @@ def improve_implementation(
     # the actual worker threads
     improvement_jobs = []
 
-    with jobs.SafeQueue() as solutions_q:
+    with jobs.SafeQueue() as solutions_q, jobs.SafeQueue() as metrics_q:
 
         def stop_jobs(js):
             js = list(js)
+            running = [j for j in js if not j.done]
             jobs.stop_jobs(js)
             for j in js:
                 improvement_jobs.remove(j)
+            if metrics is not None:
+                for j in running:
+                    metrics.set_status(j.q.name, "stopped")
 
         def reconcile_jobs():
             # figure out what new jobs we need
@@ -163,7 +235,8 @@ def improve_implementation(
                         list(impl.spec.assumptions) + list(q.assumptions),
                         q,
                         k=(lambda q: lambda new_rep, new_ret: solutions_q.put((q, new_rep, new_ret)))(q),
-                        hints=[EStateVar(c).with_type(c.type) for c in impl.concretization_functions.values()]))
+                        hints=[EStateVar(c).with_type(c.type) for c in impl.concretization_functions.values()],
+                        metrics_q=metrics_q if metrics is not None else None))
 
             # figure out what old jobs we can stop
             impl_query_names = set(q.name for q in impl.query_specs)
@@ -173,6 +246,8 @@ def improve_implementation(
             stop_jobs(old)
             for j in new:
                 j.start()
+                if metrics is not None:
+                    metrics.set_status(j.q.name, "running")
             improvement_jobs.extend(new)
 
         # start jobs
@@ -189,6 +264,12 @@ def improve_implementation(
                     else:
                         print("failed job: {}".format(j), file=sys.stderr)
                         # raise Exception("failed job: {}".format(j))
+                    if metrics is not None:
+                        metrics.set_status(j.q.name, "done" if j.successful else "failed")
+
+            if metrics is not None:
+                for (q, record) in metrics_q.drain():
+                    metrics.update(q, record)
 
             done = all(j.done for j in improvement_jobs)
 
@@ -242,11 +323,14 @@ def improve_implementation(
 
                     # clean up
                     impl.cleanup()
+                    reconcile_jobs()
                     if progress_callback is not None:
                         progress_callback((impl, impl.code, impl.concretization_functions))
-                    reconcile_jobs()
 
         # stop jobs
         print("Stopping jobs")
         stop_jobs(list(improvement_jobs))
+        if metrics is not None:
+            for (q, record) in metrics_q.drain():
+                metrics.update(q, record)
         return impl
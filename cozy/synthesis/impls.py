@@ -6,23 +6,73 @@ concretization functions relating them to their underlying specifications and
 they store various other information to aid synthesis.
 """
 
+import ctypes
 import itertools
 from collections import OrderedDict, defaultdict
+import multiprocessing
 
 import igraph
 
+from cozy import common, opts
 from cozy.common import fresh_name, find_one, typechecked, OrderedSet
 from cozy.syntax import *
 from cozy.target_syntax import EFilter, EDeepIn, EStateVar
-from cozy.syntax_tools import subst, free_vars, fresh_var, alpha_equivalent, all_exps, BottomUpRewriter, BottomUpExplorer, pprint, replace, shallow_copy, tease_apart, wrap_naked_statevars
+from cozy.syntax_tools import subst, free_vars, free_funcs, fresh_var, alpha_equivalent, all_exps, BottomUpRewriter, BottomUpExplorer, pprint, replace, shallow_copy, tease_apart, wrap_naked_statevars
 from cozy.handle_tools import reachable_handles_at_method, implicit_handle_assumptions_for_method
 import cozy.incrementalization as inc
 from cozy.opts import Option
 from cozy.simplification import simplify
+from cozy.evaluation import eval
 
 from .misc import rewrite_ret, queries_equivalent
+from .core import fingerprint
 
 dedup_queries = Option("deduplicate-subqueries", bool, True)
+exact_ordering_limit = Option("exact-update-ordering-limit", int, 20,
+    description="Order the state updates of an op with an exact feedback arc set only when there are at most this many state variables; above that, use a fast heuristic")
+parallel_incrementalization = Option("parallel-incrementalization", int, 0,
+    description="Number of worker processes that incrementalize ops when a query implementation changes (0 = do it on the main process)")
+
+# The workers draw fresh names from a block of this many names that is
+# reserved for them, so that they never collide with the parent's.
+_FRESH_NAME_BLOCK = 1 << 32
+
+def _init_incrementalization_worker(i):
+    # share the fresh name counter so that workers never reuse a name
+    common._i = i
+
+def _sketch_update(task):
+    # Spawned workers do not inherit the options, so each task carries the
+    # options it should run with.
+    options, args = task
+    opts.restore(options)
+    return inc.sketch_update(*args)
+
+def _parallel_sketch_updates(size, tasks):
+    """
+    Runs inc.sketch_update on each of the argument tuples in `tasks` using
+    `size` worker processes, and returns the results in order.
+    """
+    # The synthesizer runs several threads, so the workers are spawned
+    # rather than forked.
+    ctx = multiprocessing.get_context("spawn")
+    with common._i.get_lock():
+        fresh_base = common._i.value
+        common._i.value += _FRESH_NAME_BLOCK
+    counter = ctx.Value(ctypes.c_uint64, fresh_base)
+    options = opts.snapshot()
+    pool = ctx.Pool(min(size, len(tasks)),
+        initializer=_init_incrementalization_worker,
+        initargs=(counter,))
+    try:
+        return pool.map(_sketch_update, [(options, args) for args in tasks], chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+def _defines_everything_in(env, e):
+    """Returns True if `env` binds every free variable and function of `e`."""
+    return all(v.id in env for v in free_vars(e)) and all(f in env for f in free_funcs(e))
 
 def _queries_used_by(thing):
     qs = set()
@@ -83,6 +133,25 @@ class Implementation(object):
         self.query_impls = query_impls
         self.updates = updates # maps (concrete_var_name, op_name) to stm
         self.handle_updates = handle_updates # maps (handle_type, op_name) to stm
+        self._clear_code_caches()
+
+    def _clear_code_caches(self):
+        self._reads_cache = { } # maps query name to (query, state vars it reads)
+        self._op_code_cache = { } # maps op name to (key, temps, ordered updates)
+        self._state_solver = None # holds the spec assumptions
+        self._state_examples = [] # counterexamples found by _state_solver
+        self._state_fingerprints = { } # maps exp to fingerprint on _state_examples
+
+    def __getstate__(self):
+        # the caches are keyed on hashes, which differ from process to process
+        d = dict(self.__dict__)
+        for a in ("_reads_cache", "_op_code_cache", "_state_solver", "_state_examples", "_state_fingerprints"):
+            del d[a]
+        return d
+
+    def __setstate__(self, d):
+        self.__dict__.update(d)
+        self._clear_code_caches()
 
     def add_query(self, q : Query):
         """
@@ -177,11 +246,53 @@ class Implementation(object):
                     state_update_stm = self._add_subquery(sub_q=modified_handles, used_by=state_update_stm)
                 self.handle_updates[(t, op.name)] = state_update_stm
 
+    def _state_fingerprint(self, e):
+        """
+        Fingerprint of `e` on the examples found by _equivalent_state_var, or
+        None if `e` reads a variable or calls a function that some example
+        does not define.
+        """
+        if e in self._state_fingerprints:
+            return self._state_fingerprints[e]
+        if all(_defines_everything_in(ex, e) for ex in self._state_examples):
+            fp = fingerprint(e, self._state_examples)
+        else:
+            fp = None
+        self._state_fingerprints[e] = fp
+        return fp
+
+    def _equivalent_state_var(self, e : Exp) -> EVar:
+        """
+        Find a concrete state var whose value always equals `e`. Only state
+        vars that agree with `e` on every example found so far are checked
+        with the solver; each refuted candidate becomes a new example.
+        """
+        if self._state_solver is None:
+            from cozy.solver import IncrementalSolver
+            # Models are only used as examples to skip solver calls, and are
+            # checked below, so the solver need not validate them.
+            self._state_solver = IncrementalSolver(vars=self.abstract_state, validate_model=False)
+            self._state_solver.add_assumption(EAll(self.spec.assumptions))
+        for (vv, ee) in self.concrete_state:
+            if e.type != ee.type:
+                continue
+            fp1 = self._state_fingerprint(e)
+            fp2 = self._state_fingerprint(ee)
+            if fp1 is not None and fp2 is not None and fp1 != fp2:
+                continue
+            same = EEq(e, ee)
+            model = self._state_solver.satisfy(ENot(same))
+            if model is None:
+                return vv
+            if _defines_everything_in(model, same) and not eval(same, model):
+                self._state_examples.append(model)
+                self._state_fingerprints.clear()
+        return None
+
     def set_impl(self, q : Query, rep : [(EVar, Exp)], ret : Exp):
         to_remove = set()
-        from cozy.solver import valid
         for (v, e) in rep:
-            aeq = find_one(vv for (vv, ee) in self.concrete_state if e.type == ee.type and valid(EImplies(EAll(self.spec.assumptions), EEq(e, ee))))
+            aeq = self._equivalent_state_var(e)
             # aeq = find_one(vv for (vv, ee) in self.concrete_state if e.type == ee.type and alpha_equivalent(e, ee))
             if aeq is not None:
                 print("########### state var {} is equivalent to {}".format(v.id, aeq.id))
@@ -193,84 +304,122 @@ class Implementation(object):
         self.query_impls[q.name] = rewrite_ret(q, lambda prev: ret, keep_assumptions=False)
         op_deltas = { op.name : inc.delta_form(self.spec.statevars, op) for op in self.op_specs }
 
+        tasks = []
         for op in self.op_specs:
             # print("###### INCREMENTALIZING: {}".format(op.name))
             delta = op_deltas[op.name]
             for new_member, projection in rep:
-                (state_update_stm, subqueries) = inc.sketch_update(
+                tasks.append((op.name, new_member, (
                     new_member,
                     projection,
                     subst(projection, delta),
                     self.abstract_state,
-                    list(op.assumptions))
-                for sub_q in subqueries:
-                    sub_q.docstring = "[{}] {}".format(op.name, sub_q.docstring)
-                    state_update_stm = self._add_subquery(sub_q=sub_q, used_by=state_update_stm)
-                self.updates[(new_member, op.name)] = state_update_stm
+                    list(op.assumptions))))
 
-    @property
-    def code(self) -> Spec:
-
-        state_read_by_query = {
-            query_name : free_vars(query)
-            for query_name, query in self.query_impls.items() }
+        if parallel_incrementalization.value > 0 and len(tasks) > 1:
+            results = _parallel_sketch_updates(parallel_incrementalization.value, [args for (_, _, args) in tasks])
+        else:
+            results = [inc.sketch_update(*args) for (_, _, args) in tasks]
+
+        # Subqueries are added in the same order as if the ops had been
+        # incrementalized one after another.
+        for ((op_name, new_member, _), (state_update_stm, subqueries)) in zip(tasks, results):
+            for sub_q in subqueries:
+                sub_q.docstring = "[{}] {}".format(op_name, sub_q.docstring)
+                state_update_stm = self._add_subquery(sub_q=sub_q, used_by=state_update_stm)
+            self.updates[(new_member, op_name)] = state_update_stm
+
+    def _state_read_by_queries(self):
+        res = { }
+        for query_name, query in self.query_impls.items():
+            cached = self._reads_cache.get(query_name)
+            if cached is not None and cached[0] is query:
+                res[query_name] = cached[1]
+            else:
+                res[query_name] = frozenset(free_vars(query))
+        self._reads_cache = { query_name : (query, res[query_name]) for query_name, query in self.query_impls.items() }
+        return res
+
+    def _op_code(self, operator, state_read_by_query, query_names):
+        """
+        Returns (temps, stms) for the given op: declarations for values that
+        need to be read before any state is written, followed by the update
+        code for each concrete state var, in order. The result is cached
+        until the update code (or anything it reads) changes.
+        """
 
         def queries_used_by(stm):
             for e in all_exps(stm):
-                if isinstance(e, ECall) and e.func in [q.name for q in self.query_specs]:
+                if isinstance(e, ECall) and e.func in query_names:
                     yield e.func
 
-        # prevent read-after-write by lifting reads before writes.
-
-        # list of SDecls
-        temps = defaultdict(list)
-        updates = dict(self.updates)
-
-        for operator in self.op_specs:
-            # Compute order constraints between statements:
-            #   v1 -> v2 means that the update code for v1 should (if possible)
-            #   appear before the update code for v2
-            #   (i.e. the update code for v1 reads v2)
-            g = igraph.Graph().as_directed()
-            g.add_vertices(len(self.concrete_state))
-            for (i, (v1, _)) in enumerate(self.concrete_state):
-                v1_update_code = self.updates[(v1, operator.name)]
-                v1_queries = list(queries_used_by(v1_update_code))
-                for (j, (v2, _)) in enumerate(self.concrete_state):
-                    # if v1_update_code reads v2...
-                    if any(v2 in state_read_by_query[q] for q in v1_queries):
-                        # then v1->v2
-                        g.add_edges([(i, j)])
-
-            # Find the minimum set of edges we need to break (see "feedback arc
-            # set problem")
-            edges_to_break = safe_feedback_arc_set(g, method="ip")
-            g.delete_edges(edges_to_break)
-            ordered_concrete_state = [self.concrete_state[i] for i in g.topological_sorting(mode="OUT")]
-
-            # Lift auxiliary declarations as needed
-            things_updated = []
-            for v, _ in ordered_concrete_state:
-                things_updated.append(v)
-                stm = updates[(v, operator.name)]
-
-                for e in all_exps(stm):
-                    if isinstance(e, ECall) and e.func in [q.name for q in self.query_specs]:
-                        problems = set(things_updated) & state_read_by_query[e.func]
-
-                        if problems:
-                            name = fresh_name()
-                            temps[operator.name].append(SDecl(name, e))
-                            stm = replace(stm, e, EVar(name).with_type(e.type))
-                            updates[(v, operator.name)] = stm
+        state_vars = tuple(v for (v, _) in self.concrete_state)
+        update_code = tuple(self.updates[(v, operator.name)] for v in state_vars)
+        queries_used = [OrderedSet(queries_used_by(stm)) for stm in update_code]
+        key = (state_vars, update_code, frozenset(
+            (q, state_read_by_query[q]) for qs in queries_used for q in qs))
+
+        cached = self._op_code_cache.get(operator.name)
+        if cached is not None and cached[0] == key:
+            return cached[1], cached[2]
+
+        # Compute order constraints between statements:
+        #   v1 -> v2 means that the update code for v1 should (if possible)
+        #   appear before the update code for v2
+        #   (i.e. the update code for v1 reads v2)
+        g = igraph.Graph().as_directed()
+        g.add_vertices(len(state_vars))
+        for (i, v1_queries) in enumerate(queries_used):
+            for (j, v2) in enumerate(state_vars):
+                # if v1_update_code reads v2...
+                if any(v2 in state_read_by_query[q] for q in v1_queries):
+                    # then v1->v2
+                    g.add_edges([(i, j)])
+
+        # Find the minimum set of edges we need to break (see "feedback arc
+        # set problem").  The exact solution is an integer program, so large
+        # graphs use Eades' heuristic instead.
+        method = "ip" if len(state_vars) <= exact_ordering_limit.value else "eades"
+        edges_to_break = safe_feedback_arc_set(g, method=method)
+        g.delete_edges(edges_to_break)
+        order = g.topological_sorting(mode="OUT")
+
+        # Prevent read-after-write by lifting reads before writes.
+        temps = []
+        stms = []
+        things_updated = []
+        for i in order:
+            v = state_vars[i]
+            things_updated.append(v)
+            stm = update_code[i]
+
+            for e in all_exps(stm):
+                if isinstance(e, ECall) and e.func in query_names:
+                    problems = set(things_updated) & state_read_by_query[e.func]
+
+                    if problems:
+                        name = fresh_name()
+                        temps.append(SDecl(name, e))
+                        stm = replace(stm, e, EVar(name).with_type(e.type))
+            stms.append(stm)
+
+        self._op_code_cache[operator.name] = (key, temps, stms)
+        return temps, stms
+
+    @property
+    def code(self) -> Spec:
+
+        state_read_by_query = self._state_read_by_queries()
+        query_names = set(q.name for q in self.query_specs)
 
         # construct new op implementations
         new_ops = []
         for op in self.op_specs:
 
-            stms = [ updates[(v, op.name)] for (v, _) in ordered_concrete_state ]
+            temps, stms = self._op_code(op, state_read_by_query, query_names)
+            stms = list(stms)
             stms.extend(hup for ((t, op_name), hup) in self.handle_updates.items() if op.name == op_name)
-            new_stms = seq(temps[op.name] + stms)
+            new_stms = seq(temps + stms)
             new_ops.append(Op(
                 op.name,
                 op.args,
@@ -0,0 +1,181 @@
+"""
+Parallel enumeration of candidate expressions.
+
+When the "--parallel-enumeration" option is greater than one, each minor
+iteration of the Learner is split across that many worker subprocesses.
+Every worker keeps a read-only copy of the cache, which is brought up to
+date at the start of each iteration by sending only the entries added and
+evicted since the previous one. Each worker runs the whole builder
+pipeline (production rules, binder fixup, well-formedness checks), but only
+for its own share of the raw productions: the i-th expression
+produced by the innermost builder goes to worker i mod N. The outputs are
+merged back into the order a serial run would have produced them, and
+duplicates are dropped, before they reach the Learner.
+
+Running this module as a script starts a worker.
+"""
+
+import pickle
+
+from cozy import common, opts
+from cozy.jobs import SubprocessWorker, WorkerDied, WorkerInterrupted, serve
+from cozy.syntax_tools import alpha_key
+
+from .cache import Cache
+from .core import ExpBuilder, StopException
+
+# Each worker draws fresh names from its own block of this many names, so
+# that its fresh variables never collide with the parent's or each other's.
+_FRESH_NAME_BLOCK = 1 << 32
+
+class ShardedBuilder(ExpBuilder):
+    """
+    Pass-through builder that, once `shard` is set, only yields every
+    `nshards`-th expression of the wrapped builder. `last_index` is the
+    position of the most recently yielded expression in the wrapped
+    builder's output.
+    """
+    def __init__(self, wrapped_builder):
+        self.wrapped_builder = wrapped_builder
+        self.shard = None
+        self.nshards = 1
+        self.last_index = -1
+    def build(self, cache, size):
+        for i, tup in enumerate(self.wrapped_builder.build(cache, size)):
+            if self.shard is None or i % self.nshards == self.shard:
+                self.last_index = i
+                yield tup
+
+def _run_shard(builder, sharder, cache, size, shard, nshards):
+    sharder.shard = shard
+    sharder.nshards = nshards
+    res = []
+    for (e, pool) in builder.build(cache, size):
+        res.append((sharder.last_index, e, pool))
+    return res
+
+# The worker's copy of the coordinator's cache.
+_CACHE = None
+
+def handle(request):
+    """Handle a request in the worker process."""
+    global _CACHE
+    (payload, fresh_base, shard) = request
+    (options, builder, sharder, (full, added, evicted), size, nshards) = pickle.loads(payload)
+    opts.restore(options)
+    with common._i.get_lock():
+        common._i.value = fresh_base
+    if full:
+        _CACHE = Cache(binders=[], args=[])
+    for (e, sz, pool) in evicted:
+        _CACHE.evict(e, size=sz, pool=pool)
+    for (e, sz, pool) in added:
+        _CACHE.add(e, size=sz, pool=pool)
+    return _run_shard(builder, sharder, _CACHE, size, shard, nshards)
+
+class ParallelBuilder(ExpBuilder):
+    """
+    Runs `wrapped_builder` across `nworkers` subprocesses. `sharder` must be
+    the ShardedBuilder at the bottom of `wrapped_builder`.
+    """
+    def __init__(self, wrapped_builder, sharder : ShardedBuilder, nworkers : int, stop_callback = None):
+        self.wrapped_builder = wrapped_builder
+        self.sharder = sharder
+        self.nworkers = nworkers
+        self.stop_callback = stop_callback
+        self.workers = []
+        self.synced = [] # synced[i] is true if worker i has the entries in self.sent
+        self.sent_cache = None
+        self.sent = { } # maps (id(e), size, pool) to (e, size, pool) for the entries sent so far
+    def _cache_update(self, cache):
+        """
+        Returns (full, added, evicted) for the workers that are in sync:
+        whether they should start from an empty cache, and the entries of
+        `cache` that are new or gone since the previous call.
+        """
+        current = { (id(e), size, pool) : (e, size, pool) for (e, size, pool) in cache }
+        full = cache is not self.sent_cache
+        if full:
+            added = list(current.values())
+            evicted = []
+        else:
+            added = [x for (k, x) in current.items() if k not in self.sent]
+            evicted = [x for (k, x) in self.sent.items() if k not in current]
+        self.sent_cache = cache
+        self.sent = current
+        return (full, added, evicted)
+    def _new_worker(self, shard):
+        worker = SubprocessWorker("cozy.synthesis.parallel")
+        if shard < len(self.workers):
+            self.workers[shard] = worker
+            self.synced[shard] = False
+        else:
+            self.workers.append(worker)
+            self.synced.append(False)
+    def build(self, cache, size):
+        nshards = self.nworkers
+        while len(self.workers) < nshards:
+            self._new_worker(len(self.workers))
+
+        with common._i.get_lock():
+            fresh_base = common._i.value
+            common._i.value += nshards * _FRESH_NAME_BLOCK
+
+        # The bulk of each request is the same for every worker, so it is
+        # only pickled once (twice if a new worker needs the whole cache).
+        update = self._cache_update(cache)
+        payloads = { }
+        def payload(synced):
+            full, added, evicted = update if synced else (True, list(self.sent.values()), [])
+            if full not in payloads:
+                payloads[full] = pickle.dumps((opts.snapshot(), self.wrapped_builder, self.sharder, (full, added, evicted), size, nshards))
+            return payloads[full]
+        started = []
+        for shard in range(nshards):
+            worker = self.workers[shard]
+            try:
+                worker.send((payload(self.synced[shard]), fresh_base + shard * _FRESH_NAME_BLOCK, shard))
+                self.synced[shard] = True
+                started.append(shard)
+            except WorkerDied:
+                pass
+
+        results = []
+        try:
+            for shard in range(nshards):
+                worker = self.workers[shard]
+                if shard in started:
+                    try:
+                        results.extend(worker.recv(stop_callback=self.stop_callback))
+                        continue
+                    except WorkerDied:
+                        pass
+                print("Warning: enumeration worker died (exit code {})".format(worker.proc.poll()))
+                worker.kill()
+                self._new_worker(shard)
+                # do the work of the dead worker ourselves
+                try:
+                    results.extend(_run_shard(self.wrapped_builder, self.sharder, cache, size, shard, nshards))
+                finally:
+                    self.sharder.shard = None
+        except WorkerInterrupted:
+            self.close()
+            raise StopException()
+
+        results.sort(key=lambda x: x[0])
+        seen = set()
+        for (i, e, pool) in results:
+            k = (pool, e.type, alpha_key(e))
+            if k in seen:
+                continue
+            seen.add(k)
+            yield (e, pool)
+
+    def close(self):
+        for w in self.workers:
+            w.kill()
+        self.workers = []
+        self.synced = []
+
+if __name__ == "__main__":
+    serve(handle)
@@ -1,15 +1,27 @@
+from collections import OrderedDict
 import itertools
 
 from cozy.common import typechecked
 from cozy.typecheck import is_collection, is_scalar, is_numeric
 from cozy.target_syntax import *
-from cozy.syntax_tools import enumerate_fragments2, pprint, free_vars
-from cozy.solver import valid
+from cozy.syntax_tools import enumerate_fragments2, pprint, free_vars, alpha_key
+from cozy.solver import valid, collection_depth_opt
 from cozy.pools import RUNTIME_POOL, STATE_POOL
 from cozy.opts import Option
+from cozy.instrumentation import timed
 
 allow_conditional_state = Option("allow-conditional-state", bool, False)
 
+# Maximum number of verdicts to remember.
+_MAX_VERDICTS = 100000
+
+# Memoized verdicts of exp_wf_nonrecursive, shared by exp_wf and direct
+# callers. Maps a key describing an expression and its context (see _key) to
+# None (well-formed) or the reason the expression is not well-formed. The
+# solver calls behind a verdict are covered by it and need no memo of their
+# own.
+_VERDICTS = OrderedDict()
+
 class ExpIsNotWf(Exception):
     def __init__(self, e, offending_subexpression, reason):
         super().__init__(reason)
@@ -17,8 +29,81 @@ class ExpIsNotWf(Exception):
         self.offending_subexpression = offending_subexpression
         self.reason = reason
 
+def type_wf(t : Type) -> bool:
+    """
+    Returns False if no expression of type `t` is well-formed (see
+    exp_wf_nonrecursive).
+    """
+    if is_collection(t) and is_collection(t.t):
+        return False
+    if isinstance(t, TMap) and (not is_scalar(t.k) or isinstance(t.v, TMap)):
+        return False
+    return True
+
+def may_be_wf(exp_class, t : Type, pool : int, op : str = None) -> bool:
+    """
+    A cheap syntactic check that can be done before an expression is built.
+    Returns False if every expression of class `exp_class` (with operator
+    `op`, for binary operators) and type `t` is rejected by
+    exp_wf_nonrecursive in `pool`, regardless of its children. The type may
+    be None if it is not known yet.
+    """
+    if t is not None and not type_wf(t):
+        return False
+    if pool == RUNTIME_POOL:
+        return True
+    if exp_class in (EStateVar, EWithAlteredValue, EDropFront, EDropBack, EFlatMap, ESingleton):
+        return False
+    if exp_class is EBinOp and (is_numeric(t) or (op == "-" and is_collection(t))):
+        return False
+    if exp_class is ECond and not allow_conditional_state.value:
+        return False
+    return True
+
+def _key(e, pool, facts, env_key):
+    # Expressions are memoized on their alpha-normal form, their type (which
+    # the alpha-normal form ignores), and everything else that
+    # exp_wf_nonrecursive looks at, including the options it reads.
+    return (alpha_key(e), e.type, pool, tuple(alpha_key(f) for f in facts), env_key,
+        allow_conditional_state.value, collection_depth_opt.value)
+
+def _check(e, state_vars, args, pool, facts, assumptions, env_key):
+    """
+    Memoized exp_wf_nonrecursive on `e` under `facts` and `assumptions`.
+    Returns None if it is well-formed and the reason otherwise.
+    """
+    key = _key(e, pool, facts, env_key)
+    if key in _VERDICTS:
+        _VERDICTS.move_to_end(key)
+        return _VERDICTS[key]
+    try:
+        _exp_wf_nonrecursive(e, state_vars, args, pool, assumptions=EAll(itertools.chain(facts, (assumptions,))))
+        reason = None
+    except ExpIsNotWf as exc:
+        reason = exc.reason
+    _VERDICTS[key] = reason
+    if len(_VERDICTS) > _MAX_VERDICTS:
+        _VERDICTS.popitem(last=False)
+    return reason
+
+def verdict_count() -> int:
+    """Returns the number of memoized well-formedness verdicts."""
+    return len(_VERDICTS)
+
+def forget_verdicts(keep : int = 0):
+    """Forgets the least recently used verdicts until at most `keep` remain."""
+    while len(_VERDICTS) > keep:
+        _VERDICTS.popitem(last=False)
+
+@timed("wf")
 @typechecked
 def exp_wf_nonrecursive(e : Exp, state_vars : {EVar}, args : {EVar}, pool = RUNTIME_POOL, assumptions : Exp = T):
+    env_key = (frozenset(state_vars), frozenset(args), alpha_key(assumptions))
+    reason = _check(e, state_vars, args, pool, (), assumptions, env_key)
+    if reason is not None:
+        raise ExpIsNotWf(e, e, reason)
+
+def _exp_wf_nonrecursive(e, state_vars, args, pool, assumptions):
     at_runtime = pool == RUNTIME_POOL
     if isinstance(e, EStateVar) and not at_runtime:
         raise ExpIsNotWf(e, e, "EStateVar in state pool position")
@@ -78,15 +163,16 @@ def exp_wf_nonrecursive(e : Exp, state_vars : {EVar}, args : {EVar}, pool = RUNT
             # raise ExpIsNotWf(e, e, "non-polynomial-sized map ({}); total_size={}, this_size={}".format(model, eval(total_size, model), eval(my_size, model)))
             raise ExpIsNotWf(e, e, "non-polynomial-sized map")
 
+@timed("wf")
 @typechecked
 def exp_wf(e : Exp, state_vars : {EVar}, args : {EVar}, pool = RUNTIME_POOL, assumptions : Exp = T):
     """
     Returns True or throws exception indicating why `e` is not well-formed.
     """
+    env_key = (frozenset(state_vars), frozenset(args), alpha_key(assumptions))
     for ctx in enumerate_fragments2(e):
         p = ctx.pool if pool == RUNTIME_POOL else STATE_POOL
-        try:
-            exp_wf_nonrecursive(ctx.e, state_vars, args, p, assumptions=EAll(itertools.chain(ctx.facts, (assumptions,))))
-        except ExpIsNotWf as exc:
-            raise ExpIsNotWf(e, ctx.e, exc.reason)
+        reason = _check(ctx.e, state_vars, args, p, ctx.facts, assumptions, env_key)
+        if reason is not None:
+            raise ExpIsNotWf(e, ctx.e, reason)
     return True
@@ -1,6 +1,6 @@
 import unittest
 
-from cozy.syntax_tools import alpha_equivalent, pprint, mk_lambda
+from cozy.syntax_tools import alpha_equivalent, alpha_key, pprint, mk_lambda
 from cozy.target_syntax import *
 
 class TestAlphaEquivalent(unittest.TestCase):
@@ -68,3 +68,28 @@ class TestAlphaEquivalent(unittest.TestCase):
         assert not alpha_equivalent(
             EMakeRecord((("x", ENum(0)), ("y", T))),
             EMakeRecord((("y", T), ("x", ENum(0)))))
+
+    def test_alpha_key_agrees(self):
+        x = EVar("x").with_type(TInt())
+        y = EVar("y").with_type(TInt())
+        l = EVar("l").with_type(TBag(TInt()))
+        es = [
+            x, y,
+            ELambda(x, ELambda(y, x)),
+            ELambda(x, ELambda(x, x)),
+            ELambda(y, ELambda(x, y)),
+            EMap(l, ELambda(x, y)),
+            EMap(l, ELambda(y, y)),
+            EMap(l, ELambda(x, x)),
+            EListComprehension(x, (CPull("x", l),)),
+            EListComprehension(y, (CPull("y", l),)),
+            EListComprehension(x, (CPull("y", l), CPull("x", l))),
+            EListComprehension(y, (CPull("x", l), CPull("y", l))),
+            EListComprehension(y, (CPull("y", l), CPull("x", l))),
+            EListComprehension(x, (CPull("x", l), CCond(EEq(x, y)))),
+            EMakeRecord((("x", ENum(0)), ("y", T))),
+            EMakeRecord((("z", ENum(0)), ("y", T))),
+        ]
+        for e1 in es:
+            for e2 in es:
+                assert alpha_equivalent(e1, e2) == (alpha_key(e1) == alpha_key(e2)), "{} vs {}".format(pprint(e1), pprint(e2))
@@ -1,12 +1,13 @@
 import unittest
 import itertools
 
-from cozy.cost_model import Cost, CompositeCostModel, debug_comparison, cardinality_le
+from cozy.cost_model import Cost, CompositeCostModel, SymbolicCost, debug_comparison, cardinality_le
 from cozy.typecheck import INT, retypecheck
 from cozy.target_syntax import *
 from cozy.syntax_tools import equal, implies, pprint, fresh_var, mk_lambda, replace, subst
 from cozy.solver import valid
 from cozy.pools import RUNTIME_POOL, STATE_POOL
+from cozy.solver_cache import canonical_text
 
 cm = CompositeCostModel()
 def cost_of(e, pool=RUNTIME_POOL):
@@ -598,3 +599,26 @@ class TestCostModel(unittest.TestCase):
         e1 = EUnaryOp(UOp.Empty, EStateVar(v).with_type(v.type)).with_type(BOOL)
         e2 = EUnaryOp(UOp.Empty, emp).with_type(BOOL)
         assert_cmp(e1, cost_of(e1), e2, cost_of(e2), Cost.WORSE)
+
+    def test_comparison_key_ignores_fresh_names(self):
+        xs = EVar("xs").with_type(INT_BAG)
+        x = EVar("x").with_type(INT)
+        e = EFilter(xs, ELambda(x, EEq(x, ZERO))).with_type(xs.type)
+        k1 = canonical_text(cost_of(e).comparison_key(), fixed={xs.id})
+        k2 = canonical_text(cost_of(e).comparison_key(), fixed={xs.id})
+        assert k1 == k2
+        ys = EVar("ys").with_type(INT_BAG)
+        k3 = canonical_text(cost_of(subst(e, {xs.id: ys})).comparison_key(), fixed={xs.id, ys.id})
+        assert k1 != k3
+
+    def test_refuted_by_samples(self):
+        n = EVar("n").with_type(INT)
+        m = EVar("m").with_type(INT)
+        xs = EVar("xs").with_type(INT_BAG)
+        ys = EVar("ys").with_type(INT_BAG)
+        c1 = SymbolicCost(EBinOp(n, "*", n).with_type(INT), { xs : n })
+        c2 = SymbolicCost(m, { ys : m })
+        cards = EAll([EBinOp(n, ">", ENum(1000).with_type(INT)).with_type(BOOL), EBinOp(n, "<=", m).with_type(BOOL)])
+        assert c1.refuted_by_samples(c2, cards) == (True, False)
+        assert c2.refuted_by_samples(c1, cards) == (False, True)
+        assert c1.refuted_by_samples(c1, cards) == (False, False)
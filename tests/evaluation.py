@@ -2,7 +2,8 @@ import unittest
 
 from cozy.target_syntax import *
 from cozy.syntax_tools import *
-from cozy.evaluation import eval, Bag, Map, cmp, EQ, LT, GT
+from cozy.common import save_property
+from cozy.evaluation import eval, eval_bulk, Bag, Map, Handle, cmp, EQ, LT, GT, columnar_evaluation, compile_cache_stats
 from cozy.typecheck import retypecheck
 
 zero = ENum(0).with_type(INT)
@@ -40,3 +41,39 @@ class TestEvaluation(unittest.TestCase):
         m = Map(TMap(THandle('Entry', TRecord((('key', TNative('uint64_t')), ('pixmap', TNative('QPixmap *')), ('indexData', TNative('QByteArray')), ('memSize', TInt()), ('diskSize', TInt()), ('st', TEnum(('Disk', 'Loading', 'DiskAndMemory', 'MemoryOnly', 'Saving', 'NetworkPending', 'IndexPending', 'Invalid'))), ('inUse', TBool())))), TEnum(('Disk', 'Loading', 'DiskAndMemory', 'MemoryOnly', 'Saving', 'NetworkPending', 'IndexPending', 'Invalid'))), 'Disk', [])
         assert m == m
         assert cmp(m.type, m, m) == EQ
+
+    def test_columnar_agrees_with_scalar(self):
+        x = EVar("x").with_type(INT)
+        y = EVar("y").with_type(INT)
+        b = EVar("b").with_type(BOOL)
+        xs = EVar("xs").with_type(INT_BAG)
+        h = EVar("h").with_type(THandle("H", INT))
+        envs = [
+            { x.id: i, y.id: j, b.id: (i + j) % 2 == 0, xs.id: Bag(range(j)), h.id: Handle(i, j) }
+            for i in range(-2, 3) for j in range(4) ]
+        es = [
+            EBinOp(EBinOp(x, "+", y).with_type(INT), "*", x).with_type(INT),
+            EBinOp(x, "<=", y).with_type(BOOL),
+            EBinOp(b, "or", EBinOp(x, ">", ZERO).with_type(BOOL)).with_type(BOOL),
+            ECond(b, EUnaryOp(UOp.Length, xs).with_type(INT), EUnaryOp("-", y).with_type(INT)).with_type(INT),
+            ETupleGet(ETuple((x, EFilter(xs, ELambda(y, EBinOp(y, ">", x).with_type(BOOL))).with_type(INT_BAG))).with_type(TTuple((INT, INT_BAG))), 1).with_type(INT_BAG),
+            EBinOp(EGetField(h, "val").with_type(INT), "==", EUnaryOp(UOp.Sum, xs).with_type(INT)).with_type(BOOL),
+            EUnaryOp(UOp.The, xs).with_type(INT),
+            ECond(EUnaryOp(UOp.Empty, xs).with_type(BOOL), ZERO, EListGet(EUnaryOp(UOp.Reversed, xs).with_type(TList(INT)), ZERO).with_type(INT)).with_type(INT)]
+        for e in es:
+            with save_property(columnar_evaluation, "value"):
+                columnar_evaluation.value = False
+                expected = eval_bulk(e, envs)
+            assert eval_bulk(e, envs) == expected, pprint(e)
+
+    def test_compile_cache(self):
+        x = EVar("x").with_type(INT)
+        e = EBinOp(x, "+", ONE).with_type(INT)
+        before = compile_cache_stats()
+        assert eval_bulk(e, [{x.id: 1}, {x.id: 2}]) == [2, 3]
+        assert eval_bulk(e, [{x.id: 3}]) == [4]
+        after = compile_cache_stats()
+        assert after["misses"] == before["misses"] + 1
+        assert after["hits"] == before["hits"] + 1
+        assert eval_bulk(EBinOp(x, "+", ONE).with_type(INT), [{x.id: 3}], use_cache=False) == [4]
+        assert compile_cache_stats() == after
@@ -0,0 +1,54 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+
+from cozy import instrumentation
+
+class TestInstrumentation(unittest.TestCase):
+
+    def test_exclusive_phases(self):
+        instrumentation.reset()
+        with instrumentation.phase("cost"):
+            time.sleep(0.02)
+            with instrumentation.phase("wf"):
+                time.sleep(0.05)
+        times = instrumentation.end_iteration()
+        assert 0.05 <= times["wf"] < 0.07, times
+        assert 0.02 <= times["cost"] < 0.04, times
+        assert instrumentation.end_iteration() == {}
+        assert instrumentation.total_times().keys() == {"cost", "wf"}
+
+    def test_timed_iter(self):
+        instrumentation.reset()
+        def slow():
+            for i in range(3):
+                time.sleep(0.01)
+                yield i
+        assert list(instrumentation.timed_iter(slow(), "enumeration")) == [0, 1, 2]
+        assert instrumentation.end_iteration()["enumeration"] >= 0.03
+
+    def test_summarize(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "q.trace.jsonl")
+            instrumentation.start_trace(path, query="q")
+            instrumentation.emit("minor_iteration", size=0, phases={"cost": 1.0})
+            instrumentation.emit("minor_iteration", size=1, phases={"cost": 2.0, "wf": 0.5})
+            instrumentation.stop_trace()
+            with open(os.path.join(d, "r.trace.jsonl"), "w") as f:
+                f.write(json.dumps({"event": "minor_iteration", "query": "r", "phases": {"cost": 1.0}}) + "\n")
+                f.write(json.dumps({"event": "job", "query": "r", "phases": {"cost": 4.0}}) + "\n")
+            assert instrumentation.summarize([d]) == {
+                "q": {"cost": 3.0, "wf": 0.5},
+                "r": {"cost": 4.0}}
+
+    def test_listeners(self):
+        records = []
+        instrumentation.add_listener(records.append)
+        try:
+            instrumentation.emit("target", cost="1", size=3)
+        finally:
+            instrumentation.remove_listener(records.append)
+        instrumentation.emit("target", cost="0", size=1)
+        assert [(r["event"], r["cost"], r["size"]) for r in records] == [("target", "1", 3)]
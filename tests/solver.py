@@ -1,10 +1,18 @@
+import contextlib
+import io
 import unittest
+import os
+import tempfile
 
-from cozy.common import OrderedSet
+import z3
+
+from cozy.common import OrderedSet, save_property
 from cozy.solver import satisfy, valid, satisfiable, IncrementalSolver
 from cozy.typecheck import typecheck, retypecheck
 from cozy.target_syntax import *
-from cozy.syntax_tools import pprint, equal, implies, mk_lambda
+from cozy.syntax_tools import pprint, equal, implies, mk_lambda, subst
+from cozy.solver_cache import canonical_text, current_cache, solver_cache_path
+from cozy.solver_worker import solver_workers
 from cozy.evaluation import eval, Bag, Handle
 
 zero = ENum(0).with_type(TInt())
@@ -466,3 +474,157 @@ class TestSolver(unittest.TestCase):
         s.satisfy(e1)
         s.satisfy(e2)
         s.satisfy(e1)
+
+    def test_solver_cache_canonical_text(self):
+        x = EVar("x").with_type(INT)
+        y = EVar("y").with_type(INT)
+        b = EVar("b").with_type(BOOL)
+        assert canonical_text(EEq(x, y)) == canonical_text(EEq(y, x))
+        assert canonical_text(EEq(x, x)) != canonical_text(EEq(x, y))
+        assert canonical_text(EEq(x, x)) != canonical_text(EEq(b, b))
+
+    def test_solver_cache(self):
+        x = EVar("x").with_type(INT)
+        e = EBinOp(x, "<", x).with_type(BOOL)
+        with tempfile.TemporaryDirectory() as d:
+            with save_property(solver_cache_path, "value"):
+                solver_cache_path.value = os.path.join(d, "cache.db")
+                cache = current_cache()
+                assert not satisfiable(e)
+                assert cache.stats() == { "hits": 0, "misses": 1 }
+                assert not satisfiable(subst(e, { x.id : EVar("y").with_type(INT) }))
+                assert cache.stats() == { "hits": 1, "misses": 1 }
+                assert satisfy(e) is None
+                assert valid(ENot(e))
+                assert cache.stats() == { "hits": 3, "misses": 1 }
+                # hits update their last-used times in batches
+                assert cache._touched
+                cache.flush()
+                assert not cache._touched
+                cache.close()
+
+    def test_solver_cache_unavailable(self):
+        x = EVar("x").with_type(INT)
+        e = EBinOp(x, "<", x).with_type(BOOL)
+        with tempfile.TemporaryDirectory() as d:
+            with save_property(solver_cache_path, "value"):
+                # a directory is not a usable database
+                solver_cache_path.value = d
+                err = io.StringIO()
+                with contextlib.redirect_stderr(err):
+                    assert not satisfiable(e)
+                    assert not satisfiable(e)
+                assert err.getvalue().count("solver cache unavailable") == 1
+
+    def test_pooled_solver_var_retyping(self):
+        x = EVar("x").with_type(BOOL)
+        assert satisfiable(x, logic="QF_LIA")
+        assert valid(EEq(x, x), logic="QF_LIA")
+        x = EVar("x").with_type(INT)
+        assert not satisfiable(EBinOp(x, "<", x).with_type(BOOL), logic="QF_LIA")
+        assert valid(EBinOp(x, "<=", x).with_type(BOOL), logic="QF_LIA")
+
+    def test_pooled_solver_matches_fresh_solver(self):
+        from cozy.solver import solver_pool_reuse
+        xs = EVar("xs").with_type(TSet(INT))
+        ys = EVar("ys").with_type(TBag(INT))
+        s = EVar("s").with_type(STRING)
+        x = EVar("x").with_type(INT)
+        queries = [
+            EBinOp(EUnaryOp(UOp.Length, xs).with_type(INT), ">", one).with_type(BOOL),
+            EBinOp(EUnaryOp(UOp.Length, ys).with_type(INT), ">", EUnaryOp(UOp.Length, xs).with_type(INT)).with_type(BOOL),
+            EBinOp(x, BOp.In, xs).with_type(BOOL),
+            ENot(EBinOp(x, BOp.In, EBinOp(xs, "+", ESingleton(x).with_type(TBag(INT))).with_type(TBag(INT))).with_type(BOOL)),
+            EEq(s, EStr("").with_type(STRING)),
+            ENot(EEq(s, s)),
+            EBinOp(x, "<", x).with_type(BOOL)]
+        expected = [IncrementalSolver().satisfiable(q) for q in queries]
+        with save_property(solver_pool_reuse, "value"):
+            solver_pool_reuse.value = 100
+            for i in range(3):
+                assert [satisfiable(q) for q in queries] == expected
+                assert [satisfiable(q) for q in reversed(queries)] == list(reversed(expected))
+        assert expected == [True, True, True, False, True, False, False]
+
+    def test_pooled_solver_reuses_encodings(self):
+        from cozy import solver
+        xs = EVar("xs").with_type(TSet(INT))
+        x = EVar("x").with_type(INT)
+        q1 = EBinOp(EUnaryOp(UOp.Length, xs).with_type(INT), ">", one).with_type(BOOL)
+        q2 = EBinOp(x, BOp.In, xs).with_type(BOOL)
+        pooled = solver._PooledSolver()
+        assert pooled.query(q1, None)
+        encoding = pooled._env[xs.id]
+        assert pooled.query(q2, None)
+        assert pooled._env[xs.id] is encoding
+        assert set(pooled.encodings) == { (xs.id, xs.type), (x.id, x.type) }
+        # each query is checked on its own
+        assert not pooled.query(EBinOp(x, "<", x).with_type(BOOL), None)
+        assert list(pooled.vars) == [x]
+        assert pooled.uses == 3
+
+    def test_pooled_solver_retries_after_z3_failure(self):
+        from cozy import solver
+        x = EVar("x").with_type(INT)
+        e = EBinOp(x, "<", x).with_type(BOOL)
+        assert not satisfiable(e, logic="QF_LIA")
+        failures = [1]
+        query = solver._PooledSolver.query
+        def flaky_query(self, e, stop_callback):
+            if failures:
+                failures.pop()
+                raise z3.Z3Exception("max. memory exceeded")
+            return query(self, e, stop_callback)
+        with save_property(solver._PooledSolver, "query"):
+            solver._PooledSolver.query = flaky_query
+            assert not satisfiable(e, logic="QF_LIA")
+        assert not failures
+
+    def test_solver_workers(self):
+        x = EVar("x").with_type(INT)
+        with save_property(solver_workers, "value"):
+            solver_workers.value = 1
+            assert not satisfiable(EBinOp(x, "<", x).with_type(BOOL))
+            assert valid(EBinOp(x, "<=", x).with_type(BOOL), logic="QF_LIA", timeout=1)
+            xs = EVar("xs").with_type(TBag(INT))
+            e = EAll([EBinOp(x, BOp.In, xs).with_type(BOOL), EBinOp(x, ">", one).with_type(BOOL)])
+            model = satisfy(e)
+            assert model is not None
+            assert eval(e, model)
+            assert satisfy(ENot(EEq(xs, xs))) is None
+
+    def test_solver_workers_stop(self):
+        from cozy.solver import SolverInterrupted
+        x = EVar("x").with_type(INT)
+        with save_property(solver_workers, "value"):
+            solver_workers.value = 1
+            with self.assertRaises(SolverInterrupted):
+                satisfy(EBinOp(x, ">", zero).with_type(BOOL), stop_callback=lambda: True)
+            assert satisfiable(EBinOp(x, ">", zero).with_type(BOOL))
+
+    def test_default_stop_callback(self):
+        import time
+        from cozy.solver import SolverInterrupted, default_stop_callback
+        x, y, z = [EVar(v).with_type(INT) for v in "xyz"]
+        cube = lambda v: EBinOp(EBinOp(v, "*", v).with_type(INT), "*", v).with_type(INT)
+        positive = lambda v: EBinOp(v, ">", zero).with_type(BOOL)
+        # hard enough that Z3 does not answer in a reasonable amount of time
+        e = EAll([positive(x), positive(y), positive(z), EEq(EBinOp(cube(x), "+", cube(y)).with_type(INT), cube(z))])
+        start = time.time()
+        with default_stop_callback(lambda: time.time() > start + 0.5):
+            with self.assertRaises(SolverInterrupted):
+                satisfiable(e)
+            # an explicit callback takes precedence
+            assert satisfiable(positive(x), stop_callback=lambda: False)
+        assert time.time() - start < 30
+        assert satisfiable(positive(x))
+
+    def test_concurrent_solvers(self):
+        from concurrent.futures import ThreadPoolExecutor
+        x = EVar("x").with_type(INT)
+        e = EBinOp(x, "<", x).with_type(BOOL)
+        def check(i):
+            s = IncrementalSolver()
+            return s.satisfiable(e) or satisfiable(EEq(x, ENum(i).with_type(INT)))
+        with ThreadPoolExecutor(max_workers=4) as ex:
+            assert all(ex.map(check, range(16)))
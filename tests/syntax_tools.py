@@ -134,3 +134,38 @@ class TestSyntaxTools(unittest.TestCase):
         assert list(free_vars(SEscapableBlock("label", SDecl("x", ONE)))) == []
         assert list(free_vars(SWhile(T, SDecl("x", ONE)))) == []
         assert list(free_vars(SMapUpdate(T, T, EVar("x"), SSeq(SDecl("y", ONE), use_x)))) == []
+
+    def test_hash_cons(self):
+        x = EVar("x").with_type(INT)
+        e1 = EBinOp(EBinOp(x, "+", ONE).with_type(INT), "*", x).with_type(INT)
+        e2 = EBinOp(EBinOp(EVar("x").with_type(INT), "+", ONE).with_type(INT), "*", EVar("x").with_type(INT)).with_type(INT)
+        e3 = EBinOp(x, "+", ONE).with_type(LONG)
+        h1 = hash_cons(e1)
+        h2 = hash_cons(e2)
+        assert h1 == e1
+        assert h1 is h2
+        assert h1.e1.e1 is h1.e2
+        assert hash_cons(e3) is not h1.e1
+        assert hash_cons(e3).type == LONG
+
+    def test_hash_cons_ignores_cached_attrs(self):
+        x = EVar("x").with_type(INT)
+        xs = EVar("xs").with_type(INT_BAG)
+        mk = lambda: EFilter(xs, ELambda(x, EBinOp(x, ">", ONE).with_type(BOOL))).with_type(INT_BAG)
+        e1 = mk()
+        alpha_hash(e1)
+        alpha_key(e1)
+        assert hash_cons(e1) is hash_cons(mk())
+        e2 = mk()
+        e2._accel = True
+        assert hash_cons(e2) is not hash_cons(e1)
+
+    def test_alpha_hash(self):
+        x = EVar("x").with_type(INT)
+        y = EVar("y").with_type(INT)
+        xs = EVar("xs").with_type(INT_BAG)
+        e1 = EFilter(xs, ELambda(x, EBinOp(x, ">", ONE).with_type(BOOL))).with_type(INT_BAG)
+        e2 = EFilter(xs, ELambda(y, EBinOp(y, ">", ONE).with_type(BOOL))).with_type(INT_BAG)
+        assert alpha_hash(e1) == alpha_hash(e2)
+        assert alpha_equivalent(e1, e2)
+        assert not alpha_equivalent(e1, EFilter(xs, ELambda(x, EBinOp(x, "<", ONE).with_type(BOOL))).with_type(INT_BAG))
@@ -1,12 +1,25 @@
+import contextlib
+import io
+import pickle
+import re
 import unittest
 
-from cozy.syntax_tools import mk_lambda, pprint
+from cozy.syntax_tools import mk_lambda, pprint, free_vars
 from cozy.target_syntax import *
-from cozy.cost_model import CompositeCostModel
+from cozy.cost_model import Cost, CompositeCostModel, PlainCost
 from cozy.typecheck import retypecheck
-from cozy.evaluation import Bag, mkval
-from cozy.synthesis.core import instantiate_examples, fingerprint, improve
-from cozy.synthesis.grammar import BinderBuilder
+from cozy.evaluation import Bag, mkval, compile_cache_stats
+from cozy.common import save_property
+from cozy.wf import exp_wf, verdict_count, forget_verdicts
+from cozy.synthesis.core import instantiate_examples, fingerprint, improve, evaluate_from_children, threaded_verification, incremental
+from cozy.synthesis.grammar import BinderBuilder, operand_pairs
+from cozy.synthesis.cache import Cache, SeenSet, CompactSeenSet
+from cozy.synthesis.parallel import ShardedBuilder, ParallelBuilder, _run_shard
+from cozy.synthesis import parallel
+from cozy.synthesis.high_level_interface import JobMetrics
+from cozy.synthesis.impls import construct_initial_implementation, parallel_incrementalization
+from cozy import parse, typecheck, desugar, common, opts
+from cozy.pools import RUNTIME_POOL, STATE_POOL
 
 handle_type = THandle("H", INT)
 handle1 = (1, mkval(INT))
@@ -14,6 +27,21 @@ handle2 = (2, mkval(INT))
 handle3 = (3, mkval(INT))
 zero = ENum(0).with_type(INT)
 
+def make_learner(cost_model=None, prepare_target=lambda e: e):
+    """
+    A Learner for the query `[x | x <- xs]` over a bag of booleans that are
+    all true. Returns the learner, `x`, and `xs`.
+    """
+    from cozy.synthesis import core
+    x = EVar("x").with_type(BOOL)
+    xs = EVar("xs").with_type(TBag(BOOL))
+    target = EFilter(EStateVar(xs), ELambda(x, x))
+    assumptions = EUnaryOp(UOp.All, xs)
+    assert retypecheck(target)
+    assert retypecheck(assumptions)
+    learner = core.Learner(prepare_target(target), assumptions, [x], [xs], [], [xs, x], [], cost_model or CompositeCostModel(), BinderBuilder([x], [xs], []), lambda: False, [], solver=None)
+    return (learner, x, xs)
+
 class TestSynthesisCore(unittest.TestCase):
 
     def test_instantiate_examples_empty(self):
@@ -39,6 +67,43 @@ class TestSynthesisCore(unittest.TestCase):
             res = r
         assert should_stop()
 
+    def test_threaded_verification(self):
+        x = EVar("x").with_type(BOOL)
+        xs = EVar("xs").with_type(TBag(BOOL))
+        target = EFilter(EStateVar(xs), ELambda(x, x))
+        assumptions = EUnaryOp(UOp.All, xs)
+        assert retypecheck(target)
+        assert retypecheck(assumptions)
+        with save_property(threaded_verification, "value"), save_property(incremental, "value"):
+            threaded_verification.value = True
+            for incremental.value in (False, True):
+                res = None
+                def should_stop():
+                    return res == EStateVar(EVar("xs"))
+                for r in improve(target, assumptions, [x], [xs], [], CompositeCostModel(), BinderBuilder([x], [xs], []), stop_callback=should_stop):
+                    print(pprint(r))
+                    res = r
+                assert should_stop()
+
+    def test_cost_checker_stop(self):
+        from cozy.solver import SolverInterrupted
+        from cozy.synthesis import core
+        x = EVar("x").with_type(BOOL)
+        xs = EVar("xs").with_type(TBag(BOOL))
+        target = EFilter(EStateVar(xs), ELambda(x, x))
+        assert retypecheck(target)
+        cm = CompositeCostModel()
+        target_cost = cm.cost(target, RUNTIME_POOL)
+        stop = [False]
+        checker = core._CostChecker(cm, T, None, lambda: stop[0])
+        try:
+            assert checker.submit(EStateVar(xs).with_type(xs.type), target_cost).result()[1] == Cost.BETTER
+            stop[0] = True
+            with self.assertRaises(SolverInterrupted):
+                checker.submit(EStateVar(xs).with_type(xs.type), target_cost).result()
+        finally:
+            checker.close()
+
     def test_incomplete_binders_list(self):
         res = None
         x = EVar("x").with_type(BOOL)
@@ -68,3 +133,327 @@ class TestSynthesisCore(unittest.TestCase):
             print(pprint(r))
             res = r
         assert should_stop()
+
+    def test_watch_leaves_shared_nodes_alone(self):
+        from cozy.syntax_tools import hash_cons, all_exps
+        learner, x, xs = make_learner(prepare_target=hash_cons)
+        target = learner.target
+        assert any(hasattr(e, "_root") for (e, pool) in learner.roots)
+        assert not any(hasattr(e, "_root") for e in all_exps(target))
+        assert not any(hasattr(e, "_root") for e in all_exps(hash_cons(target)))
+
+    def test_cost_comparison_memo(self):
+        from cozy.synthesis import core
+        cm = CompositeCostModel()
+        learner, x, xs = make_learner(cm)
+        c1 = cm.cost(learner.target, RUNTIME_POOL)
+        c2 = cm.cost(EStateVar(xs).with_type(xs.type), RUNTIME_POOL)
+        c3 = cm.cost(EStateVar(EFilter(xs, ELambda(x, x)).with_type(xs.type)).with_type(xs.type), RUNTIME_POOL)
+        with save_property(core, "_MAX_COST_COMPARISONS"):
+            core._MAX_COST_COMPARISONS = 2
+            learner.cost_comparisons.clear()
+            expected = learner.compare_costs(c2, c1)
+            learner.compare_costs(c3, c1)
+            learner.compare_costs(c2, c1)
+            learner.compare_costs(c1, c3)
+            assert len(learner.cost_comparisons) == 2
+            hits = learner.cchits
+            assert learner.compare_costs(c2, c1) == expected
+            assert learner.cchits == hits + 1
+            learner.assumptions = T
+            assert len(learner.cost_comparisons) == 0
+
+    def test_cache_find_containing(self):
+        x = EVar("x").with_type(TInt())
+        y = EVar("y").with_type(TInt())
+        e1 = EBinOp(x, "+", y).with_type(TInt())
+        e2 = EBinOp(e1, "+", ONE).with_type(TInt())
+        cache = Cache(binders=[], args=[x, y])
+        cache.add(x, size=1, pool=RUNTIME_POOL)
+        cache.add(e1, size=3, pool=RUNTIME_POOL)
+        cache.add(e2, size=5, pool=RUNTIME_POOL)
+        cache.add(e1, size=3, pool=STATE_POOL)
+        assert len(cache) == 4
+        assert cache.index_entries == 1 + 3 + 5 + 3
+        assert cache.find_containing(e1, RUNTIME_POOL) == [(e1, 3), (e2, 5)]
+        cache.evict(e2, size=5, pool=RUNTIME_POOL)
+        assert len(cache) == 3
+        assert cache.index_entries == 1 + 3 + 3
+        assert cache.find_containing(e1, RUNTIME_POOL) == [(e1, 3)]
+        assert cache.find_containing(ONE, RUNTIME_POOL) == []
+        assert cache.find_containing(x, STATE_POOL) == [(e1, 3)]
+        cache.evict(e2, size=5, pool=RUNTIME_POOL)
+        assert len(cache) == 3
+
+    def test_seen_set_crowded(self):
+        x = EVar("x").with_type(TInt())
+        e1 = EBinOp(x, "+", ZERO).with_type(TInt())
+        e2 = EBinOp(ZERO, "+", x).with_type(TInt())
+        for seen in (SeenSet(), CompactSeenSet()):
+            seen.add(x, RUNTIME_POOL, (1, 2), 1, PlainCost(1))
+            seen.add(e1, RUNTIME_POOL, (1, 2), 3, PlainCost(3))
+            seen.add(e2, RUNTIME_POOL, (1, 2), 3, PlainCost(4))
+            seen.add(ZERO, RUNTIME_POOL, (0, 0), 1, PlainCost(1))
+            assert [e for (e, size, cost) in seen.find_all(RUNTIME_POOL, (1, 2))] == [x, e1, e2]
+            assert [cost.n for (e, size, cost) in seen.find_all(RUNTIME_POOL, (1, 2))] == [1, 3, 4]
+            # every entry of the class is checked, including the last one
+            with self.assertRaises(AssertionError):
+                seen.add(e2, RUNTIME_POOL, (1, 2), 3, PlainCost(4))
+            assert len(seen) == 4
+            assert seen.contains(e1, RUNTIME_POOL, (1, 2))
+            assert not seen.contains(EBinOp(x, "+", ZERO).with_type(TInt()), RUNTIME_POOL, (1, 2))
+            assert seen.contains_alpha_equivalent(EBinOp(x, "+", ZERO).with_type(TInt()), RUNTIME_POOL, (1, 2))
+            assert not seen.contains_alpha_equivalent(e1, STATE_POOL, (1, 2))
+            assert [e for (e, pool, fp, size) in seen.crowded()] == [e1, e2]
+            seen.remove(e1, RUNTIME_POOL, (1, 2))
+            seen.remove(x, RUNTIME_POOL, (1, 2))
+            assert list(seen.crowded()) == []
+            seen.remove(e2, RUNTIME_POOL, (1, 2))
+            assert seen.find_one(RUNTIME_POOL, (1, 2)) is None
+            assert [e for (e, pool, fp, size) in seen.entries()] == [ZERO]
+            seen.add(e2, RUNTIME_POOL, (1, 2), 3, PlainCost(3))
+            assert seen.find_one(RUNTIME_POOL, (1, 2))[0] is e2
+            assert len(seen) == 2
+
+    def test_seen_set_counts_evaluations(self):
+        x = EVar("x").with_type(TInt())
+        seen = SeenSet()
+        seen.add(x, RUNTIME_POOL, (1, 2), 1, PlainCost(1), evaluation=((1, 2, 3), frozenset()))
+        assert seen.nodes == 1 + 2 + 3
+        seen.remove(x, RUNTIME_POOL, (1, 2))
+        assert seen.nodes == 0
+        assert seen.evaluation_of(x) is None
+
+    def test_memory_budget(self):
+        from cozy.synthesis import core
+        learner, x, xs = make_learner()
+        a = x
+        b = EBinOp(x, BOp.Or, x).with_type(BOOL)
+        c = EBinOp(ENot(x), BOp.And, ENot(x)).with_type(BOOL)
+        d = ENot(x)
+        with save_property(core.cache_memory_budget, "value"), save_property(core, "_BYTES_PER_NODE"), save_property(core, "_BYTES_PER_WF_VERDICT"):
+            core.cache_memory_budget.value = 1
+            core._BYTES_PER_NODE = 60000
+            forget_verdicts()
+            learner.reset([])
+            learner.cost_comparisons.clear()
+            for (e, fp, size, crowded) in [(a, (0,), 1, False), (b, (0,), 3, True), (c, (1,), 5, False), (d, (2,), 2, False)]:
+                learner.cache.add(e, size=size, pool=RUNTIME_POOL)
+                learner.seen.add(e, RUNTIME_POOL, fp, size, PlainCost(size))
+                learner._enqueue_for_eviction(e, RUNTIME_POOL, fp, size, crowded)
+            assert learner._memory_estimate() > 1024 * 1024
+            learner._enforce_memory_budget()
+            assert learner._memory_estimate() <= 1024 * 1024
+            assert [e for (e, pool, fp, size) in learner.seen.entries()] == [a, d]
+            assert sorted(size for (e, size, pool) in learner.cache) == [1, 2]
+            assert (learner.crowded_evictions, learner.large_evictions) == (1, 1)
+            # the wf memo counts against the budget too
+            exp_wf(d, state_vars={xs}, args={x})
+            assert verdict_count() > 0
+            core._BYTES_PER_NODE = 0
+            core._BYTES_PER_WF_VERDICT = 1024 * 1024
+            learner._enforce_memory_budget()
+            assert verdict_count() == 0
+
+    def test_batch_enumeration(self):
+        learner, x, xs = make_learner()
+        learner.reset([{ xs.id: Bag((True,)) }, { xs.id: Bag((False, True)) }])
+        candidates = [
+            (EBinOp(ENot(x), BOp.And, ENot(x)).with_type(BOOL), RUNTIME_POOL),
+            (EBinOp(x, BOp.Or, x).with_type(BOOL), RUNTIME_POOL),
+            (ENot(x), RUNTIME_POOL),
+            (x, RUNTIME_POOL),
+            (EBinOp(x, BOp.And, x).with_type(BOOL), RUNTIME_POOL),
+            (EBinOp(x, BOp.And, x).with_type(BOOL), STATE_POOL)]
+        pruned = learner.batch_pruned
+        fingerprinted = learner.fpcount
+        res = list(learner._batch(candidates))
+        # only the smallest candidate per (pool, fingerprint) survives
+        assert res == [(ENot(x), RUNTIME_POOL), (x, RUNTIME_POOL), (EBinOp(x, BOp.And, x).with_type(BOOL), STATE_POOL)]
+        assert learner.batch_pruned - pruned == 3
+        # every candidate is evaluated exactly once, and only the survivors'
+        # evaluations are kept
+        assert learner.fpcount - fingerprinted == len(candidates)
+        assert len(learner.batch_evaluations) == len(res)
+        # ...and its batched evaluation matches evaluating it on its own
+        for (e, pool) in res:
+            stored, (values, free_binders) = learner.batch_evaluations[id(e)]
+            assert stored is e
+            assert (e.type,) + values == fingerprint(e, learner.all_examples)
+            assert free_binders == frozenset((x,))
+
+    def test_sharded_enumeration(self):
+        x = EVar("x").with_type(INT)
+        b = EVar("_b").with_type(INT)
+        s = EVar("s").with_type(TBag(INT))
+        builder = BinderBuilder([b], [s], [x])
+        cache = Cache(binders=[b], args=[x])
+        for size in (1, 2):
+            for (e, pool) in list(builder.build(cache, size)):
+                cache.add(e, size=size, pool=pool)
+        serial = list(builder.build(cache, 3))
+        sharder = ShardedBuilder(builder)
+        shards = []
+        for shard in range(3):
+            shards.extend(_run_shard(sharder, sharder, cache, 3, shard, 3))
+        shards.sort(key=lambda x: x[0])
+        assert [(e, pool) for (i, e, pool) in shards] == serial
+
+    def test_parallel_cache_updates(self):
+        x = EVar("x").with_type(INT)
+        b = EVar("_b").with_type(INT)
+        s = EVar("s").with_type(TBag(INT))
+        builder = BinderBuilder([b], [s], [x])
+        sharder = ShardedBuilder(builder)
+        pb = ParallelBuilder(sharder, sharder, 2)
+        cache = Cache(binders=[b], args=[x])
+        def sync():
+            update = pb._cache_update(cache)
+            payload = pickle.dumps((opts.snapshot(), sharder, sharder, update, 2, 1))
+            out = parallel.handle((payload, common._i.value, 0))
+            assert list(parallel._CACHE) == list(cache)
+            return (update, out)
+        with save_property(parallel, "_CACHE"):
+            for (e, pool) in list(builder.build(cache, 1)):
+                cache.add(e, size=1, pool=pool)
+            (full, added, evicted), out = sync()
+            assert full and len(added) == len(cache) and not evicted
+            assert [(e, pool) for (i, e, pool) in out] == list(builder.build(cache, 2))
+
+            (e, size, pool) = next(iter(cache))
+            cache.evict(e, size=size, pool=pool)
+            cache.add(EBinOp(x, "+", x).with_type(INT), size=3, pool=RUNTIME_POOL)
+            (full, added, evicted), out = sync()
+            assert not full and len(added) == 1 and evicted == [(e, size, pool)]
+
+            (full, added, evicted), out = sync()
+            assert not full and not added and not evicted
+
+            cache = Cache(binders=[b], args=[x])
+            (full, added, evicted), out = sync()
+            assert full and not added and not evicted
+
+    def test_job_metrics(self):
+        metrics = JobMetrics()
+        metrics.set_status("q", "running")
+        metrics.update("q", {"event": "target", "time": 0, "cost": "10", "size": 5})
+        metrics.update("q", {"event": "minor_iteration", "time": 1, "size": 2, "exps": 50, "duration": 2.0, "cache_size": 7, "solver": {"calls": 3}})
+        metrics.update("q", {"event": "target", "time": 2, "cost": "4", "size": 3})
+        metrics.set_status("q", "done")
+        q = metrics.snapshot()["queries"]["q"]
+        assert q["status"] == "done"
+        assert (q["best_cost"], q["best_size"], q["improvements"]) == ("4", 3, 1)
+        assert (q["exps_per_second"], q["cache_size"], q["solver"]) == (25.0, 7, {"calls": 3})
+
+    def test_implementation_code_is_cached(self):
+        spec = parse.parse("""
+            Basic:
+                state l : Bag<Int>
+                op add(n : Int)
+                    l.add(n);
+                op remove(n : Int)
+                    l.remove(n);
+                query elems()
+                    l
+                query count()
+                    sum [ 1 | x <- l ]
+            """)
+        assert not typecheck.typecheck(spec)
+        impl = construct_initial_implementation(desugar.desugar(spec))
+        code = impl.code
+        cached = dict(impl._op_code_cache)
+        assert set(cached) == {"add", "remove"}
+        assert impl.code == code
+        assert all(impl._op_code_cache[op] is cached[op] for op in cached)
+
+        # changing the update code of one op only invalidates that op
+        (v, _) = impl.concrete_state[0]
+        impl.updates[(v, "add")] = SNoOp()
+        impl.code
+        assert impl._op_code_cache["add"] is not cached["add"]
+        assert impl._op_code_cache["remove"] is cached["remove"]
+
+        copy = pickle.loads(pickle.dumps(impl))
+        assert copy._op_code_cache == {}
+        # (the copy lifts reads into fresh temporaries of its own)
+        assert [m.name for m in copy.code.methods] == [m.name for m in impl.code.methods]
+
+    def test_equivalent_state_var(self):
+        spec = parse.parse("""
+            Basic:
+                state l : Bag<Int>
+                query elems()
+                    l
+            """)
+        assert not typecheck.typecheck(spec)
+        impl = construct_initial_implementation(desugar.desugar(spec))
+        [(v, _)] = impl.concrete_state
+        l = EVar("l").with_type(INT_BAG)
+        x = EVar("x").with_type(INT)
+        assert impl._equivalent_state_var(EFilter(l, ELambda(x, T)).with_type(INT_BAG)) == v
+        assert impl._equivalent_state_var(EEmptyList().with_type(INT_BAG)) is None
+        assert len(impl._state_examples) == 1
+        # refuted by the stored example without another solver call
+        assert impl._equivalent_state_var(EUnaryOp(UOp.Distinct, EEmptyList().with_type(INT_BAG)).with_type(INT_BAG)) is None
+        assert len(impl._state_examples) == 1
+        # expressions the examples cannot evaluate have no fingerprint
+        err = io.StringIO()
+        with contextlib.redirect_stderr(err):
+            assert impl._state_fingerprint(ECall("f", ()).with_type(INT_BAG)) is None
+        assert err.getvalue() == ""
+
+    def test_parallel_incrementalization(self):
+        spec = parse.parse("""
+            Basic:
+                state l : Bag<Int>
+                op add(n : Int)
+                    l.add(n);
+                op remove(n : Int)
+                    l.remove(n);
+                query elems()
+                    l
+            """)
+        assert not typecheck.typecheck(spec)
+        spec = desugar.desugar(spec)
+        serial = construct_initial_implementation(spec)
+        with save_property(parallel_incrementalization, "value"):
+            parallel_incrementalization.value = 2
+            parallel = construct_initial_implementation(spec)
+        # same subqueries in the same order, up to fresh names
+        docs = lambda impl: [re.sub(r"\d+", "", q.docstring) for q in impl.query_specs]
+        assert docs(parallel) == docs(serial)
+        assert len(set(q.name for q in parallel.query_specs)) == len(parallel.query_specs)
+        assert list(k[1] for k in parallel.updates) == list(k[1] for k in serial.updates)
+
+    def test_operand_pairs(self):
+        x = EVar("x").with_type(INT)
+        m = EVar("m").with_type(TMap(INT, BOOL))
+        ys = EVar("ys").with_type(TBag(INT))
+        cache = Cache(binders=[], args=[])
+        for e in (x, m, ys, T, ONE):
+            cache.add(e, size=1, pool=RUNTIME_POOL)
+        assert list(operand_pairs(cache, RUNTIME_POOL, 1, 1, lambda t: t.k if isinstance(t, TMap) else None)) == [(m, x), (m, ONE)]
+        assert set(operand_pairs(cache, RUNTIME_POOL, 1, 1, lambda t: t)) == set((a, b) for a in (x, m, ys, T, ONE) for b in (x, m, ys, T, ONE) if a.type == b.type)
+
+    def test_evaluate_from_children(self):
+        xs = EVar("xs").with_type(INT_BAG)
+        x = EVar("x").with_type(INT)
+        b = EVar("b").with_type(INT)
+        examples = instantiate_examples([{ xs.id: Bag((1, 2, 3)) }, { xs.id: Bag((0,)) }], [b])
+        children = {
+            xs: (tuple(ex[xs.id] for ex in examples), frozenset()),
+            b:  (tuple(ex[b.id] for ex in examples), frozenset((b,))) }
+        known = lambda e: children.get(e)
+        es = [
+            EBinOp(EUnaryOp(UOp.Sum, xs).with_type(INT), "+", b).with_type(INT),
+            EFilter(xs, ELambda(x, EBinOp(x, ">", b).with_type(BOOL))).with_type(INT_BAG),
+            EMap(xs, ELambda(x, EBinOp(x, "+", x).with_type(INT))).with_type(INT_BAG)]
+        for e in es:
+            values, free_binders = evaluate_from_children(e, examples, [b], known)
+            assert (e.type,) + values == fingerprint(e, examples)
+            assert free_binders == frozenset(v for v in (b,) if v in free_vars(e))
+        # the one-off shallow copies stay out of the compile cache
+        before = compile_cache_stats()
+        for e in es[1:]:
+            evaluate_from_children(e, examples, [b], known)
+        assert compile_cache_stats() == before
@@ -0,0 +1,59 @@
+import unittest
+
+from cozy.target_syntax import *
+from cozy.syntax_tools import mk_lambda
+from cozy.pools import RUNTIME_POOL, STATE_POOL
+from cozy.common import save_property
+from cozy.wf import exp_wf, exp_wf_nonrecursive, ExpIsNotWf, type_wf, may_be_wf, allow_conditional_state, verdict_count, forget_verdicts
+
+class TestWf(unittest.TestCase):
+
+    def test_type_wf(self):
+        assert type_wf(TBag(INT))
+        assert not type_wf(TBag(TBag(INT)))
+        assert not type_wf(TMap(TBag(INT), INT))
+        assert not type_wf(TMap(INT, TMap(INT, INT)))
+
+    def test_may_be_wf(self):
+        assert may_be_wf(EBinOp, INT, RUNTIME_POOL, "+")
+        assert not may_be_wf(EBinOp, INT, STATE_POOL, "+")
+        assert not may_be_wf(EBinOp, TBag(INT), STATE_POOL, "-")
+        assert may_be_wf(EBinOp, TBag(INT), STATE_POOL, "+")
+        assert not may_be_wf(ESingleton, TBag(INT), STATE_POOL)
+
+    def test_memoized_fragments(self):
+        xs = EVar("xs").with_type(TBag(INT))
+        arg = EVar("arg").with_type(INT)
+        f = mk_lambda(INT, lambda x: EEq(x, arg))
+        good = EFilter(EStateVar(xs).with_type(xs.type), f).with_type(xs.type)
+        bad = EStateVar(EFilter(xs, f).with_type(xs.type)).with_type(xs.type)
+        for i in range(2):
+            assert exp_wf(good, state_vars={xs}, args={arg})
+            with self.assertRaises(ExpIsNotWf):
+                exp_wf(bad, state_vars={xs}, args={arg})
+            # the same fragments, in a different context
+            assert exp_wf(bad, state_vars={xs, arg}, args=set())
+            # direct calls share the verdicts
+            with self.assertRaises(ExpIsNotWf):
+                exp_wf_nonrecursive(bad, state_vars={xs}, args={arg})
+
+    def test_memoized_verdicts_depend_on_options(self):
+        b = EVar("b").with_type(BOOL)
+        xs = EVar("xs").with_type(TBag(INT))
+        e = ECond(b, xs, xs).with_type(xs.type)
+        with save_property(allow_conditional_state, "value"):
+            for allow_conditional_state.value in (False, True, False):
+                if allow_conditional_state.value:
+                    exp_wf_nonrecursive(e, state_vars={b, xs}, args=set(), pool=STATE_POOL)
+                else:
+                    with self.assertRaises(ExpIsNotWf):
+                        exp_wf_nonrecursive(e, state_vars={b, xs}, args=set(), pool=STATE_POOL)
+
+    def test_forget_verdicts(self):
+        xs = EVar("xs").with_type(TBag(INT))
+        exp_wf(EUnaryOp(UOp.Sum, EStateVar(xs).with_type(xs.type)).with_type(INT), state_vars={xs}, args=set())
+        assert verdict_count() > 0
+        forget_verdicts(keep=1)
+        assert verdict_count() == 1
+        forget_verdicts()
+        assert verdict_count() == 0